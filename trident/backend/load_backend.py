@@ -85,6 +85,7 @@ if get_backend()== 'pytorch':
     from trident.optims.pytorch_regularizers import *
     from trident.optims.pytorch_losses import *
     from trident.optims.pytorch_metrics import *
+    from trident.optims.pytorch_inference import *
 
     from trident.optims.pytorch_trainer import *
 
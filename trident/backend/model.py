@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 #import pysnooper
+import contextlib
 import copy
 import inspect
 import os
@@ -11,6 +12,7 @@ import random
 import shutil
 import string
 import sys
+import tempfile
 import time
 import uuid
 import json
@@ -21,11 +23,13 @@ from trident.backend.common import to_list, addindent, get_time_suffix, format_t
     snake2camel, PrintException, unpack_singleton, enforce_singleton, OrderedDict, split_path, sanitize_path,make_dir_if_need,Signature
 from trident.backend.tensorspec import *
 from trident.data.image_common import *
-from trident.callbacks import LambdaCallback, UnfreezeModelCallback
+from trident.callbacks import LambdaCallback, UnfreezeModelCallback, CallbackDispatcher
 
 _session = get_session()
 _backend = get_backend()
+_null_context = contextlib.nullcontext()
 if _backend == 'pytorch':
+    import torch
     from trident.backend.pytorch_backend import *
     from trident.backend.pytorch_ops import *
 
@@ -36,7 +40,7 @@ elif _backend == 'tensorflow':
 
 
 
-__all__ = ['progress_bar','ModelBase','HistoryBase']
+__all__ = ['progress_bar','ModelBase','HistoryBase','HistorySeries']
 
 
 
@@ -83,6 +87,8 @@ class ModelBase(object):
         self.grad_clipping_by_norm = False
         self.grad_clipping_threshold = None
         self.use_output_as_loss = False
+        self.profiler = None
+        self.callback_dispatcher = CallbackDispatcher()
         self.training_context = {
                                  'losses': HistoryBase('losses'),  # loss_wrapper
                                  'metrics': HistoryBase('metrics'),  # loss_wrapper
@@ -517,6 +523,119 @@ class ModelBase(object):
 
         return train_data, test_data
 
+    def compile_call_plans(self):
+        """Compile the argument plans of the model, losses, regularizers and metrics for the current data_feed.
+
+        The plans are cached in training_context['call_plans'] and rebuilt by `call_with_plan` only when
+        the data_feed or the signature of a callable changes.
+
+        """
+        self.training_context['call_plans'] = OrderedDict()
+        if _backend != 'pytorch' or 'data_feed' not in self.training_context:
+            return
+        data_feed = self.training_context['data_feed']
+        callables = [('model', self._model)]
+        callables.extend([('loss:' + k, v) for k, v in self._losses.items()])
+        callables.extend([('reg:' + k, v) for k, v in self._regs.items()])
+        callables.extend([('metric:' + k, v) for k, v in self._metrics.items()])
+        for key, fn in callables:
+            try:
+                self.training_context['call_plans'][key] = CallPlan(fn, data_feed)
+            except Exception:
+                pass
+
+    def call_with_plan(self, key, fn, data):
+        """Call fn with its arguments gathered from data through the cached call plan.
+
+        Args:
+            key (str): the plan key, ex. 'model', 'loss:CrossEntropyLoss'.
+            fn (callable): the callable.
+            data (OrderedDict): The key-value pair for available data.
+
+        Returns:
+            The result of the callable base on data_feed
+
+        """
+        data_feed = self.training_context['data_feed']
+        if _backend != 'pytorch':
+            return try_map_args_and_call(fn, data, data_feed)
+        if 'call_plans' not in self.training_context:
+            self.training_context['call_plans'] = OrderedDict()
+        plans = self.training_context['call_plans']
+        try:
+            plan = plans[key] if key in plans else None
+            if plan is None or not plan.is_valid(fn, data_feed):
+                plan = CallPlan(fn, data_feed)
+                plans[key] = plan
+            return plan(data)
+        except Exception as e:
+            print(e)
+            PrintException()
+
+    def dispatch_callbacks(self, when, shared=None):
+        """Call the hook of a training event on the callbacks overriding it (see `CallbackDispatcher`)."""
+        dispatcher = self.__dict__.get('callback_dispatcher')
+        if dispatcher is None:
+            dispatcher = self.callback_dispatcher = CallbackDispatcher()
+        if dispatcher.callbacks is not self.training_context['callbacks']:
+            dispatcher.bind(self.training_context['callbacks'])
+        dispatcher.dispatch(when, self.training_context, shared=shared)
+
+    def profile_phase(self, name):
+        """Context manager timing a phase of the training step while the profiler records it, a no-op otherwise."""
+        if self.profiler is None or not self.profiler.is_active:
+            return _null_context
+        return self.profiler.phase(name)
+
+    def mask_abnormal_number(self, name, loss):
+        """Replace a loss having nan/inf by zero, and mark the step to be skipped.
+
+        The check stays on device (no host sync per loss), the occurrences are accumulated in
+        training_context['abnormal_counts'] and reported by `check_abnormal_number` at the collect boundary.
+        Masking the value does not remove the non finite branch from the autograd graph, so the checks of all
+        the losses of the step are also fused in training_context['step_is_finite'], and the non finite
+        gradients of a step where it is false are zeroed on device after the backward (see `do_gradient_update`),
+        the finite gradients of the other losses are still applied.
+
+        Args:
+            name (str): the loss name.
+            loss (Tensor): the loss value.
+
+        Returns:
+            the loss, or zero if it has abnormal number.
+
+        """
+        if _backend != 'pytorch' or not is_tensor(loss):
+            if any_abnormal_number(to_tensor(loss)):
+                sys.stderr.write('Loss {0} have abnormal number (nan, inf,-inf), trident will skip it automaticly, please check anything wrong!!!\n'.format(name))
+                return to_tensor(0.0)
+            return loss
+        is_finite = torch.isfinite(loss).all()
+        if 'abnormal_counts' not in self.training_context:
+            self.training_context['abnormal_counts'] = OrderedDict()
+        counts = self.training_context['abnormal_counts']
+        counts[name] = (~is_finite).int() + (counts[name] if name in counts else 0)
+        step_is_finite = self.training_context.get('step_is_finite', None)
+        self.training_context['step_is_finite'] = is_finite if step_is_finite is None else step_is_finite & is_finite
+        return torch.where(is_finite, loss, torch.zeros_like(loss))
+
+    def check_abnormal_number(self):
+        """Report the losses masked by `mask_abnormal_number` with a single device sync, and repair the model parameters if needed."""
+        counts = self.training_context.get('abnormal_counts', None)
+        if counts is None or len(counts) == 0:
+            return
+        self.training_context['abnormal_counts'] = OrderedDict()
+        count_values = to_numpy(torch.stack([c.reshape(()) for c in counts.value_list])).tolist()
+        has_abnormal = False
+        for name, count in zip(counts.key_list, count_values):
+            if count > 0:
+                has_abnormal = True
+                sys.stderr.write('Loss {0} have abnormal number (nan, inf,-inf) in {1} steps, trident masked it automaticly, please check anything wrong!!!\n'.format(name, count))
+        if has_abnormal and isinstance(self._model, Layer) and any_abnormal_number(self._model):
+            for para in self._model.parameters():
+                if any_abnormal_number(para):
+                    para.data.copy_(where(is_nan(para), random_normal_like(para, mean=0, std=0.02).to(get_device()), para))
+
     def do_preparation_for_loss(self):
         pass
 
@@ -533,10 +652,10 @@ class ModelBase(object):
 
     def do_post_gradient_update(self):
 
-        self.training_context['tmp_losses'].collect('total_losses',self.training_context['steps'],self.training_context['current_loss'])
+        # running sum on device, the mean is collected as a pending tensor and only read at the print/epoch boundaries
+        self.training_context['tmp_losses'].accumulate('total_losses',self.training_context['current_loss'])
         if self.training_context['is_collect_data'] == True:
-            steps,values=self.training_context['tmp_losses'].get_series('total_losses')
-            self.training_context['losses'].collect('total_losses',self.training_context['steps'],float(np.asarray(values).mean()))
+            self.training_context['losses'].collect('total_losses',self.training_context['steps'],self.training_context['tmp_losses'].pop_mean('total_losses'))
             self.training_context['tmp_losses'].reset()
 
     def do_on_metrics_evaluation_start(self):
@@ -595,10 +714,10 @@ class ModelBase(object):
         folder,filename,ext=split_path(save_path)
         save_path=os.path.join(folder,default_file_name)
         out=OrderedDict()
-        out['batch_loss_history']=self.batch_loss_history
-        out['batch_metric_history'] = self.batch_metric_history
-        out['epoch_loss_history'] = self.epoch_loss_history
-        out['epoch_metric_history'] = self.epoch_metric_history
+        out['batch_loss_history']=self.batch_loss_history.to_dict()
+        out['batch_metric_history'] = self.batch_metric_history.to_dict()
+        out['epoch_loss_history'] = self.epoch_loss_history.to_dict()
+        out['epoch_metric_history'] = self.epoch_metric_history.to_dict()
         with open(save_path, 'w') as f:
             jstring=json.dumps(out, indent=4)
             f.write(jstring)
@@ -622,10 +741,10 @@ class ModelBase(object):
             if collect_history != False:
                 if k in self.batch_metric_history and len(batch_values)>=print_batch_progress_frequency:
                     metric_value=np.array(batch_values[-1*print_batch_progress_frequency:]).mean()
-                elif k in self.training_context['tmp_metrics']:
-                    tmp_steps,tmp_values=self.training_context['tmp_metrics'].get_series(k)
-                    metric_value = np.array(tmp_values).mean()
-                    self.training_context['tmp_metrics'][k]=[]
+                elif k in self.training_context['tmp_metrics'].running_keys:
+                    metric_value = float(to_numpy(self.training_context['tmp_metrics'].pop_mean(k)))
+                else:
+                    metric_value = np.array(batch_values[-1*print_batch_progress_frequency:]).mean() if len(batch_values) > 0 else np.nan
                 format_string='.3%'
                 if metric_value > 3:
                     format_string = '.3f'
@@ -709,17 +828,17 @@ class ModelBase(object):
                 self.training_context['print_epoch_progress_frequency'] = 1
 
                 self.do_on_epoch_start()
-                for callback in self.callbacks:
-                    callback.on_epoch_start(self.training_context)
+                self.dispatch_callbacks('on_epoch_start')
 
             self.do_on_batch_start()
-            for callback in self.callbacks:
-                callback.on_batch_start(self.training_context)
+            with self.profile_phase('callbacks'):
+                self.dispatch_callbacks('on_batch_start')
 
-            train_data, test_data = self.do_on_data_received(train_data, test_data)
+            with self.profile_phase('host_to_device'):
+                train_data, test_data = self.do_on_data_received(train_data, test_data)
 
-            for callback in self.callbacks:
-                callback.on_data_received(self.training_context)
+            with self.profile_phase('callbacks'):
+                self.dispatch_callbacks('on_data_received')
 
             if accumulate_grads == False:
                 self.training_context['current_loss'] = to_tensor(0.0,requires_grad=True)
@@ -729,7 +848,8 @@ class ModelBase(object):
 
             if  'skip_generate_output' not in self.training_context or self.training_context['skip_generate_output']==False:
                 try:
-                    output = try_map_args_and_call(self._model, train_data, self.training_context['data_feed'])
+                    with self.profile_phase('forward'):
+                        output = self.call_with_plan('model', self._model, train_data)
                     if isinstance(output, (list, tuple)):
                         for i in range(len(output)):
                             train_data[self.outputs.key_list[i]] = output[i]
@@ -767,60 +887,54 @@ class ModelBase(object):
             # output=unpack_singleton(output)
 
             # losss
-            for k, v in self._losses.items():
-                if not hasattr(v,'start_epoch') or (hasattr(v,'start_epoch') and v.start_epoch<=self.training_context['current_epoch']):
-
-                    try:
-                        loss_weight = to_tensor(1.0)
-                        if k in self.loss_weights:
-                            loss_weight = self.loss_weights[k]
-                        loss_weight=to_tensor(loss_weight,'float32')
-                        this_loss = loss_weight*try_map_args_and_call(v, train_data, self.training_context['data_feed']) # v.forward(output, target) if hasattr(v, 'forward') else v(
-
-                        if isinstance(this_loss, tuple):
-                            overall_loss =to_tensor(0.0,requires_grad=True)
-                            for i in range(len(this_loss)):
-                                if any_abnormal_number(this_loss[i]):
-                                    sys.stderr.write('Loss {0} have abnormal number (nan, inf,-inf), trident will skip it automaticly, please check anything wrong!!!/n'.format(k))
-                                else:
+            with self.profile_phase('loss'):
+                for k, v in self._losses.items():
+                    if not hasattr(v,'start_epoch') or (hasattr(v,'start_epoch') and v.start_epoch<=self.training_context['current_epoch']):
+
+                        try:
+                            loss_weight = to_tensor(1.0)
+                            if k in self.loss_weights:
+                                loss_weight = self.loss_weights[k]
+                            loss_weight=to_tensor(loss_weight,'float32')
+                            this_loss = loss_weight*self.call_with_plan('loss:' + k, v, train_data) # v.forward(output, target) if hasattr(v, 'forward') else v(
+
+                            if isinstance(this_loss, tuple):
+                                overall_loss =to_tensor(0.0,requires_grad=True)
+                                for i in range(len(this_loss)):
                                     # a leaf Variable that requires grad connotused in an in-place operation.
-                                    overall_loss =overall_loss+ this_loss[i]
-                            self.training_context['current_loss'] =self.training_context['current_loss']+ overall_loss
+                                    overall_loss =overall_loss+ self.mask_abnormal_number(k, this_loss[i])
+                                self.training_context['current_loss'] =self.training_context['current_loss']+ overall_loss
 
-                            if is_collect_data:
-                                self.training_context['losses'].collect(k,self.training_context['steps'],overall_loss)
+                                if is_collect_data:
+                                    self.training_context['losses'].collect(k,self.training_context['steps'],overall_loss)
 
-                        else:
-                            if any_abnormal_number(this_loss):
-                                sys.stderr.write( 'Loss {0} have abnormal number (nan, inf,-inf), trident will skip it automaticly, ' 'please check anything wrong!!!/n'.format(k))
                             else:
                                 #a leaf Variable that requires grad connotused in an in-place operation.
-                                self.training_context['current_loss'] =self.training_context['current_loss'] + this_loss
-                            if is_collect_data:
-                                self.training_context['losses'].collect(k, self.training_context['steps'], this_loss)
-                    except Exception as e:
-                        print(e)
-                        PrintException()
+                                self.training_context['current_loss'] =self.training_context['current_loss'] + self.mask_abnormal_number(k, this_loss)
+                                if is_collect_data:
+                                    self.training_context['losses'].collect(k, self.training_context['steps'], this_loss)
+                        except Exception as e:
+                            print(e)
+                            PrintException()
 
             self.do_post_loss_calculation()
-            for callback in self.callbacks:
-                callback.on_loss_calculation_end(self.training_context)
+            with self.profile_phase('callbacks'):
+                self.dispatch_callbacks('on_loss_calculation_end')
 
             if accumulate_grads == False:
-                # regularizer
-                for k, v in self._regs.items():
-                    this_loss=to_tensor(0.0,requires_grad=True)
-                    if 'model' in v.signature.inputs:
-                        this_loss = v(self._model) if self.training_context['stop_update'] < 1 else to_tensor(0.0,requires_grad=True)
-                    elif 'output' in v.signature.inputs:
-
-                        this_loss = try_map_args_and_call(v, train_data, self.training_context['data_feed']) if self.training_context['stop_update'] < 1 else to_tensor(0.0)
-                    if not any_abnormal_number(this_loss):
+                with self.profile_phase('regularizer'):
+                    # regularizer
+                    for k, v in self._regs.items():
+                        this_loss=to_tensor(0.0,requires_grad=True)
+                        if 'model' in v.signature.inputs:
+                            this_loss = v(self._model) if self.training_context['stop_update'] < 1 else to_tensor(0.0,requires_grad=True)
+                        elif 'output' in v.signature.inputs:
+
+                            this_loss = self.call_with_plan('reg:' + k, v, train_data) if self.training_context['stop_update'] < 1 else to_tensor(0.0)
                         # a leaf Variable that requires grad connotused in an in-place operation.
-                        self.training_context['current_loss'] =self.training_context['current_loss'] + this_loss  # self.training_context[
-                    # 'current_loss'] + this_loss
-                    if is_collect_data:
-                        self.training_context['losses'].collect(k + '_Loss', self.training_context['steps'], this_loss)
+                        self.training_context['current_loss'] =self.training_context['current_loss'] + self.mask_abnormal_number(k + '_Loss', this_loss)
+                        if is_collect_data:
+                            self.training_context['losses'].collect(k + '_Loss', self.training_context['steps'], this_loss)
 
 
 
@@ -837,10 +951,9 @@ class ModelBase(object):
                 # ON_POSTBACKWARD_CALCULATION
                 self.do_post_gradient_update()
 
-                if isinstance(self._model, Layer) and any_abnormal_number(self._model):
-                    for para in self._model.parameters():
-                        if any_abnormal_number(para):
-                            para.data.copy_(where(is_nan(para), random_normal_like(para, mean=0, std=0.02).to(get_device()), para))
+                # the nan/inf guard only syncs with the device at the collect boundary
+                if is_collect_data:
+                    self.check_abnormal_number()
 
                 # model comfirm
                 for k, v in self._constraints.items():
@@ -856,7 +969,7 @@ class ModelBase(object):
 
 
                 if is_out_sample_evaluation==True and test_data is not None and len(test_data) > 0 and  self.training_context['stop_update']<1 :
-                    tmp_output = try_map_args_and_call(self._model, test_data, self.training_context['data_feed'])
+                    tmp_output = self.call_with_plan('model', self._model, test_data)
                     if isinstance(tmp_output, (list, tuple)):
                         for i in range(len(tmp_output)):
                             test_data[self.outputs.key_list[i]] = tmp_output[i]
@@ -868,60 +981,56 @@ class ModelBase(object):
 
 
 
-                # ON_EVALUATION_START
-                self.do_on_metrics_evaluation_start()
-                for callback in self.training_context['callbacks']:
-                    callback.on_metrics_evaluation_start(self.training_context)
+                with self.profile_phase('metrics'):
+                    # ON_EVALUATION_START
+                    self.do_on_metrics_evaluation_start()
+                    self.dispatch_callbacks('on_metrics_evaluation_start')
 
 
-                for k, v in self._metrics.items():
-                    collect_history =getattr(v,'collect_history') if  hasattr(v,'collect_history') else True
-                    if not collect_history == False:
-                        self.training_context['metrics'].regist(k)
-                        self.training_context['tmp_metrics'].regist(k)
+                    for k, v in self._metrics.items():
+                        collect_history =getattr(v,'collect_history') if  hasattr(v,'collect_history') else True
+                        if not collect_history == False:
+                            self.training_context['metrics'].regist(k)
+                            self.training_context['tmp_metrics'].regist(k)
 
-                    this_metric = try_map_args_and_call(v, train_data, self.training_context['data_feed']) if  self.training_context['stop_update']<1 else to_tensor(0)
-                    self.training_context['tmp_metrics'].collect(k, self.training_context['steps'], this_metric)
+                        this_metric = self.call_with_plan('metric:' + k, v, train_data) if  self.training_context['stop_update']<1 else to_tensor(0)
+                        self.training_context['tmp_metrics'].accumulate(k, this_metric)
 
 
-                    if is_out_sample_evaluation==True and test_data is not None and len(test_data) > 0 and collect_history!=False :
-                        this_out_metric = try_map_args_and_call(v, test_data , self.training_context['data_feed'])
-                        self.training_context['out_sample_metrics'].collect(k, self.training_context['steps'], this_out_metric)
+                        if is_out_sample_evaluation==True and test_data is not None and len(test_data) > 0 and collect_history!=False :
+                            this_out_metric = self.call_with_plan('metric:' + k, v, test_data)
+                            self.training_context['out_sample_metrics'].collect(k, self.training_context['steps'], this_out_metric)
 
-                # ON_EVALUATION_END
-                self.do_on_metrics_evaluation_end()
-                for callback in self.training_context['callbacks']:
-                    callback.on_metrics_evaluation_end(self.training_context)
+                    # ON_EVALUATION_END
+                    self.do_on_metrics_evaluation_end()
+                    self.dispatch_callbacks('on_metrics_evaluation_end')
 
                 #callback's metric can keep in epoch_metric_history
 
 
                 if is_collect_data:
                     #aggregate tmp data and move to metrics history
-                    for k, v in self.training_context['tmp_metrics'].items():
-                        steps,values=self.training_context['tmp_metrics'].get_series(k)
-                        self.training_context['metrics'].collect(k, self.training_context['steps'], np.asarray(values).mean())
+                    for k in self.training_context['tmp_metrics'].running_keys:
+                        self.training_context['metrics'].collect(k, self.training_context['steps'], self.training_context['tmp_metrics'].pop_mean(k))
                     self.training_context['tmp_metrics'].reset()
 
-                # ON_BATCH_END
-                self.do_on_batch_end()
-                for callback in self.training_context['callbacks']:
-                    callback.on_batch_end(self.training_context)
+                with self.profile_phase('callbacks'):
+                    # ON_BATCH_END
+                    self.do_on_batch_end()
+                    self.dispatch_callbacks('on_batch_end')
 
-                # print batch progresss
-                if is_print_batch_progress:
-                    self.do_on_progress_start()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_progress_start(self.training_context)
+                    # print batch progresss
+                    if is_print_batch_progress:
+                        self.do_on_progress_start()
+                        self.dispatch_callbacks('on_progress_start')
 
-                    self.print_batch_progress(self.training_context['print_batch_progress_frequency'])
+                        self.print_batch_progress(self.training_context['print_batch_progress_frequency'])
 
-                    self.training_context['print_batch_progress_frequency'] = 1
-                    self.do_on_progress_end()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_progress_end(self.training_context)
-                else:
-                    self.training_context['print_batch_progress_frequency'] += 1
+                        self.training_context['print_batch_progress_frequency'] = 1
+                        self.do_on_progress_end()
+                        self.dispatch_callbacks('on_progress_end')
+                    else:
+                        self.training_context['print_batch_progress_frequency'] += 1
 
                 if is_out_sample_evaluation==True and test_data is not None and len(test_data) > 0:
                     verbose=[]
@@ -940,46 +1049,41 @@ class ModelBase(object):
 
             if self.training_context['current_batch'] == self.training_context['total_batch'] - 1:
                 self.do_on_epoch_end()
-                batch_steps,batch_values=self.training_context['losses'].get_series('total_losses')
+                batch_series=self.training_context['losses']['total_losses']
                 if not hasattr(self.training_context['losses'],'last_aggregate_idx'):
-                    self.epoch_loss_history.collect('total_losses',self.training_context['current_epoch'],np.asarray(batch_values).mean())
-                    self.training_context['losses'].last_aggregate_idx=len(batch_values)
+                    self.epoch_loss_history.collect('total_losses',self.training_context['current_epoch'],batch_series.mean())
+                    self.training_context['losses'].last_aggregate_idx=len(batch_series)
                 else:
-                    self.epoch_loss_history.collect('total_losses', self.training_context['current_epoch'], np.asarray(batch_values[self.training_context['losses'].last_aggregate_idx:]).mean())
-                    self.training_context['losses'].last_aggregate_idx = len(batch_values)
+                    self.epoch_loss_history.collect('total_losses', self.training_context['current_epoch'], batch_series.mean(self.training_context['losses'].last_aggregate_idx))
+                    self.training_context['losses'].last_aggregate_idx = len(batch_series)
 
 
 
-                for k, v in self.training_context['metrics'].items():
-                    metric_steps, metric_values = self.training_context['metrics'].get_series(k)
+                for k, metric_series in self.training_context['metrics'].items():
                     if not hasattr(self.training_context['metrics'], 'last_aggregate_idx'):
-                        self.epoch_metric_history.collect(k, self.training_context['current_epoch'], np.asarray(metric_values).mean())
-                        self.training_context['metrics'].last_aggregate_idx = len(metric_values)
+                        self.epoch_metric_history.collect(k, self.training_context['current_epoch'], metric_series.mean())
+                        self.training_context['metrics'].last_aggregate_idx = len(metric_series)
                     else:
-                        self.epoch_metric_history.collect(k, self.training_context['current_epoch'], np.asarray(metric_values[self.training_context['metrics'].last_aggregate_idx:]).mean())
-                        self.training_context['metrics'].last_aggregate_idx = len(metric_values)
+                        self.epoch_metric_history.collect(k, self.training_context['current_epoch'], metric_series.mean(self.training_context['metrics'].last_aggregate_idx))
+                        self.training_context['metrics'].last_aggregate_idx = len(metric_series)
 
 
 
                 if is_print_epoch_progress:
                     self.do_on_progress_start()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_progress_start(self.training_context)
+                    self.dispatch_callbacks('on_progress_start')
                     self.print_epoch_progress(self.training_context['print_epoch_progress_frequency'])
                     self.training_context['print_epoch_progress_frequency'] = 1
                     self.do_on_progress_end()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_progress_end(self.training_context)
+                    self.dispatch_callbacks('on_progress_end')
                 else:
                     self.training_context['print_epoch_progress_frequency'] += 1
 
-                for callback in self.training_context['callbacks']:
-                    callback.on_epoch_end(self.training_context)
+                self.dispatch_callbacks('on_epoch_end')
 
                 if self.training_context['current_epoch'] == self.training_context['total_epoch'] - 1:
                     self.do_on_training_end()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_training_end(self.training_context)
+                    self.dispatch_callbacks('on_training_end')
         except Exception:
             self.do_on_excution_exception()
             PrintException()
@@ -1066,41 +1170,286 @@ def progress_bar(step_time,current, total, msg=None, name=''):
 
 
 
+class HistorySeries(object):
+    """A growable (step, value) series backed by preallocated numpy arrays.
+
+    It behaves like the former list of (step, value) tuples (append, len, indexing, iteration),
+    while `steps`/`values` are zero-copy views, and `last`, `best` and range `mean` are O(1) thanks
+    to the running maximum/minimum and the cumulative sum. Once the capacity reaches `spill_threshold`
+    entries the arrays are moved to memory-mapped files in `spill_dir` (the temp folder if None).
+
+    Examples:
+        >>> series = HistorySeries([(0, 1.0), (1, 3.0)])
+        >>> series.append((2, 2.0))
+        >>> len(series), series[-1], series.mean(1), series.best()
+        (3, (2, 2.0), 2.5, 3.0)
+
+    """
+    spill_threshold = 1 << 20
+    spill_dir = None
+
+    def __init__(self, items=None, capacity=64):
+        self._size = 0
+        self._capacity = 0
+        self._steps = None
+        self._values = None
+        self._cumsum = None
+        self._abnormal = None
+        self._files = []
+        self._max = -np.inf
+        self._min = np.inf
+        self._reserve(capacity)
+        if items is not None:
+            for item in items:
+                self.append(item)
+
+    def _allocate(self, capacity, dtype):
+        if capacity >= self.spill_threshold:
+            fd, path = tempfile.mkstemp(prefix='trident_history_', suffix='.dat', dir=self.spill_dir)
+            os.close(fd)
+            self._files.append(path)
+            return np.memmap(path, dtype=dtype, mode='w+', shape=(capacity,))
+        return np.empty(capacity, dtype=dtype)
+
+    def _remove_files(self, files):
+        for path in files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _reserve(self, capacity):
+        if capacity <= self._capacity:
+            return
+        old_files = self._files
+        self._files = []
+        arrays = [self._allocate(capacity, dtype) for dtype in (np.int64, np.float64, np.float64, np.int64)]
+        if self._size > 0:
+            for new, old in zip(arrays, [self._steps, self._values, self._cumsum, self._abnormal]):
+                new[:self._size + 1] = old[:self._size + 1]
+        else:
+            arrays[2][0] = 0
+            arrays[3][0] = 0
+        self._steps, self._values, self._cumsum, self._abnormal = arrays
+        self._capacity = capacity
+        # the old mappings stay valid for the views handed out, only the files are released
+        self._remove_files(old_files)
+
+    def append(self, item):
+        if isinstance(item, (tuple, list)) and len(item) == 2:
+            step, value = item
+        else:
+            # a bare value, use its position as step
+            step, value = self._size, item
+        value = float(value)
+        # the cumulative arrays have one more slot than the series
+        if self._size + 2 > self._capacity:
+            self._reserve(max(2 * self._capacity, 64))
+        idx = self._size
+        self._steps[idx] = int(step)
+        self._values[idx] = value
+        is_finite = np.isfinite(value)
+        self._cumsum[idx + 1] = self._cumsum[idx] + (value if is_finite else 0.0)
+        self._abnormal[idx + 1] = self._abnormal[idx] + (0 if is_finite else 1)
+        if is_finite:
+            self._max = builtins.max(self._max, value)
+            self._min = builtins.min(self._min, value)
+        self._size += 1
+
+    @property
+    def steps(self):
+        return self._steps[:self._size]
+
+    @property
+    def values(self):
+        return self._values[:self._size]
+
+    def mean(self, start=0, end=None):
+        """The mean of values[start:end] in O(1)."""
+        start, end, _ = slice(start, end).indices(self._size)
+        if end <= start:
+            return np.nan
+        if self._abnormal[end] - self._abnormal[start] > 0:
+            return float(self._values[start:end].mean())
+        return float((self._cumsum[end] - self._cumsum[start]) / (end - start))
+
+    def best(self, is_larger_better=True):
+        if self._size == 0:
+            raise ValueError('The series is empty.')
+        best = self._max if is_larger_better else self._min
+        return float(best) if np.isfinite(best) else float(self._values[self._size - 1])
+
+    def copy(self):
+        return list(iter(self))
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [(int(self._steps[i]), float(self._values[i])) for i in range(*idx.indices(self._size))]
+        if idx < 0:
+            idx += self._size
+        if idx < 0 or idx >= self._size:
+            raise IndexError('series index out of range')
+        return int(self._steps[idx]), float(self._values[idx])
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield int(self._steps[i]), float(self._values[i])
+
+    def __getstate__(self):
+        return {'steps': np.array(self.steps), 'values': np.array(self.values)}
+
+    def __setstate__(self, state):
+        self.__init__(capacity=builtins.max(len(state['steps']) + 1, 64))
+        for step, value in zip(state['steps'], state['values']):
+            self.append((step, value))
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __del__(self):
+        try:
+            self._remove_files(self._files)
+        except Exception:
+            pass
+
+
 class HistoryBase(OrderedDict):
+    """Series of (step, value) pairs keyed by name, every series is a columnar `HistorySeries`.
+
+    Tensor values are kept on device (detached, reduced to a scalar) when collected, and are only
+    materialized to python numbers, all series at once with a single host transfer, when the history
+    is read (`get_series`, `get_last`, `get_best`, item access...). So collecting losses and metrics
+    every step does not force a device synchronization. `accumulate` / `pop_mean` keep running sums and
+    counts instead of series, for the values only read as a mean at the collect boundary.
+
+    """
     def __init__(self, name='', *args, **kwargs):
+        self._pending = OrderedDict()
+        self._running = OrderedDict()
         super().__init__(*args, **kwargs)
         self.name=name
 
     def regist(self,data_name:str):
         if data_name not in self:
-            self[data_name]=[]
+            super().__setitem__(data_name, HistorySeries())
 
     def collect(self,data_name:str,step:int,value:(float,Tensor)):
         if data_name not in self:
             self.regist(data_name)
         if is_tensor(value):
-            value=value.clone().cpu().detach()
-            if ndim(value)==0:
-                value=value.item()
-            elif ndim(value)==1 and len(value)==1:
-                value = value[0].item()
-            else:
-                value=value.mean().item()
-            self[data_name].append((step, value))
+            value = value.detach()
+            if ndim(value) == 1 and len(value) == 1:
+                value = value[0]
+            elif ndim(value) > 0:
+                value = value.mean()
+        if is_tensor(value) or data_name in self._pending:
+            # keep the order with values waiting to be materialized
+            if data_name not in self._pending:
+                self._pending[data_name] = []
+            self._pending[data_name].append((step, value))
         else:
-            self[data_name].append((step, value))
+            super().__getitem__(data_name).append((step, value))
 
+    def accumulate(self,data_name:str,value:(float,Tensor)):
+        """Add value to the running sum and count of data_name, kept on device for tensors (no host sync)."""
+        if data_name not in self:
+            self.regist(data_name)
+        if is_tensor(value):
+            value = cast(value.detach(), 'float32')
+            if ndim(value) > 0:
+                value = value.mean()
+        total, count = self._running.get(data_name, (0.0, 0))
+        self._running[data_name] = (total + value, count + 1)
+
+    @property
+    def running_keys(self):
+        """The names having an accumulated running sum."""
+        return list(self._running.keys())
+
+    def pop_mean(self,data_name:str):
+        """The mean of the values accumulated since the last call (a device tensor for tensor values), or None."""
+        if data_name not in self._running:
+            return None
+        total, count = self._running.pop(data_name)
+        return total / count
+
+    def flush(self):
+        """Materialize all the pending device values with a single host transfer."""
+        if len(self._pending) == 0:
+            return
+        pending = self._pending
+        self._pending = OrderedDict()
+        tensors = [v for items in pending.values() for _, v in items if is_tensor(v)]
+        values = []
+        if len(tensors) > 0:
+            try:
+                values = to_numpy(stack([cast(t, 'float32') for t in tensors], axis=0)).tolist()
+            except Exception:
+                values = [to_numpy(t).tolist() for t in tensors]
+        idx = 0
+        for data_name, items in pending.items():
+            series = super().__getitem__(data_name)
+            for step, v in items:
+                if is_tensor(v):
+                    v = values[idx]
+                    idx += 1
+                series.append((step, v))
+
+    def __getitem__(self, key):
+        if len(self._pending) > 0:
+            self.flush()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if len(self._pending) > 0:
+            self.flush()
+        if isinstance(value, (list, tuple)):
+            value = HistorySeries(value)
+        super().__setitem__(key, value)
+
+    def items(self):
+        self.flush()
+        return super().items()
+
+    def values(self):
+        self.flush()
+        return super().values()
+
+    @property
+    def value_list(self):
+        self.flush()
+        return list(super().values())
+
+    @property
+    def item_list(self):
+        self.flush()
+        return list(super().items())
+
+    def __reduce__(self):
+        self.flush()
+        return super().__reduce__()
 
     def reset(self):
-        for i in range(len(self)):
-            self.value_list[i]=[]
+        self._pending = OrderedDict()
+        self._running = OrderedDict()
+        for k in self.key_list:
+            super().__setitem__(k, HistorySeries())
+
     def get_keys(self):
         return self.key_list
 
+    def to_dict(self):
+        """A json serializable copy, every series as a list of [step, value]."""
+        return OrderedDict([(k, v.copy()) for k, v in self.items()])
+
     def get_series(self,data_name):
+        """Steps and values of a series as zero-copy numpy views."""
         if data_name in self:
-            steps,values=zip(*self[data_name].copy())
-            return list(steps),list(values)
+            series=self[data_name]
+            return series.steps,series.values
         else:
             raise ValueError('{0} is not in this History.'.format(data_name))
 
@@ -1112,10 +1461,6 @@ class HistoryBase(OrderedDict):
 
     def get_best(self,data_name,is_larger_better=True):
             if data_name in self:
-                steps,values=zip(*self[data_name].copy())
-                if is_larger_better:
-                    return builtins.max(values)
-                else:
-                    return builtins.min(values)
+                return self[data_name].best(is_larger_better)
             else:
-                raise ValueError('{0} is not in this History.'.format(data_name))
\ No newline at end of file
+                raise ValueError('{0} is not in this History.'.format(data_name))
@@ -33,8 +33,8 @@ from trident.backend.tensorspec import *
 from trident.backend import iteration_tools
 from trident.backend.pytorch_ops import *
 from trident.backend import pytorch_ops as tops
-__all__ = ['get_device', 'set_device', 'Layer', 'Sequential', 'ModuleList', 'ModuleDict', 'print_network', 'summary', 'load', 'save', 'Combine', 'try_map_args_and_call',
-           'print_mem_stack',
+__all__ = ['get_device', 'set_device', 'set_fast_dispatch', 'Layer', 'Sequential', 'ModuleList', 'ModuleDict', 'print_network', 'summary', 'symbolic_build', 'load', 'save', 'Combine', 'try_map_args_and_call',
+           'CallPlan', 'print_mem_stack',
            'normalize_padding', 'fix_layer']
 
 _FUN_NAMES = [
@@ -172,6 +172,23 @@ _global_backward_hooks = OrderedDict()
 _global_forward_pre_hooks = OrderedDict()
 _global_forward_hooks = OrderedDict()
 
+_fast_dispatch = False
+
+
+def set_fast_dispatch(enabled=True):
+    """Globally enable the fast dispatch of the layer calls.
+
+    With fast dispatch, calling a built, non-root layer without hooks and without keep_output goes straight to its
+    forward: no numpy conversion, no hook iteration and no output shape bookkeeping (done on the calls before its
+    output shape is known). A model can override it with `Layer.enable_fast_dispatch`.
+
+    Args:
+        enabled (bool): enable or disable the fast dispatch.
+
+    """
+    global _fast_dispatch
+    _fast_dispatch = bool(enabled)
+
 
 
 def register_module_forward_pre_hook(hook: Callable[..., None]) -> RemovableHandle:
@@ -382,6 +399,39 @@ class Layer(nn.Module):
     """
     forward: Callable[..., Any] = _forward_unimplemented
 
+    # None follows the global setting of set_fast_dispatch
+    fast_dispatch = None
+
+    def compute_output_shape(self, input_shape):
+        """The output shape of the layer for an input shape, without running the layer.
+
+        The layers declare their static shape rule by overriding it, the default None means the layer has no rule
+        and `symbolic_build` falls back to a forward of this layer alone.
+
+        Args:
+            input_shape (tuple of int): the input shape, not including the batch axis.
+
+        Returns:
+            the output shape (tuple of int, not including the batch axis), or None
+
+        """
+        return None
+
+    def enable_fast_dispatch(self, enabled=True):
+        """Enable (or disable) the fast dispatch for this layer and all its sublayers, whatever the global setting.
+
+        Args:
+            enabled (bool, None): True or False, None to follow the global setting again.
+
+        Returns:
+            the layer itself
+
+        """
+        for module in self.modules():
+            if isinstance(module, Layer):
+                module.fast_dispatch = enabled
+        return self
+
     def get_root(self):
         if not hasattr(self, '_nodes') or self._nodes is None or len(self._nodes) < 2:
             self.is_root = True
@@ -768,6 +818,13 @@ class Layer(nn.Module):
                                         'output': {0: 'batch_size'}})
 
     def _call_impl(self, *input, **kwargs):
+        # fast dispatch: the built sublayers without hooks go straight to forward once their output shape is known
+        if (_fast_dispatch if self.fast_dispatch is None else self.fast_dispatch) and self._built and not self.is_root \
+                and not self.keep_output and self._output_shape is not None \
+                and not self._forward_pre_hooks and not self._forward_hooks and not self._backward_hooks \
+                and not _global_forward_pre_hooks and not _global_forward_hooks and not _global_backward_hooks \
+                and not torch._C._get_tracing_state():
+            return self.forward(*input)
         is_all_numpy = True
         is_built=self._built
         input = list(input)
@@ -1079,6 +1136,11 @@ class Sequential(Layer):
             x = module(x)
         return x
 
+    def compute_output_shape(self, input_shape):
+        for module in self._modules.values():
+            input_shape = symbolic_build(module, input_shape)
+        return input_shape
+
 
 class ModuleList(Layer):
     r"""Holds submodules in a list.
@@ -1455,51 +1517,133 @@ def print_network(net, verbose=False):
     logging.info('Total number of parameters: %d\n' % num_params)
 
 
-def summary(model, input_size, batch_size=-1, device="cuda"):
+def _to_shape(shape):
+    """A shape as a tuple of int, a tuple of such tuples for multiple tensors."""
+    if isinstance(shape, TensorSpec):
+        shape = shape.shape
+    if is_tensor(shape) or isinstance(shape, np.ndarray):
+        return tuple([int(d) for d in to_list(shape)])
+    if isinstance(shape, (list, tuple)) and len(shape) > 0 and not isinstance(shape[0], numbers.Integral):
+        return tuple([_to_shape(s) for s in shape])
+    return tuple([int(d) for d in shape])
+
+
+def _is_single_shape(shape):
+    return all([isinstance(d, numbers.Integral) for d in shape])
+
+
+def _dry_run_shape(layer, input_shape):
+    """The output shape of a layer without shape rule, by a forward of this layer alone on zeros."""
+    if _is_single_shape(input_shape):
+        x = torch.zeros((1,) + input_shape, dtype=torch.float32, device=get_device())
+    else:
+        x = tuple([torch.zeros((1,) + s, dtype=torch.float32, device=get_device()) for s in input_shape])
+    was_training = layer.training
+    layer.eval()
+    with torch.no_grad():
+        out = layer(x)
+    layer.train(was_training)
+
+    def output_shape(t):
+        if is_tensor(t):
+            return tuple([int(d) for d in t.shape[1:]])
+        elif isinstance(t, dict):
+            return tuple([output_shape(v) for v in t.values()])
+        return tuple([output_shape(v) for v in t])
+
+    return output_shape(out)
+
+
+def symbolic_build(layer, input_shape):
+    """Build a layer (and its sublayers) for an input shape and return its output shape without a forward pass.
+
+    The shape flows through the shape rule (`Layer.compute_output_shape`) of every layer, each layer is built from
+    its input shape (so the parameters have their final shape) and gets its input and output shapes, no activation
+    is allocated. A layer without rule is run alone on zeros of its input shape, the activations of that layer only.
+
+    Args:
+        layer (Layer): the layer or the model.
+        input_shape (tuple, Tensor or TensorSpec): the input shape, not including the batch axis.
+
+    Returns:
+        the output shape (tuple of int, not including the batch axis), a tuple of shapes for multiple outputs
+
+    Examples:
+        >>> net = Sequential(Conv2d((3, 3), 16, strides=2), Flatten(), Dense(10))  # doctest: +SKIP
+        >>> symbolic_build(net, (3, 32, 32))  # doctest: +SKIP
+        (10,)
+
+    """
+    input_shape = _to_shape(input_shape)
+    output_shape = None
+    if isinstance(layer, Layer):
+        if (not layer._built or layer._input_shape is None) and _is_single_shape(input_shape):
+            layer.input_shape = input_shape
+        if _is_single_shape(input_shape):
+            output_shape = layer.compute_output_shape(input_shape)
+        if output_shape is None:
+            output_shape = _dry_run_shape(layer, input_shape)
+        output_shape = _to_shape(output_shape)
+        if _is_single_shape(output_shape):
+            layer.output_shape = list(output_shape)
+        else:
+            layer.output_shape = tuple([to_tensor(list(s)).int() for s in output_shape])
+    else:
+        output_shape = _to_shape(_dry_run_shape(layer, input_shape))
+    return output_shape
+
+
+def summary(model, input_size, batch_size=-1, device="cuda", symbolic=False):
+    """Print the layers of a model with their output shape, parameters and FLOPs.
+
+    Args:
+        model (Layer): the model.
+        input_size (tuple): the input shape, not including the batch axis.
+        batch_size (int): the batch size shown in the shapes.
+        device (str): 'cuda' or 'cpu'.
+        symbolic (bool): infer the shapes with `symbolic_build` instead of a forward pass.
+
+    """
+    def record(module, input_shape, output_shape):
+        m_key = module.relative_name if hasattr(module, 'relative_name') else module.name
+        summary[m_key] = OrderedDict()
+        summary[m_key]["class_name"] = module.__class__.__name__
+        if hasattr(module, 'keep_output'):
+            summary[m_key]["keep_output"] = module.keep_output
+        else:
+            summary[m_key]["keep_output"] = False
+        summary[m_key]["input_shape"] = list(input_shape)
+        summary[m_key]["input_shape"][0] = batch_size
+        summary[m_key]["output_shape"] = list(output_shape)
+        summary[m_key]["output_shape"][0] = batch_size
+
+        params = 0
+        summary[m_key]["flops"] = np.array([0], dtype=np.float64)
+        summary[m_key]["macc"] = np.array([0], dtype=np.float64)
+        if hasattr(module, "weight") and hasattr(module.weight, "size"):
+            params += torch.prod(torch.LongTensor(list(module.weight.shape)))
+            summary[m_key]["weight"] = list(module.weight.shape)
+            summary[m_key]["trainable"] = module.weight.requires_grad
+            summary[m_key]["flops"] += (2 * np.prod(np.array(summary[m_key]["weight"]).astype(np.float64)) - 1) * np.prod(
+                np.array(summary[m_key]["output_shape"][2:]).astype(np.float64))
+            summary[m_key]["macc"] += np.prod(np.array(summary[m_key]["weight"]).astype(np.float64)) * np.prod(np.array(summary[m_key]["output_shape"][2:]).astype(np.float64))
+
+        if hasattr(module, "bias") and module.bias is not None and hasattr(module.bias, "size"):
+            params += torch.prod(torch.LongTensor(list(module.bias.shape)))
+            summary[m_key]["bias"] = list(module.bias.shape)
+            summary[m_key]["flops"] += np.prod(np.array(summary[m_key]["bias"]).astype(np.float64)) * np.prod(np.array(summary[m_key]["output_shape"][2:]).astype(np.float64))
+        summary[m_key]["nb_params"] = params
+
     def register_hook(module):
         def hook(module, input, output):
-            # class_name =module.re    module.name   # str(module.__class__).split(".")[-1].split("'")[0]
-            module_idx = len(summary)
-
-            m_key = module.relative_name if hasattr(module, 'relative_name') else module.name
-            summary[m_key] = OrderedDict()
-            summary[m_key]["class_name"] = module.__class__.__name__
-            if hasattr(module, 'keep_output'):
-                summary[m_key]["keep_output"] = module.keep_output
-            else:
-                summary[m_key]["keep_output"] = False
             input = iteration_tools.flatten([input], iterable_types=(list, tuple))
             input = unpack_singleton([item for item in input if item is not None])
-            if isinstance(input, (list, tuple)):
-                summary[m_key]["input_shape"] = list(int_shape(input[0]))
-            elif is_tensor(input):
-                summary[m_key]["input_shape"] = list(int_shape(input))
-            summary[m_key]["input_shape"][0] = batch_size
+            input_shape = list(int_shape(input[0])) if isinstance(input, (list, tuple)) else list(int_shape(input))
 
             output = iteration_tools.flatten([output], iterable_types=(list, tuple))
             output = unpack_singleton([item for item in output if item is not None])
-            if isinstance(output, (list, tuple)):
-                summary[m_key]["output_shape"] = list(int_shape(output[0]))
-            elif is_tensor(output):
-                summary[m_key]["output_shape"] = list(int_shape(output))
-            summary[m_key]["output_shape"][0] = batch_size
-
-            params = 0
-            summary[m_key]["flops"] = np.array([0], dtype=np.float64)
-            summary[m_key]["macc"] = np.array([0], dtype=np.float64)
-            if hasattr(module, "weight") and hasattr(module.weight, "size"):
-                params += torch.prod(torch.LongTensor(list(module.weight.shape)))
-                summary[m_key]["weight"] = list(module.weight.shape)
-                summary[m_key]["trainable"] = module.weight.requires_grad
-                summary[m_key]["flops"] += (2 * np.prod(np.array(summary[m_key]["weight"]).astype(np.float64)) - 1) * np.prod(
-                    np.array(summary[m_key]["output_shape"][2:]).astype(np.float64))
-                summary[m_key]["macc"] += np.prod(np.array(summary[m_key]["weight"]).astype(np.float64)) * np.prod(np.array(summary[m_key]["output_shape"][2:]).astype(np.float64))
-
-            if hasattr(module, "bias") and module.bias is not None and hasattr(module.bias, "size"):
-                params += torch.prod(torch.LongTensor(list(module.bias.shape)))
-                summary[m_key]["bias"] = list(module.bias.shape)
-                summary[m_key]["flops"] += np.prod(np.array(summary[m_key]["bias"]).astype(np.float64)) * np.prod(np.array(summary[m_key]["output_shape"][2:]).astype(np.float64))
-            summary[m_key]["nb_params"] = params
+            output_shape = list(int_shape(output[0])) if isinstance(output, (list, tuple)) else list(int_shape(output))
+            record(module, input_shape, output_shape)
 
         if (
                 not isinstance(module, (nn.Sequential, Sequential, nn.ModuleList, ModuleList, nn.ModuleDict, ModuleDict))
@@ -1527,27 +1671,37 @@ def summary(model, input_size, batch_size=-1, device="cuda"):
     # prevent pytorch 'ValueError: Expected more than 1 value per channel when training, got input size ....
     model.to(get_device())
     model.eval()
-    if isinstance(input_size, int):
-        x = [torch.rand(1, input_size).type(dtype).to("cuda" if model.weights[0].data.is_cuda else "cpu")]
-    else:
-        # batch_size of 2 for batchnorm
-        x = [torch.rand(1, *in_size).type(dtype).to("cuda" if model.weights[0].data.is_cuda else "cpu") for in_size in input_size]
-    # p    rint(type(x[0]))
 
     # create properties
     summary = OrderedDict()
     hooks = []
 
-    # register hook
-    model.apply(register_hook)
+    if symbolic:
+        # the shapes recorded by symbolic_build on every layer, no forward pass
+        symbolic_build(model, (input_size,) if isinstance(input_size, int) else input_size[0] if len(input_size) == 1 else input_size)
+        for name, module in model.named_modules():
+            if isinstance(module, (nn.Sequential, Sequential, nn.ModuleList, ModuleList, nn.ModuleDict, ModuleDict)) or module is model:
+                continue
+            if isinstance(module, Layer) and module.input_shape is not None and module.output_shape is not None:
+                input_shape = module.input_shape if is_tensor(module.input_shape) else module.input_shape[0]
+                output_shape = module.output_shape if is_tensor(module.output_shape) else module.output_shape[0]
+                record(module, [1] + list(_to_shape(input_shape)), [1] + list(_to_shape(output_shape)))
+    else:
+        if isinstance(input_size, int):
+            x = [torch.rand(1, input_size).type(dtype).to("cuda" if model.weights[0].data.is_cuda else "cpu")]
+        else:
+            # batch_size of 2 for batchnorm
+            x = [torch.rand(1, *in_size).type(dtype).to("cuda" if model.weights[0].data.is_cuda else "cpu") for in_size in input_size]
+
+        # register hook
+        model.apply(register_hook)
 
-    # make a forward pass
-    # print(x.shape)
-    model(*x)
+        # make a forward pass
+        model(*x)
 
-    # remove these hooks
-    for h in hooks:
-        h.remove()
+        # remove these hooks
+        for h in hooks:
+            h.remove()
 
     print("--------------------------------------------------------------------------------------------------------------------------------")
     line_new = "{0:^50s} {1:^25s}  {2:^20s} {3:^8s}  {4:^8s}  {5:^25s}".format("Layer (type)", "Output Shape", "Weight ", "Bias", "Param #", "FLOPS #")
@@ -1579,7 +1733,7 @@ def summary(model, input_size, batch_size=-1, device="cuda"):
                    + '{:,}'.format(summary[layer]["flops"].sum()).ljust(25, ' ')
 
         total_params += summary[layer]["nb_params"]
-        flops += float(summary[layer]["flops"])
+        flops += float(summary[layer]["flops"].sum())
         macc += float(summary[layer]["macc"].sum())
         total_output += np.prod(summary[layer]["output_shape"])
         if "trainable" in summary[layer]:
@@ -1915,6 +2069,84 @@ def get_human_readable_count(number):
     return '{int(number):,d} {labels[index]}'
 
 
+_MISSING = object()
+
+
+class CallPlan(object):
+    """A compiled argument plan of one callable (model, loss, regularizer or metric) for a data_feed.
+
+    The inputs of the callable are resolved to data keys only once, every call then gathers the arguments
+    from a flat key list, no signature walking, no `get_signature` inspection and no intermediate OrderedDict.
+    The behavior is the same as `try_map_args_and_call`.
+
+    Args:
+        fn (callable): the callable, maybe functions or layers
+        data_feed (OrderedDict): The relation between callable argments (key) and data (value)
+
+    Examples:
+        >>> plan = CallPlan(lambda output, target: output - target, OrderedDict([('output', 'output'), ('target', 'label')]))
+        >>> plan.keys
+        ['output', 'label']
+
+    """
+
+    def __init__(self, fn, data_feed=None):
+        data_feed = data_feed if data_feed is not None else OrderedDict()
+        self.fn = fn
+        self.signature = None
+        if isinstance(fn, Layer):
+            self.mode = 'layer'
+            self.signature = fn.signature
+            self.args = fn.signature.inputs.key_list
+        elif hasattr(fn, 'signature') and callable(fn):
+            self.mode = 'signature'
+            self.signature = fn.signature
+            self.args = fn.signature.inputs.key_list
+        elif callable(fn):
+            self.mode = 'callable'
+            self.args = get_signature(fn).inputs.key_list
+        else:
+            raise ValueError('{0} is not callable.'.format(fn))
+        self.feed = tuple([data_feed[arg] if arg in data_feed else _MISSING for arg in self.args])
+        self.keys = [arg if feed is _MISSING else feed for arg, feed in zip(self.args, self.feed)]
+        # plain callables get '' for arguments neither in data_feed nor in data
+        self.optional = [self.mode == 'callable' and feed is _MISSING for feed in self.feed]
+
+    def is_valid(self, fn, data_feed=None):
+        """Whether the plan still matches the callable, its signature and the data_feed."""
+        if fn is not self.fn:
+            return False
+        if self.signature is not None and (fn.signature is not self.signature or len(self.signature.inputs) != len(self.args)):
+            return False
+        data_feed = data_feed if data_feed is not None else OrderedDict()
+        for arg, feed in zip(self.args, self.feed):
+            if data_feed.get(arg, _MISSING) != feed:
+                return False
+        return True
+
+    def __call__(self, data):
+        device = get_device()
+        args = []
+        for key, optional in zip(self.keys, self.optional):
+            if key in data:
+                value = data[key]
+                if self.mode == 'layer':
+                    # resident tensors are passed as they are
+                    if not (is_tensor(value) and value.device.type == device):
+                        value = to_tensor(value).to(device)
+                else:
+                    value = value.to(device)
+                args.append(value)
+            elif optional:
+                args.append('')
+            else:
+                raise ValueError('arg :{0} cannot mapping correctly!'.format(key))
+        if get_session_value('amp_available') == True and get_session_value('is_amp_enable') == True and device == 'cuda':
+            with torch.cuda.amp.autocast():
+                return self.fn(*args)
+        return self.fn(*args)
+
+
 def try_map_args_and_call(fn, data: OrderedDict, data_feed=None):
     """This function is the core function for mapping callable and argments
 
@@ -1926,6 +2158,9 @@ def try_map_args_and_call(fn, data: OrderedDict, data_feed=None):
     Returns:
         The result of the callable base on data_feed
 
+    Tensors already resident on the device are passed as they are and never copied back to cpu,
+    so the model, losses and metrics of one step share the same device copy of the minibatch.
+
     """
     if isinstance(fn, torch.Tensor):
         return fn
@@ -1946,9 +2181,6 @@ def try_map_args_and_call(fn, data: OrderedDict, data_feed=None):
                         out = fn(*arg_map.value_list)
                 else:
                     out = fn(*arg_map.value_list)
-                    for item in data.value_list:
-                        if hasattr(item, 'cpu'):
-                            item.cpu()
                 return out
             elif hasattr(fn, 'signature') and callable(fn):
                 for arg in fn.signature.inputs.key_list:
@@ -1966,9 +2198,6 @@ def try_map_args_and_call(fn, data: OrderedDict, data_feed=None):
                         out = fn(*arg_map.value_list)
                 else:
                     out = fn(*arg_map.value_list)
-                    for item in data.value_list:
-                        if hasattr(item, 'cpu'):
-                            item.cpu()
 
                 return out
             elif callable(fn):
@@ -1986,9 +2215,6 @@ def try_map_args_and_call(fn, data: OrderedDict, data_feed=None):
                         out = fn(*arg_map.value_list)
                 else:
                     out = fn(*arg_map.value_list)
-                    for item in data.value_list:
-                        if is_tensor(item):
-                            item.cpu()
                 return out
             else:
                 print('uncomplete arg_map', arg_map.key_list)
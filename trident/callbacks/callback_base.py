@@ -1,3 +1,4 @@
+import time
 import uuid
 import warnings
 from abc import ABC
@@ -6,7 +7,7 @@ from types import MethodType
 import numpy as np
 from tqdm.auto import tqdm
 
-__all__ = ['CallbackBase','StoppingCriterionCallback','EarlyStoppingCriterionCallback','LambdaCallback','UnfreezeModelCallback']
+__all__ = ['CallbackBase','CallbackDispatcher','StoppingCriterionCallback','EarlyStoppingCriterionCallback','LambdaCallback','UnfreezeModelCallback']
 
 
 _valid_when=["on_training_start"
@@ -287,6 +288,96 @@ class CallbackBase(ABC):
 
 
 
+def overridden_hooks(callback):
+    """The events whose hook the callback overrides, the hooks of CallbackBase do nothing."""
+    hooks = []
+    for when in _valid_when + ['on_training_terminated']:
+        if when in callback.__dict__:
+            # bound on the instance (LambdaCallback)
+            hooks.append(when)
+        elif not isinstance(callback, CallbackBase):
+            if callable(getattr(callback, when, None)):
+                hooks.append(when)
+        elif getattr(type(callback), when, None) is not getattr(CallbackBase, when):
+            hooks.append(when)
+    return hooks
+
+
+class CallbackDispatcher(object):
+    """
+    Dispatch the training events to the callbacks overriding their hook.
+
+    The table of the hooks is built when the callbacks are registered (and rebuilt when the list of callbacks
+    changes), so an event only calls the few callbacks implementing it instead of every callback. The time spent
+    in every callback is accumulated, `summary` reports the slowest ones.
+
+    Args:
+        callbacks (list): the callbacks, the list is kept by reference.
+
+    """
+
+    def __init__(self, callbacks=None):
+        self.callbacks = callbacks if callbacks is not None else []
+        self._key = None
+        self._table = {}
+        self.timing = {}
+
+    def bind(self, callbacks):
+        """Dispatch to another list of callbacks."""
+        self.callbacks = callbacks
+        self._key = None
+
+    def _refresh(self):
+        key = tuple([id(callback) for callback in self.callbacks])
+        if key != self._key:
+            self._table = {}
+            for callback in self.callbacks:
+                for when in overridden_hooks(callback):
+                    self._table.setdefault(when, []).append(callback)
+            self._key = key
+
+    def hooked(self, when):
+        """The callbacks overriding the hook of an event."""
+        self._refresh()
+        return self._table.get(when, [])
+
+    def dispatch(self, when, training_context, shared=None):
+        """
+        Call the hook of an event on the callbacks overriding it.
+
+        Args:
+            when (str): the event, ex. 'on_batch_end'.
+            training_context (dict): the argument of the hook.
+            shared (None or bool): only the shared (True) or the private (False) callbacks, all of them if None.
+
+        """
+        for callback in self.hooked(when):
+            if shared is not None and getattr(callback, 'is_shared', False) != shared:
+                continue
+            start = time.perf_counter()
+            getattr(callback, when)(training_context)
+            elapsed = time.perf_counter() - start
+            record = self.timing.get(id(callback))
+            if record is None:
+                record = self.timing[id(callback)] = [callback.__class__.__name__, 0, 0.0]
+            record[1] += 1
+            record[2] += elapsed
+
+    def reset_timing(self):
+        self.timing = {}
+
+    def summary(self, top=10):
+        """The cumulative time of the slowest callbacks, one line per callback."""
+        records = sorted(self.timing.values(), key=lambda record: record[2], reverse=True)[:top]
+        if len(records) == 0:
+            return ''
+        total = sum([record[2] for record in self.timing.values()])
+        lines = ['{0:<40s}{1:>10s}{2:>14s}{3:>10s}'.format('Callback', 'Calls', 'Time (s)', '%')]
+        for name, calls, seconds in records:
+            lines.append('{0:<40s}{1:>10d}{2:>14.3f}{3:>10.1f}'.format(name, calls, seconds, 100.0 * seconds / total if total > 0 else 0.0))
+        return '\n'.join(lines)
+
+
 class LambdaCallback(CallbackBase):
     """
     Objects of derived classes inject functionality in several points of the training process.
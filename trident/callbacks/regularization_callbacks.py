@@ -15,15 +15,13 @@ from trident.data.image_common import *
 from trident.misc.ipython_utils import is_in_colab
 if get_backend()=='pytorch':
     import torch.nn as nn
-    from trident.backend.pytorch_ops import to_numpy,to_tensor,arange,shuffle,cast,clip,sqrt,int_shape
-    from trident.optims.pytorch_losses import CrossEntropyLoss
+    from trident.backend.pytorch_ops import to_numpy,to_tensor,cast,clip,sqrt,int_shape,ndim,make_onehot
 elif get_backend()=='tensorflow':
     import tensorflow as tf
-    from trident.backend.tensorflow_ops import  to_numpy,to_tensor,arange,shuffle,cast,clip,sqrt,int_shape,concate,zeros_like,ones_like
-    from trident.optims.tensorflow_losses import CrossEntropyLoss
+    from trident.backend.tensorflow_ops import  to_numpy,to_tensor,cast,clip,sqrt,int_shape,concate,zeros_like,ones_like,ndim,make_onehot
 
 
-__all__ = ['RegularizationCallbacksBase', 'MixupCallback', 'CutMixCallback']
+__all__ = ['RegularizationCallbacksBase', 'MixupCallback', 'CutMixCallback', 'mixup_batch', 'cutmix_batch']
 
 class RegularizationCallbacksBase(CallbackBase):
     """ The base callback class for regularization  """
@@ -34,183 +32,216 @@ class RegularizationCallbacksBase(CallbackBase):
 
 
 
-class MixupCallback(RegularizationCallbacksBase):
-    """ Implementation. of the mixup regularization
-     Mixup - a neural network regularization technique based on linear interpolation
-     of labeled sample pairs - has stood out by its capacity to improve model's robustness
-     and generalizability through a surprisingly simple formalism.
+def _is_numpy(x):
+    return isinstance(x, np.ndarray)
 
-    References:
-        mixup: BEYOND EMPIRICAL RISK MINIMIZATION
-        https://arxiv.org/pdf/1710.09412.pdf
+
+def _gather(x, index):
+    """The samples of x in the order of index (axis 0)."""
+    if get_backend() == 'tensorflow' and not _is_numpy(x):
+        return tf.gather(x, index, axis=0)
+    return x[index]
+
+
+def _soft_target(y, num_classes):
+    """The class distribution of a target, the class indexes are turned into one-hot vectors."""
+    if _is_numpy(y):
+        if y.dtype.kind in 'iu':
+            return np.eye(num_classes, dtype=np.float32)[y]
+        return y.astype(np.float32)
+    if 'int' in str(y.dtype):
+        return make_onehot(cast(y, 'int64'), num_classes, axis=-1)
+    return cast(y, 'float32')
+
+
+def _permutation(batch_size, x):
+    index = np.random.permutation(batch_size)
+    if not _is_numpy(x) and get_backend() == 'pytorch':
+        return to_tensor(index).long().to(x.device)
+    return index
+
+
+def _cutmix_mask(shape, lam):
+    """The mask of a random box of area (1 - lam), in the data format of the backend (NCHW for pytorch, NHWC for tensorflow)."""
+    height, width = (shape[2], shape[3]) if get_backend() == 'pytorch' else (shape[1], shape[2])
+    cut_ratio = math.sqrt(1. - lam)
+    cut_h, cut_w = int(height * cut_ratio), int(width * cut_ratio)
+    cy, cx = np.random.randint(height), np.random.randint(width)
+    y1, y2 = np.clip(cy - cut_h // 2, 0, height), np.clip(cy + cut_h // 2, 0, height)
+    x1, x2 = np.clip(cx - cut_w // 2, 0, width), np.clip(cx + cut_w // 2, 0, width)
+    mask = np.zeros((height, width), dtype=np.float32)
+    mask[y1:y2, x1:x2] = 1
+    return mask[None, None, :, :] if get_backend() == 'pytorch' else mask[None, :, :, None], 1 - float(mask.mean())
+
+
+def mixup_batch(x, y, num_classes, alpha=1, lam=None):
+    """Mix a minibatch with a shuffled copy of itself (mixup).
+
+    The inputs are interpolated and the targets become the same interpolation of the class distributions, so the mixed
+    batch is trained with a single forward and any loss accepting soft targets (CrossEntropyLoss). It works on tensors
+    and on the numpy arrays of a collated minibatch.
+
+    Args:
+        x (Tensor or ndarray): the inputs.
+        y (Tensor or ndarray): the targets, class indexes or class distributions.
+        num_classes (int): the number of classes.
+        alpha (float): the parameter of the beta distribution of the mixing ratio.
+        lam (float): the mixing ratio, sampled if None.
+
+    Returns:
+        the mixed inputs, the soft targets and the mixing ratio
+
+    Examples:
+        >>> x, y = np.ones((4, 3, 8, 8), dtype=np.float32), np.array([0, 1, 2, 1])
+        >>> mixed_x, soft_y, lam = mixup_batch(x, y, 3, lam=0.6)
+        >>> soft_y.shape, float(soft_y.sum(-1).mean())
+        ((4, 3), 1.0)
+
+    """
+    if lam is None:
+        lam = builtins.min(builtins.max(np.random.beta(alpha, alpha), 0.3), 0.7)
+    index = _permutation(int_shape(x)[0], x)
+    y = _soft_target(y, num_classes)
+    mixed_x = lam * x + (1 - lam) * _gather(x, index)
+    mixed_y = lam * y + (1 - lam) * _gather(y, index)
+    return mixed_x, mixed_y, lam
+
+
+def cutmix_batch(x, y, num_classes, alpha=1, lam=None):
+    """Paste a random box of a shuffled copy of the minibatch into every image (cutmix).
+
+    The targets become the mixture of the class distributions weighted by the pasted area, so the mixed batch is
+    trained with a single forward and any loss accepting soft targets (CrossEntropyLoss). It works on tensors and on
+    the numpy arrays of a collated minibatch.
+
+    Args:
+        x (Tensor or ndarray): the images.
+        y (Tensor or ndarray): the targets, class indexes or class distributions.
+        num_classes (int): the number of classes.
+        alpha (float): the parameter of the beta distribution of the kept area.
+        lam (float): the kept area, sampled if None.
+
+    Returns:
+        the mixed images, the soft targets and the actual kept area
 
     """
-    def __init__(self, alpha=1,loss_criterion=CrossEntropyLoss,loss_weight=1,save_path=None,  **kwargs):
-        super(MixupCallback, self).__init__()
-        self.alpha=alpha
-        self.loss_criterion=loss_criterion()
-        self.loss_weight=loss_weight
-        self.save_path=save_path
+    if lam is None:
+        lam = builtins.min(builtins.max(np.random.beta(alpha, alpha), 0.1), 0.4)
+    index = _permutation(int_shape(x)[0], x)
+    mask, lam = _cutmix_mask(int_shape(x), lam)
+    if not _is_numpy(x):
+        mask = cast(to_tensor(mask), x.dtype)
+        if get_backend() == 'pytorch':
+            mask = mask.to(x.device)
+    y = _soft_target(y, num_classes)
+    mixed_x = x * (1 - mask) + _gather(x, index) * mask
+    mixed_y = lam * y + (1 - lam) * _gather(y, index)
+    return mixed_x, mixed_y, lam
+
+
+class _BatchMixingCallback(RegularizationCallbacksBase):
+    """Rewrite the minibatch (inputs and soft targets) when it is received, before the forward of the model."""
+    mixing_name = None
+
+    def __init__(self, alpha=1, num_classes=None, save_path=None, **kwargs):
+        super(_BatchMixingCallback, self).__init__()
+        self.alpha = alpha
+        self.num_classes = num_classes
+        self.save_path = save_path
         if save_path is not None:
             make_dir_if_need(save_path)
-    def on_loss_calculation_end(self, training_context):
-        """Returns mixed inputs, pairs of targets, and lambda"""
+
+    def mix(self, x, y, num_classes):
+        raise NotImplementedError
+
+    def _fields(self, training_context):
+        """The keys of the input and the target in the minibatch."""
         train_data = training_context['train_data']
-        x=None
-        y=None
-        x = train_data.value_list[0].copy().detach()  # input
-        y = train_data.value_list[1].copy().detach()  # label
-        model=training_context['current_model']
-
-        lam=builtins.min(builtins.max(np.random.beta(self.alpha,self.alpha),0.3), 0.7)
-
-        batch_size = int_shape(x)[0]
-        index = arange(batch_size)
-        index=cast(shuffle(index),'long')
-        this_loss=None
-        mixed_x=None
-        if get_backend()=='pytorch':
-            mixed_x = lam * x + (1 - lam) * x[index, :]
-            pred = model(to_tensor(mixed_x, requires_grad=True))
-            y_a, y_b = y, y[index]
-            this_loss = lam * self.loss_criterion(pred, y_a.long()) + (1 - lam) * self.loss_criterion(pred, y_b.long())
-        elif get_backend()=='tensorflow':
-            x1 = tf.gather(x, index,axis=0)
-            y1 = tf.gather(y, index,axis=0)
-            mixed_x = lam * x + (1 - lam) * x1
-            pred = model(to_tensor(mixed_x, requires_grad=True))
-            y_a, y_b = y, y1
-
-            this_loss = lam * self.loss_criterion(pred, y_a) + (1 - lam) * self.loss_criterion(pred,y_b)
-
-        training_context['current_loss'] = training_context['current_loss'] + this_loss *self.loss_weight
-        if training_context['is_collect_data']:
-            training_context['losses'].collect('mixup_loss', training_context['steps'], float(to_numpy(this_loss * self.loss_weight)))
-
-        if training_context['current_batch']==0:
-            for item in mixed_x:
-                if self.save_path is None and not is_in_colab():
-                    item = unnormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(to_numpy(item))
-                    item = unnormalize(0, 255)(item)
-                    array2image(item).save('Results/mixup_{0}.jpg'.format(get_time_suffix()))
-                elif self.save_path is not None:
+        data_feed = training_context.get('data_feed', None)
+        if data_feed is not None and len(data_feed) > 1:
+            input_key = data_feed.value_list[0]
+            target_key = data_feed['target'] if 'target' in data_feed else data_feed.value_list[-1]
+            if input_key in train_data and target_key in train_data:
+                return input_key, target_key
+        return train_data.key_list[0], train_data.key_list[1]
+
+    def _num_classes(self, training_context, y):
+        if self.num_classes is None:
+            if ndim(y) > 1:
+                self.num_classes = int_shape(y)[-1]
+            else:
+                self.num_classes = int(to_numpy(training_context['current_model'].output_shape)[0])
+        return self.num_classes
+
+    def on_data_received(self, training_context):
+        train_data = training_context['train_data']
+        if train_data is None or len(train_data) < 2:
+            return
+        input_key, target_key = self._fields(training_context)
+        x, y = train_data[input_key], train_data[target_key]
+        mixed_x, mixed_y, lam = self.mix(x, y, self._num_classes(training_context, y))
+        train_data[input_key] = mixed_x
+        train_data[target_key] = mixed_y
+
+        if training_context['current_batch'] == 0 and training_context['current_epoch'] == 0 and ndim(mixed_x) == 4:
+            folder = self.save_path if self.save_path is not None else 'Results' if not is_in_colab() else None
+            if folder is not None:
+                for item in mixed_x:
                     item = unnormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(to_numpy(item))
                     item = unnormalize(0, 255)(item)
-                    array2image(item).save(os.path.join(self.save_path, 'mixup_{0}.jpg'.format(get_time_suffix())))
+                    array2image(item).save(os.path.join(folder, '{0}_{1}.jpg'.format(self.mixing_name, get_time_suffix())))
 
 
-class CutMixCallback(RegularizationCallbacksBase):
-    """Implementation. of the cutmix regularization
-    CutMix is a way to combine two images. It comes from MixUp and Cutout. In this
-    data augmentation technique:patches are cut and pasted among training images
-    where the ground truth labels are also mixed proportionally to the area of the patches
+class MixupCallback(_BatchMixingCallback):
+    """ Implementation. of the mixup regularization
+     Mixup - a neural network regularization technique based on linear interpolation
+     of labeled sample pairs - has stood out by its capacity to improve model's robustness
+     and generalizability through a surprisingly simple formalism.
 
-    References:
-        CutMix: Regularization Strategy to Train Strong Classifiers with Localizable Features
-        https://arxiv.org/abs/1905.04899
+     The minibatch is mixed when it is received (see `mixup_batch`), the inputs are replaced by the mixed inputs and
+     the targets by the soft targets, so the mixed batch costs one forward and one backward like any other batch.
+     The loss of the model has to accept the soft targets (CrossEntropyLoss does).
 
+    Args:
+        alpha (float): the parameter of the beta distribution of the mixing ratio.
+        num_classes (int): the number of classes, inferred from the target or the output shape of the model if None.
+        save_path (str): the folder of the mixed images saved at the first batch.
 
+    References:
+        mixup: BEYOND EMPIRICAL RISK MINIMIZATION
+        https://arxiv.org/pdf/1710.09412.pdf
 
     """
-    def __init__(self, alpha=1,loss_criterion=CrossEntropyLoss,loss_weight=1,save_path=None,  **kwargs):
-        super(CutMixCallback, self).__init__()
-        self.alpha=alpha
-        self.loss_criterion=loss_criterion()
-        self.loss_weight=loss_weight
-        self.save_path=save_path
-
-    def rand_bbox(self, width, height, lam):
-        """
-
-        Args:
-            width ():
-            height ():
-            lam ():
-
-        Returns:
-
-        """
-        W = width
-        H = height
-        cut_rat = math.sqrt(1. - lam)
-        cut_w = int(W * cut_rat)
-        cut_h =int(H * cut_rat)
-
-        # uniform
-        cx = np.random.randint(W)
-        cy = np.random.randint(H)
-
-        bbx1 = np.clip(cx - cut_w // 2, 0, W)
-        bby1 = np.clip(cy - cut_h // 2, 0, H)
-        bbx2 = np.clip(cx + cut_w // 2, 0, W)
-        bby2 = np.clip(cy + cut_h // 2, 0, H)
-
-        return bbx1, bby1, bbx2, bby2
-
-    def on_loss_calculation_end(self, training_context):
-        """Returns mixed inputs, pairs of targets, and lambda"""
-        train_data = training_context['train_data']
-        x = None
-        y = None
-        x = train_data.value_list[0].copy().detach()   # input
-        y = train_data.value_list[1].copy().detach()   # label
+    mixing_name = 'mixup'
 
-        model = training_context['current_model']
+    def mix(self, x, y, num_classes):
+        return mixup_batch(x, y, num_classes, alpha=self.alpha)
 
-        lam=builtins.min(builtins.max(np.random.beta(self.alpha,self.alpha),0.1), 0.4)
 
-        batch_size = int_shape(x)[0]
-        index = cast(arange(batch_size),'int64')
-        index=shuffle(index)
-
-        this_loss=None
-        if get_backend()=='pytorch':
-            y_a, y_b = y, y[index]
-            bbx1, bby1, bbx2, bby2 = self.rand_bbox(x.shape[3], x.shape[2], lam)
-            x[:, :, bbx1:bbx2, bby1:bby2] = x[index, :, bbx1:bbx2, bby1:bby2]
-            # adjust lambda to exactly match pixel ratio
-            lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (x.shape[3] * x.shape[2]))
-            pred = model(to_tensor(x, requires_grad=True))
-            this_loss = lam * self.loss_criterion(pred, y_a.long()) + (1 - lam) * self.loss_criterion(pred, y_b.long())
-
-        elif get_backend() == 'tensorflow':
-
-            y1 = tf.gather(y,index,axis=0)
-            x1= tf.gather(x,index,axis=0)
-            y_a, y_b = y, y1
-            bbx1, bby1, bbx2, bby2 = self.rand_bbox(x.shape[2], x.shape[1], lam)
-            filter=np.zeros(int_shape(x))
-            filter[:, bbx1:bbx2, bby1:bby2, :] =1
-            filter=to_tensor(x)
-            x=x*(1-filter)+x1*filter
-            #x[:, bbx1:bbx2, bby1:bby2, :] = x1[:, bbx1:bbx2, bby1:bby2,:]
-            # adjust lambda to exactly match pixel ratio
-            lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (x.shape[2] * x.shape[1]))
-            pred = model(to_tensor(x, requires_grad=True))
-            loss1=self.loss_criterion(pred, y_a)
-            loss2=self.loss_criterion(pred, y_b)
-            this_loss = lam *loss1  + (1 - lam) * loss2
-
-
-        if training_context['current_batch'] == 0:
-            if self.save_path is None and not is_in_colab():
-                for item in x:
-                    item = unnormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(to_numpy(item))
-                    item = unnormalize(0, 255)(item)
-                    array2image(item).save('Results/cutmix_{0}.jpg'.format(get_time_suffix()))
-            elif self.save_path is not None:
-                for item in x:
-                    item = unnormalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(to_numpy(item))
-                    item = unnormalize(0, 255)(item)
-                    array2image(item).save(os.path.join(self.save_path,'cutmix_{0}.jpg'.format(get_time_suffix())))
+class CutMixCallback(_BatchMixingCallback):
+    """Implementation. of the cutmix regularization
+    CutMix is a way to combine two images. It comes from MixUp and Cutout. In this
+    data augmentation technique:patches are cut and pasted among training images
+    where the ground truth labels are also mixed proportionally to the area of the patches
 
+    The minibatch is mixed when it is received (see `cutmix_batch`), the images are replaced by the mixed images and
+    the targets by the soft targets, so the mixed batch costs one forward and one backward like any other batch.
+    The loss of the model has to accept the soft targets (CrossEntropyLoss does).
 
+    Args:
+        alpha (float): the parameter of the beta distribution of the kept area.
+        num_classes (int): the number of classes, inferred from the target or the output shape of the model if None.
+        save_path (str): the folder of the mixed images saved at the first batch.
 
-        training_context['current_loss'] = training_context['current_loss'] + this_loss *self.loss_weight
-        if training_context['is_collect_data']:
-            training_context['losses'].collect('cutmix_loss', training_context['steps'], float(to_numpy(this_loss * self.loss_weight)))
+    References:
+        CutMix: Regularization Strategy to Train Strong Classifiers with Localizable Features
+        https://arxiv.org/abs/1905.04899
 
+    """
+    mixing_name = 'cutmix'
 
+    def mix(self, x, y, num_classes):
+        return cutmix_batch(x, y, num_classes, alpha=self.alpha)
 
 
 class GradientClippingCallback(RegularizationCallbacksBase):
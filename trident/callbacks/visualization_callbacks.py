@@ -15,12 +15,14 @@ from trident.backend.pillow_backend import image2array
 from trident.callbacks.callback_base import CallbackBase
 from trident.data.mask_common import label2color
 from trident.misc.ipython_utils import is_in_ipython, is_in_colab
+from trident.misc.render_worker import get_render_worker
 from trident.misc.visualization_utils import *
 from trident.data.bbox_common  import *
 
 if get_backend()=='pytorch':
     from trident.backend.pytorch_backend import try_map_args_and_call
-    from trident.backend.pytorch_ops import to_numpy,to_tensor,arange,shuffle,cast,clip,sqrt,int_shape,argmax,softmax,any_abnormal_number,reduce_any
+    from trident.backend.pytorch_ops import to_numpy,to_tensor,arange,shuffle,cast,clip,sqrt,int_shape,argmax,softmax,any_abnormal_number,reduce_any,zeros_like
+    from trident.optims.pytorch_parameter_statistics import parameter_statistics
 
 elif get_backend()=='tensorflow':
     from trident.backend.tensorflow_backend import try_map_args_and_call
@@ -42,7 +44,14 @@ __all__ = ['VisualizationCallbackBase', 'TileImageCallback', 'PrintGradientsCall
 
 
 class VisualizationCallbackBase(CallbackBase):
-    def __init__(self, epoch_inteval, batch_inteval, save_path: str = None, imshow=False):
+    """Base of the callbacks plotting during the training.
+
+    With ``render_in_background`` (outside of ipython and colab, where the figures are displayed inline) the plots are
+    rendered and saved by the shared rendering process (see `RenderWorker`), the training loop only pays for
+    a snapshot of the data to plot, and the stale frames are dropped when the rendering cannot keep up.
+
+    """
+    def __init__(self, epoch_inteval, batch_inteval, save_path: str = None, imshow=False, render_in_background=True):
         super(VisualizationCallbackBase, self).__init__()
         self.is_in_ipython = is_in_ipython()
         self.is_in_colab = is_in_colab()
@@ -52,15 +61,22 @@ class VisualizationCallbackBase(CallbackBase):
             save_path = 'results'
         self.save_path = make_dir_if_need(save_path)
         self.imshow = imshow
+        self.render_in_background = render_in_background
 
-    pass
+    def render(self, fn, *args, **kwargs):
+        """Call the plotting function fn, in the rendering process when rendering in background."""
+        if self.render_in_background and not self.is_in_ipython and not self.is_in_colab:
+            kwargs['imshow'] = False
+            get_render_worker().submit(self.uuid, fn, *args, **kwargs)
+        else:
+            fn(*args, **kwargs)
 
 
 class TileImageCallback(VisualizationCallbackBase):
     def __init__(self, epoch_inteval=-1, batch_inteval=-1, save_path: str = 'results',
                  name_prefix: str = 'tile_image_{0}.png',row=3, include_input=True, include_output=True, include_target=True,
-                 include_mask=None, reverse_image_transform=None,imshow=False):
-        super(TileImageCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow)
+                 include_mask=None, reverse_image_transform=None,imshow=False, render_in_background=True):
+        super(TileImageCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow, render_in_background)
         self.is_in_ipython = is_in_ipython()
         self.is_in_colab = is_in_colab()
         self.tile_image_name_prefix = name_prefix
@@ -140,7 +156,7 @@ class TileImageCallback(VisualizationCallbackBase):
 
         # if self.tile_image_include_mask:
         #     tile_images_list.append(input*127.5+127.5)
-        tile_rgb_images(*tile_images_list,row=self.row, save_path=os.path.join(self.save_path, self.tile_image_name_prefix),imshow=True)
+        self.render(tile_rgb_images, *tile_images_list,row=self.row, save_path=os.path.join(self.save_path, self.tile_image_name_prefix),imshow=True)
 
     def on_batch_end(self, training_context):
         if self.batch_inteval > 0 and (training_context['current_batch']  % self.batch_inteval == 0):
@@ -153,8 +169,8 @@ class TileImageCallback(VisualizationCallbackBase):
 
 class SegTileImageCallback(VisualizationCallbackBase):
     def __init__(self, epoch_inteval=-1, batch_inteval=-1, save_path: str = 'results', reverse_image_transform=None,
-                 palette=None, background=(120, 120, 120), name_prefix: str = 'segtile_image_{0}.png', imshow=False):
-        super(SegTileImageCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow)
+                 palette=None, background=(120, 120, 120), name_prefix: str = 'segtile_image_{0}.png', imshow=False, render_in_background=True):
+        super(SegTileImageCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow, render_in_background)
         self.is_in_ipython = is_in_ipython()
         self.is_in_colab = is_in_colab()
         self.palette = palette
@@ -223,7 +239,7 @@ class SegTileImageCallback(VisualizationCallbackBase):
 
         # if self.tile_image_include_mask:
         #     tile_images_list.append(input*127.5+127.5)
-        tile_rgb_images(*tile_images_list, save_path=os.path.join(self.save_path, self.tile_image_name_prefix),imshow=True)
+        self.render(tile_rgb_images, *tile_images_list, save_path=os.path.join(self.save_path, self.tile_image_name_prefix),imshow=True)
 
     def on_batch_end(self, training_context):
         if self.batch_inteval > 0 and (training_context['current_batch']) % self.batch_inteval == 0:
@@ -242,8 +258,8 @@ class SegTileImageCallback(VisualizationCallbackBase):
 
 class DetectionPlotImageCallback(VisualizationCallbackBase):
     def __init__(self, epoch_inteval=-1, batch_inteval=-1, save_path: str = 'results', reverse_image_transform=None, labels=None,
-                 palette=None, background=(120, 120, 120), name_prefix: str = 'detection_plot_image_{0}.png', imshow=False):
-        super(DetectionPlotImageCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow)
+                 palette=None, background=(120, 120, 120), name_prefix: str = 'detection_plot_image_{0}.png', imshow=False, render_in_background=True):
+        super(DetectionPlotImageCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow, render_in_background)
         self.is_in_ipython = is_in_ipython()
         self.is_in_colab = is_in_colab()
         self.labels=labels
@@ -289,7 +305,7 @@ class DetectionPlotImageCallback(VisualizationCallbackBase):
 
         tile_images_list.append(input_image2)
 
-        tile_rgb_images(*tile_images_list, save_path=os.path.join(self.save_path, self.tile_image_name_prefix),imshow=True)
+        self.render(tile_rgb_images, *tile_images_list, save_path=os.path.join(self.save_path, self.tile_image_name_prefix),imshow=True)
 
     def on_batch_end(self, training_context):
         if self.batch_inteval > 0 and (training_context['current_batch']) % self.batch_inteval == 0:
@@ -305,8 +321,8 @@ class DetectionPlotImageCallback(VisualizationCallbackBase):
 
 class PlotLossMetricsCallback(VisualizationCallbackBase):
     def __init__(self, epoch_inteval=-1, batch_inteval=-1, save_path: str = 'results', clean_ipython_output_frequency=5,
-                 name_prefix: str = 'loss_metric_curve_{0}.png',is_inplace=False, imshow=False):
-        super(PlotLossMetricsCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow)
+                 name_prefix: str = 'loss_metric_curve_{0}.png',is_inplace=False, imshow=False, render_in_background=True):
+        super(PlotLossMetricsCallback, self).__init__(epoch_inteval, batch_inteval, save_path, imshow, render_in_background)
         self.training_items = None
         self.name_prefix = name_prefix
         self.is_inplace=is_inplace
@@ -333,10 +349,10 @@ class PlotLossMetricsCallback(VisualizationCallbackBase):
                     self.loss_history_list.append(trainitem.batch_loss_history)
                     self.metric_history_list.append(trainitem.batch_metric_history)
                 self.counter += 1
-                loss_metric_curve(self.loss_history_list, self.metric_history_list,
-                                  legend=training_context['training_names'].value_list, calculate_base='batch',
-                                  max_iteration=None, save_path=os.path.join(self.save_path, self.name_prefix),
-                                  imshow=self.imshow)
+                self.render(loss_metric_curve, self.loss_history_list, self.metric_history_list,
+                            legend=training_context['training_names'].value_list, calculate_base='batch',
+                            max_iteration=None, save_path=os.path.join(self.save_path, self.name_prefix),
+                            imshow=self.imshow)
 
 
                 # if self.tile_image_unit == 'epoch' and (epoch + 1) % self.tile_image_frequency == 0:  #     epoch_loss_history = [trainitem.epoch_loss_history for k, trainitem in self.training_items.items()]  #     epoch_metric_history = [trainitem.epoch_metric_history for k, trainitem in self.training_items.items()]  #  #     loss_metric_curve(epoch_loss_history, epoch_metric_history, legend=self.training_names.value_list,  #                       calculate_base='epoch', max_iteration=self.num_epochs,  #                       save_path=os.path.join(self.tile_image_save_path, 'loss_metric_curve.png'),  #                       imshow=True)
@@ -372,7 +388,6 @@ class PrintGradientsCallback(VisualizationCallbackBase):
     def on_optimization_step_start(self, training_context):
         if get_backend()=='pytorch':
             if  (training_context['current_epoch'] * training_context['total_batch'] + training_context['current_batch']) % self.batch_inteval == 0:
-                grad_dict = {}
                 if 'grads_state' not in training_context:
                     training_context['grads_state']=OrderedDict()
                     training_context['grads_state']['first_layer']=[]
@@ -381,29 +396,17 @@ class PrintGradientsCallback(VisualizationCallbackBase):
                     #relocate the first/ last layers
                     self.first_layer=''
                     self.last_layer=''
+                parameters = OrderedDict([(k, v) for k, v in training_context['current_model'].named_parameters() if v is not None and v.requires_grad == True])
+                if self.first_layer == '' or self.last_layer == '' or self.first_layer not in parameters or self.last_layer not in parameters:
+                    layers = [k for k, v in parameters.items() if v.ndim > 1]
+                    self.first_layer = layers[0] if len(layers) > 0 else ''
+                    self.last_layer = layers[-1] if len(layers) > 0 else ''
                 if self.first_layer != '' and self.last_layer != '':
-                    for i, (k, v) in enumerate(training_context['current_model'].named_parameters()):
-                        if v is not None and v.requires_grad == True:
-                            if k == self.first_layer:
-                                training_context['grads_state']['first_layer'].append(
-                                    np.abs(to_numpy(0 if v.grad is None else v.grad)).mean())
-                            elif k == self.last_layer:
-                                training_context['grads_state']['last_layer'].append(
-                                    np.abs(to_numpy(0 if v.grad is None else v.grad)).mean())
-
-                else:
-
-                    for i, (k, v) in enumerate(training_context['current_model'].named_parameters()):
-                        if v is not None and v.requires_grad==True:
-                            grad_dict[k] = np.abs(to_numpy(0 if v.grad is None else v.grad))
-                            if grad_dict[k].ndim > 1:
-                                if self.first_layer == '':
-                                    self.first_layer = k
-                                self.last_layer = k
-                    if self.first_layer!='' and self.first_layer in grad_dict:
-                        training_context['grads_state']['first_layer'].append(grad_dict[self.first_layer].mean())
-                    if self.last_layer != '' and self.last_layer in grad_dict:
-                        training_context['grads_state']['last_layer'].append(grad_dict[self.last_layer].mean())
+                    grads = [parameters[k].grad if parameters[k].grad is not None else zeros_like(parameters[k]) for k in (self.first_layer, self.last_layer)]
+                    # the mean absolute gradients of both layers, computed on device, a single transfer to host
+                    first_grad, last_grad = to_numpy(parameter_statistics(grads)[:, 1]).tolist()
+                    training_context['grads_state']['first_layer'].append(first_grad)
+                    training_context['grads_state']['last_layer'].append(last_grad)
 
                 if len(training_context['grads_state']['first_layer'])>0 and len(training_context['grads_state']['last_layer'])>0:
                     self.lines.append('{0:<16s}  first_layer gradients: {1:<8.3e}| last_layer gradients: {2:<8.3e}'.format(
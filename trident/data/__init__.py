@@ -11,10 +11,13 @@ from trident.data.mask_common import *
 from trident.data.label_common import *
 from trident.data.bbox_common  import *
 from trident.data.image_reader import ImageReader,ImageThread
+from trident.data.image_cache import *
 from trident.data.utils import *
+from trident.data.worker_pool import *
 from trident.data.samplers import *
 from trident.data.data_provider import *
 from trident.data.data_loaders import *
+from trident.data.packed_dataset import *
 
 
 
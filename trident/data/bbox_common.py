@@ -20,7 +20,7 @@ if _backend=='pytorch':
     from  trident.backend.pytorch_ops import *
 else:
     from trident.backend.tensorflow_ops import *
-
+from trident.data.bbox_nms import nms as nms_indexes
 
 
 __all__ = ['nms', 'xywh2xyxy', 'xyxy2xywh','bbox_iou','bbox_diou','bbox_giou','bbox_giou_numpy','plot_one_box']
@@ -158,74 +158,22 @@ def nms(boxes, threshold):
         non max suppression
 
     Args
-        box: numpy array n x 5
-            input bbox array
-        overlap_threshold: float number
+        box: numpy array or tensor n x 5
+            input bbox array (x1, y1, x2, y2, score)
+        threshold: float number
             threshold of overlap
-        mode: float number
-            how to compute overlap ratio, 'Union' or 'Min'
 
     Returns:
-        index array of the selected bbox
+        (the selected bboxes, index array of the selected bbox), None if there is no box
+
     """
     # if there are no boxes, return an empty list
-
-
     if len(boxes) == 0:
         return []
-
-    # initialize the list of picked indexes
-    pick = []
-    box_len = len(boxes)
-    # grab the coordinates of the bounding boxes
-    x1, y1, x2, y2, score = [boxes[:, i] for i in range(5)]
-
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-    sorted_index = np.argsort(score)
-    # keep looping while some indexes still remain in the indexes list
-    adjust_bbox = []
-    while len(sorted_index) > 0:
-        # grab the last index in the indexes list and add the index value to the list of picked indexes
-        last = len(sorted_index) - 1
-        i = sorted_index[-1]
-        pick.append(int(i))
-        sorted_index = sorted_index[:-1]
-        if len(sorted_index) == 1:
-            break
-        # sorted_index = sorted_index[:-1]
-        xx1 = np.max(x1[i], x1[sorted_index[:last]])
-        yy1 = np.max(y1[i], y1[sorted_index[:last]])
-        xx2 = np.min(x2[i], x2[sorted_index[:last]])
-        yy2 = np.min(y2[i], y2[sorted_index[:last]])
-        # compute the width and height of the bounding box
-        xc = ((xx1 + xx2).abs_() / 2 - (x1[sorted_index[:last]] + x2[sorted_index[:last]]) / 2)
-        yc = ((yy1 + yy2).abs_() / 2 - (y1[sorted_index[:last]] + y2[sorted_index[:last]]) / 2)
-
-        w = (xx2 - xx1 + 1).clamp_(0)
-        h = (yy2 - yy1 + 1).clamp_(0)
-        inter = w * h
-
-        # any of happends will dedup
-        IoU = inter / (area[i] + area[sorted_index[:last]] - inter)
-        sorted_index = sorted_index[IoU <= threshold]
-
-    if boxes is not None and len(pick) > 0:
-        try:
-            out = boxes[pick]
-            if len(out.size()) == 1:
-                out = out.unsqueeze(0)
-                if len(out) == 0:
-                    return None
-            return out,pick
-        except Exception as e:
-            print(e)
-            print('box_len', box_len)
-            print('pick', len(pick))
-            print('boxes', len(boxes))
-
-    return None
-
+    pick = nms_indexes(boxes[:, :4], boxes[:, 4], iou_threshold=threshold, offset=1)
+    if len(pick) == 0:
+        return None
+    return boxes[pick], pick
 
 
 def matrix_iou(a, b):
@@ -0,0 +1,281 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from trident.backend.load_backend import get_backend
+
+if get_backend() == 'pytorch':
+    import torch
+else:
+    torch = None
+
+__all__ = ['box_iou_matrix', 'nms', 'batched_nms', 'soft_nms']
+
+# rows of the overlap matrix computed at once, bounds the memory of crowded images
+_BLOCK_SIZE = 2048
+
+
+def _is_torch(x):
+    return torch is not None and isinstance(x, torch.Tensor)
+
+
+def _as_array(x):
+    if _is_torch(x):
+        return x
+    if hasattr(x, 'numpy'):
+        x = x.numpy()
+    return np.asarray(x)
+
+
+def _to_numpy(x):
+    return x.detach().cpu().numpy() if _is_torch(x) else np.asarray(x)
+
+
+def box_iou_matrix(boxes0, boxes1, mode='iou', offset=0):
+    """Pairwise overlap of two sets of corner-form boxes.
+
+    Args:
+        boxes0 (tensor or ndarray): (N, 4) boxes (x1, y1, x2, y2).
+        boxes1 (tensor or ndarray): (M, 4) boxes (x1, y1, x2, y2).
+        mode (str): 'iou' intersection over union, 'iof' intersection over the area of boxes1.
+        offset (int): 1 for the legacy pixel convention where the width is x2 - x1 + 1.
+
+    Returns:
+        (N, M) overlap matrix, the same type as the inputs.
+
+    Examples:
+        >>> np.round(box_iou_matrix(np.array([[0, 0, 2, 2]]), np.array([[1, 1, 3, 3], [0, 0, 2, 2]])), 4).tolist()
+        [[0.1429, 1.0]]
+
+    """
+    overlap, area0, area1 = _overlap_and_areas(boxes0, boxes1, offset)
+    if mode == 'iof':
+        return overlap / (area1[None, :] + 1e-5)
+    return overlap / (area0[:, None] + area1[None, :] - overlap + 1e-5)
+
+
+def _overlap_and_areas(boxes0, boxes1, offset=0):
+    """Intersection areas (N, M) and the areas of both sets, built coordinate by coordinate to keep the temporaries 2-D."""
+    if _is_torch(boxes0):
+        maximum, minimum = torch.max, torch.min
+        clip = lambda x: x.clamp_(min=0)
+    else:
+        maximum, minimum = np.maximum, np.minimum
+        clip = lambda x: np.clip(x, 0, None, out=x)
+    w = clip(minimum(boxes0[:, None, 2], boxes1[None, :, 2]) - maximum(boxes0[:, None, 0], boxes1[None, :, 0]) + offset)
+    h = clip(minimum(boxes0[:, None, 3], boxes1[None, :, 3]) - maximum(boxes0[:, None, 1], boxes1[None, :, 1]) + offset)
+    w *= h
+    area0 = clip((boxes0[:, 2] - boxes0[:, 0] + offset)) * clip((boxes0[:, 3] - boxes0[:, 1] + offset))
+    area1 = clip((boxes1[:, 2] - boxes1[:, 0] + offset)) * clip((boxes1[:, 3] - boxes1[:, 1] + offset))
+    return w, area0, area1
+
+
+def _order(scores, candidate_size=None):
+    """Indexes sorted by descending score (stable), truncated to the candidate_size best."""
+    if _is_torch(scores):
+        order = torch.argsort(scores, descending=True, stable=True)
+    else:
+        order = np.argsort(-scores, kind='stable')
+    if candidate_size is not None and candidate_size > 0:
+        order = order[:candidate_size]
+    return order
+
+
+def _suppression_matrix(boxes, iou_threshold, mode='iou', offset=0):
+    """Boolean (N, N) matrix, row i marks the boxes suppressed by box i, computed in row blocks on the box device and transferred once."""
+    blocks = []
+    for start in range(0, len(boxes), _BLOCK_SIZE):
+        overlap, area0, area1 = _overlap_and_areas(boxes[start:start + _BLOCK_SIZE], boxes, offset)
+        # iou > t  <=>  overlap * (1 + t) > t * (area0 + area1), no division needed
+        if mode == 'iof':
+            blocks.append(overlap > iou_threshold * area1[None, :])
+        else:
+            blocks.append(overlap * (1 + iou_threshold) > iou_threshold * (area0[:, None] + area1[None, :]))
+    if _is_torch(boxes):
+        return torch.cat(blocks, 0).cpu().numpy()
+    return np.concatenate(blocks, 0)
+
+
+def _greedy_keep(suppress, top_k=-1):
+    """Greedy pass over a score-sorted suppression matrix, one vector operation per kept box."""
+    n = len(suppress)
+    removed = np.zeros(n, dtype=bool)
+    keep = []
+    for i in range(n):
+        if removed[i]:
+            continue
+        keep.append(i)
+        if 0 < top_k == len(keep):
+            break
+        removed[i + 1:] |= suppress[i, i + 1:]
+    return np.asarray(keep, dtype=np.int64)
+
+
+def nms(boxes, scores, iou_threshold=0.5, top_k=-1, candidate_size=None, mode='iou', offset=0):
+    """Greedy non-maximum suppression on a precomputed overlap matrix.
+
+    The overlap of every pair of candidates is computed in a few vectorized blocks (on the GPU for cuda tensors),
+    only the greedy selection walks the boxes, and it touches one boolean row per kept box.
+
+    Args:
+        boxes (tensor or ndarray): (N, 4) corner-form boxes (x1, y1, x2, y2).
+        scores (tensor or ndarray): (N,) scores, the higher the better.
+        iou_threshold (float): boxes overlapping a kept box more than the threshold are suppressed.
+        top_k (int): maximum number of kept boxes, if <= 0 keep them all.
+        candidate_size (int): only consider the candidate_size best scored boxes (top-k pre-filtering).
+        mode (str): 'iou' or 'iof' (intersection over the area of the suppressed box).
+        offset (int): 1 for the legacy pixel convention where the width is x2 - x1 + 1.
+
+    Returns:
+        the indexes of the kept boxes sorted by descending score, a LongTensor for tensors, an int64 array otherwise.
+
+    Examples:
+        >>> boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 30, 30]], dtype=np.float32)
+        >>> nms(boxes, np.array([0.9, 0.8, 0.7]), iou_threshold=0.5)
+        array([0, 2])
+
+    """
+    boxes = _as_array(boxes)
+    scores = _as_array(scores)
+    is_torch = _is_torch(boxes)
+    if len(boxes) == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device) if is_torch else np.zeros(0, dtype=np.int64)
+    order = _order(scores, candidate_size)
+    keep = _greedy_keep(_suppression_matrix(boxes[order, :4], iou_threshold, mode=mode, offset=offset), top_k=top_k)
+    if is_torch:
+        return order[torch.from_numpy(keep).to(order.device)]
+    return order[keep]
+
+
+def batched_nms(boxes, scores, idxs, iou_threshold=0.5, top_k=-1, candidate_size=None, offset=0):
+    """Class-aware (or image-aware) non-maximum suppression in a single pass.
+
+    Boxes of different categories never suppress each other: every category is shifted by a distinct offset larger
+    than all coordinates, so a single overlap matrix handles all of them. Use the image index (or image index *
+    num_classes + class) as ``idxs`` to run the suppression of a whole batch of images at once.
+
+    Args:
+        boxes (tensor or ndarray): (N, 4) corner-form boxes (x1, y1, x2, y2).
+        scores (tensor or ndarray): (N,) scores.
+        idxs (tensor or ndarray): (N,) integer category of every box.
+        iou_threshold (float): the suppression threshold.
+        top_k (int): maximum number of kept boxes per category, if <= 0 keep them all.
+        candidate_size (int): only consider the candidate_size best scored boxes of every category.
+        offset (int): 1 for the legacy pixel convention where the width is x2 - x1 + 1.
+
+    Returns:
+        the indexes of the kept boxes sorted by descending score.
+
+    Examples:
+        >>> boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [1, 1, 10, 10]], dtype=np.float32)
+        >>> batched_nms(boxes, np.array([0.9, 0.8, 0.7]), np.array([0, 0, 1]), iou_threshold=0.5)
+        array([0, 2])
+
+    """
+    boxes = _as_array(boxes)
+    scores = _as_array(scores)
+    idxs = _as_array(idxs)
+    is_torch = _is_torch(boxes)
+    if len(boxes) == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device) if is_torch else np.zeros(0, dtype=np.int64)
+
+    order = _order(scores)
+    if (top_k is not None and top_k > 0) or (candidate_size is not None and candidate_size > 0):
+        # rank of every box inside its category, the per-category limits become one mask
+        category = _to_numpy(idxs)[_to_numpy(order)]
+        by_category = np.argsort(category, kind='stable')
+        sorted_category = category[by_category]
+        group_start = np.searchsorted(sorted_category, sorted_category, side='left')
+        rank = np.empty(len(category), dtype=np.int64)
+        rank[by_category] = np.arange(len(category)) - group_start
+        if candidate_size is not None and candidate_size > 0:
+            candidate = np.nonzero(rank < candidate_size)[0]
+            order, rank, category = order[torch.from_numpy(candidate).to(order.device) if is_torch else candidate], rank[candidate], category[candidate]
+
+    sorted_boxes = boxes[order, :4]
+    if is_torch:
+        shift = (sorted_boxes.max() - sorted_boxes.min() + 1 + offset) * idxs[order].to(sorted_boxes.dtype)
+    else:
+        shift = (sorted_boxes.max() - sorted_boxes.min() + 1 + offset) * idxs[order].astype(sorted_boxes.dtype)
+    suppress = _suppression_matrix(sorted_boxes + shift[:, None], iou_threshold, offset=offset)
+
+    if top_k is not None and top_k > 0:
+        # a kept box still suppresses its neighbours once the category is full, run the greedy pass then cap
+        keep = _greedy_keep(suppress)
+        kept_category = category[keep]
+        by_category = np.argsort(kept_category, kind='stable')
+        sorted_category = kept_category[by_category]
+        kept_rank = np.empty(len(keep), dtype=np.int64)
+        kept_rank[by_category] = np.arange(len(keep)) - np.searchsorted(sorted_category, sorted_category, side='left')
+        keep = keep[kept_rank < top_k]
+    else:
+        keep = _greedy_keep(suppress)
+    if is_torch:
+        return order[torch.from_numpy(keep).to(order.device)]
+    return order[keep]
+
+
+def soft_nms(boxes, scores, iou_threshold=0.3, sigma=0.5, score_threshold=0.001, method='gaussian', top_k=-1, candidate_size=None, offset=0):
+    """Soft non-maximum suppression (Bodla et al. 2017), overlapping boxes are down-weighted instead of removed.
+
+    The overlap matrix is computed once, every step only picks the best remaining box and rescales the scores of the
+    others with its overlap row.
+
+    Args:
+        boxes (tensor or ndarray): (N, 4) corner-form boxes (x1, y1, x2, y2).
+        scores (tensor or ndarray): (N,) scores.
+        iou_threshold (float): for the 'linear' method, only boxes overlapping more than the threshold are rescaled.
+        sigma (float): the width of the 'gaussian' penalty exp(-iou^2 / sigma).
+        score_threshold (float): boxes whose rescaled score falls below it are discarded.
+        method (str): 'gaussian' or 'linear'.
+        top_k (int): maximum number of kept boxes, if <= 0 keep them all.
+        candidate_size (int): only consider the candidate_size best scored boxes.
+        offset (int): 1 for the legacy pixel convention where the width is x2 - x1 + 1.
+
+    Returns:
+        (keep, new_scores): the indexes of the kept boxes in selection order and their rescaled scores.
+
+    Examples:
+        >>> boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 30, 30]], dtype=np.float32)
+        >>> keep, new_scores = soft_nms(boxes, np.array([0.9, 0.8, 0.7]), score_threshold=0.1)
+        >>> keep
+        array([0, 2, 1])
+
+    """
+    boxes = _as_array(boxes)
+    scores = _as_array(scores)
+    is_torch = _is_torch(boxes)
+    if len(boxes) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        if is_torch:
+            return torch.from_numpy(empty).to(boxes.device), scores[:0]
+        return empty, scores[:0]
+    order = _order(scores, candidate_size)
+    sorted_boxes = boxes[order, :4]
+    iou = box_iou_matrix(sorted_boxes, sorted_boxes, offset=offset)
+    iou = _to_numpy(iou).astype(np.float64)
+    current = _to_numpy(scores[order]).astype(np.float64).copy()
+
+    alive = current > score_threshold
+    keep, keep_scores = [], []
+    while alive.any():
+        i = int(np.argmax(np.where(alive, current, -np.inf)))
+        keep.append(i)
+        keep_scores.append(current[i])
+        alive[i] = False
+        if 0 < top_k == len(keep):
+            break
+        if method == 'linear':
+            decay = np.where(iou[i] > iou_threshold, 1 - iou[i], 1)
+        else:
+            decay = np.exp(-(iou[i] ** 2) / sigma)
+        current = np.where(alive, current * decay, current)
+        alive &= current > score_threshold
+
+    keep = np.asarray(keep, dtype=np.int64)
+    keep_scores = np.asarray(keep_scores)
+    if is_torch:
+        return order[torch.from_numpy(keep).to(order.device)], torch.as_tensor(keep_scores, dtype=scores.dtype, device=scores.device)
+    return order[keep], keep_scores.astype(scores.dtype)
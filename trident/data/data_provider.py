@@ -70,8 +70,11 @@ class ImageDataProvider(object):
         self.tot_records = 0
         self.tot_epochs = 0
         self._image_transform_funcs = []
+        self.image_transform_plans = TransformPlanCache()
         self._label_transform_funcs = []
         self._paired_transform_funcs = []
+        self._batch_transform_funcs = []
+        self._device_transform_funcs = []
         self.spatial_transform_funcs = []
 
     @property
@@ -123,6 +126,45 @@ class ImageDataProvider(object):
         else:
             return None
 
+    @property
+    def use_multiprocessing(self):
+        """If True, train/test minibatches are built in background workers (see `Iterator.workers` and `Iterator.buffer_size`)."""
+        return self.traindata.use_multiprocessing if self.traindata is not None else False
+
+    @use_multiprocessing.setter
+    def use_multiprocessing(self, value):
+        if self.traindata is not None and hasattr(self.traindata, 'use_multiprocessing'):
+            self.traindata.use_multiprocessing = value
+        if self.testdata is not None and hasattr(self.testdata, 'use_multiprocessing'):
+            self.testdata.use_multiprocessing = value
+
+    def with_worker_pool(self, workers=None, buffer_size=None):
+        """Build minibatches in background workers with a bounded prefetch queue.
+
+        Args:
+            workers (int): number of loader workers, keep the iterator's setting if None.
+            buffer_size (int): maximum number of prefetched minibatches, keep the iterator's setting if None.
+
+        Returns:
+            the data provider self
+
+        """
+        for iterator in [self.traindata, self.testdata]:
+            if iterator is not None and hasattr(iterator, 'use_multiprocessing'):
+                if workers is not None:
+                    iterator.workers = workers
+                if buffer_size is not None:
+                    iterator.buffer_size = buffer_size
+                iterator.use_multiprocessing = True
+                iterator.close()
+        return self
+
+    def close(self):
+        """Shutdown the loader workers of train/test data."""
+        for iterator in [self.traindata, self.testdata]:
+            if iterator is not None and hasattr(iterator, 'close'):
+                iterator.close()
+
     @property
     def image_transform_funcs(self):
         return self._image_transform_funcs
@@ -130,6 +172,7 @@ class ImageDataProvider(object):
     @image_transform_funcs.setter
     def image_transform_funcs(self, value):
         self._image_transform_funcs = value
+        self.image_transform_plans.clear()
         if self.traindata is not None and hasattr(self.traindata.data, 'transform_funcs'):
             self.traindata.data.transform_funcs = self._image_transform_funcs
             if len(self.traindata.unpair) > 0:
@@ -147,9 +190,8 @@ class ImageDataProvider(object):
         if len(self.image_transform_funcs) == 0:
             return image_backend_adaption(img_data)
         if isinstance(img_data, np.ndarray):
-            for fc in self.image_transform_funcs:
-                if not fc.__qualname__.startswith('random_') or 'crop' in fc.__qualname__ or 'rescale' in fc.__qualname__ or (
-                        fc.__qualname__.startswith('random_') and random.randint(0, 10) % 2 == 0):
+            for fc in self.image_transform_plans.get(self.image_transform_funcs, gate=should_apply):
+                if should_apply(fc):
                     img_data = fc(img_data)
 
             img_data = image_backend_adaption(img_data)
@@ -162,6 +204,14 @@ class ImageDataProvider(object):
     def reverse_image_transform_funcs(self):
         return_list = []
         return_list.append(reverse_image_backend_adaption)
+        for i in range(len(self.device_transform_funcs)):
+            fn = self.device_transform_funcs[-1 - i]
+            if fn.__qualname__ == 'normalize.<locals>.img_op':
+                return_list.append(unnormalize(fn.mean, fn.std))
+        for i in range(len(self.batch_transform_funcs)):
+            fn = self.batch_transform_funcs[-1 - i]
+            if fn.__qualname__ == 'batch_normalize.<locals>.batch_op':
+                return_list.append(unnormalize(fn.mean, fn.std))
         for i in range(len(self.image_transform_funcs)):
             fn = self.image_transform_funcs[-1 - i]
             if fn.__qualname__ == 'normalize.<locals>.img_op':
@@ -194,6 +244,45 @@ class ImageDataProvider(object):
             self.testdata.label.label_transform_funcs = self._label_transform_funcs
             self.testdata.update_data_template()
 
+    @property
+    def batch_transform_funcs(self):
+        """The batch transform functions (ex. batch_random_adjust_gamma, batch_normalize) applied to the image fields of
+        every collated minibatch, the photometric augmentations run once per minibatch instead of once per sample.
+
+        They expect images in [0, 255], so a normalize in image_transform_funcs should be replaced by a batch_normalize
+        at the end of this list.
+
+        """
+        return self._batch_transform_funcs
+
+    @batch_transform_funcs.setter
+    def batch_transform_funcs(self, value):
+        self._batch_transform_funcs = value
+        if self.traindata is not None and hasattr(self.traindata, 'batch_transform_funcs'):
+            self.traindata.batch_transform_funcs = self._batch_transform_funcs
+        if self.testdata is not None and hasattr(self.testdata, 'batch_transform_funcs'):
+            self.testdata.batch_transform_funcs = self._batch_transform_funcs
+
+    @property
+    def device_transform_funcs(self):
+        """Image transform functions applied to every fetched minibatch with batched tensor kernels on the current
+        device (see `device_transform`), the images and masks of the minibatch are returned as tensors.
+
+        The same functions as image_transform_funcs are accepted, the ones without a device implementation
+        (`has_device_impl`) fall back to numpy sample by sample. The geometric functions are applied to the paired
+        masks, boxes and landmarks with the same matrices.
+
+        """
+        return self._device_transform_funcs
+
+    @device_transform_funcs.setter
+    def device_transform_funcs(self, value):
+        self._device_transform_funcs = value
+        if self.traindata is not None and hasattr(self.traindata, 'device_transform_funcs'):
+            self.traindata.device_transform_funcs = self._device_transform_funcs
+        if self.testdata is not None and hasattr(self.testdata, 'device_transform_funcs'):
+            self.testdata.device_transform_funcs = self._device_transform_funcs
+
     @property
     def paired_transform_funcs(self):
         return self._paired_transform_funcs
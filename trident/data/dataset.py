@@ -18,12 +18,14 @@ import threading
 import time
 from enum import Enum, unique
 from typing import List, TypeVar, Tuple, Union, Optional, Generic, Iterable, Iterator, Sequence, Dict
+import cv2
 import numpy as np
 from skimage import color
 
 from trident.data.bbox_common import xywh2xyxy, xyxy2xywh
+from trident.data.image_cache import ImageCache
 from trident.data.image_common import gray_scale, image2array, mask2array, image_backend_adaption, reverse_image_backend_adaption, \
-    unnormalize, array2image, GetImageMode
+    unnormalize, array2image, GetImageMode, TransformPlanCache, should_apply, apply_batch_transform_funcs, batch_normalize
 
 from trident.backend import iteration_tools
 from trident.data.label_common import label_backend_adaptive
@@ -42,6 +44,7 @@ except ImportError:
 if get_backend() == 'pytorch':
     from trident.backend.pytorch_backend import to_numpy, to_tensor, ObjectType
     from trident.backend.pytorch_ops import int_shape, str2dtype, tensor_to_shape
+    from trident.data.pytorch_augmentation import device_transform
     import torch
 elif get_backend() == 'tensorflow':
     from trident.backend.tensorflow_backend import to_numpy, to_tensor, ObjectType
@@ -85,6 +88,16 @@ class Dataset(object):
         self.object_type = kwargs.get("expect_data_type", object_type)
         self.transform_funcs = []
 
+    @property
+    def transform_funcs(self):
+        return self._transform_funcs
+
+    @transform_funcs.setter
+    def transform_funcs(self, value):
+        self._transform_funcs = value
+        if not hasattr(self, 'transform_plans'):
+            self.transform_plans = TransformPlanCache()
+        self.transform_plans.clear()
 
 
     def __add__(self, other):
@@ -276,18 +289,58 @@ class NumpyDataset(Dataset):
 #         return len(super().__getitem__(0))
 
 
+def _image2array_compact(path):
+    """`image2array` kept as uint8 when the decoded values fit, 4 times smaller in the image cache."""
+    img = image2array(path)
+    if img is not None and img.dtype != np.uint8 and img.size > 0 and img.min() >= 0 and img.max() <= 255:
+        return img.astype(np.uint8)
+    return img
+
+
 class ImageDataset(Dataset):
     def __init__(self, images=None, object_type: ObjectType = ObjectType.rgb,
                  get_image_mode: GetImageMode = GetImageMode.processed, symbol="image", name=None, **kwargs):
         super().__init__(symbol=symbol, object_type=object_type, name=name, **kwargs)
 
         self.__add__(kwargs.get('data',images))
-        self.dtype = np.float32
+        # keep_uint8: decode and transform the images as uint8, a trailing normalize is deferred to the minibatch
+        self.keep_uint8 = kwargs.get('keep_uint8', False)
+        self.dtype = np.uint8 if self.keep_uint8 else np.float32
+        self.cache = kwargs.get('cache', None)
         self.get_image_mode = get_image_mode
         self.transform_funcs = []
         self.is_spatial = True
         self.is_pair_process = False
 
+    def with_cache(self, max_bytes=1024 ** 3, disk_dir=None, target_size=None):
+        """Cache the decoded images (see `ImageCache`), the images are only decoded once across the epochs.
+
+        Args:
+            max_bytes (int): the capacity of the in-RAM LRU.
+            disk_dir (str): optional folder of the memory-mapped on-disk tier.
+            target_size (int or tuple): optional resize before caching, longest side or (height, width).
+
+        Returns:
+            the dataset self
+
+        """
+        self.cache = ImageCache(max_bytes=max_bytes, disk_dir=disk_dir, target_size=target_size)
+        return self
+
+    def _cast(self, img):
+        if self.keep_uint8 and img.dtype != np.uint8:
+            if img.dtype.kind == 'f' and img.size > 0 and img.max() <= 1.0:
+                img = img * 255.0
+            return np.clip(np.round(img), 0, 255).astype(np.uint8)
+        return img.astype(self.dtype)
+
+    @property
+    def deferred_normalize(self):
+        """With keep_uint8, the trailing normalize of transform_funcs, applied to the whole minibatch by the iterator."""
+        if self.keep_uint8 and len(self.transform_funcs) > 0 and self.transform_funcs[-1].__qualname__ == 'normalize.<locals>.img_op':
+            return self.transform_funcs[-1]
+        return None
+
     def __getitem__(self, index: int):
         img = self.list[index]  # self.pop(index)
         if isinstance(img, str) and self.get_image_mode == GetImageMode.path:
@@ -295,8 +348,15 @@ class ImageDataset(Dataset):
         elif self.get_image_mode == GetImageMode.path:
             return None
 
-        if isinstance(img, str):
+        if isinstance(img, str) and self.cache is None:
             img = image2array(img)
+        elif isinstance(img, str):
+            # the cache holds the compact decode read-only, the cast after retrieval is the private copy
+            img = self.cache.get(img, _image2array_compact, writable=False)
+            if img is not None and not self.keep_uint8:
+                img = img.astype(np.float32)
+            elif img is not None and (self.get_image_mode == GetImageMode.raw or self.object_type not in [ObjectType.gray, ObjectType.rgb, ObjectType.rgba, ObjectType.multi_channel]):
+                img = np.array(img)
 
         if self.get_image_mode == GetImageMode.raw:
             return img
@@ -304,20 +364,24 @@ class ImageDataset(Dataset):
             raise ValueError('image data should be ndarray')
         elif isinstance(img, np.ndarray) and img.ndim not in [2, 3]:
             raise ValueError('image data dimension  should be 2 or 3, but get {0}'.format(img.ndim))
+        elif self.object_type == ObjectType.gray and self.keep_uint8:
+            img = self._cast(img)
+            if img.ndim == 3:
+                img = cv2.cvtColor(img[:, :, :3], cv2.COLOR_RGB2GRAY)
         elif self.object_type == ObjectType.gray:
             img = color.rgb2gray(img).astype(self.dtype)
         elif self.object_type == ObjectType.rgb and img.ndim == 2:
-            img = np.repeat(np.expand_dims(img, -1), 3, -1).astype(self.dtype)
+            img = np.repeat(np.expand_dims(self._cast(img), -1), 3, -1)
         elif self.object_type == ObjectType.rgb and img.ndim == 3:
-            img = img[:, :, :3].astype(self.dtype)
+            img = self._cast(img[:, :, :3])
         elif self.object_type == ObjectType.rgba:
             if img.ndim == 2:
                 img = np.repeat(np.expand_dims(img, -1), 3, -1)
             if img.shape[2] == 3:
-                img = np.concatenate([img, np.ones((img.shape[0], img.shape[1], 1)) * 255], axis=-1)
-            img = img.astype(self.dtype)
+                img = np.concatenate([img, np.full((img.shape[0], img.shape[1], 1), 1.0 if img.dtype.kind == 'f' and img.max() <= 1.0 else 255, dtype=img.dtype)], axis=-1)
+            img = self._cast(img)
         elif self.object_type == ObjectType.multi_channel:
-            img = img.astype(self.dtype)
+            img = self._cast(img)
 
         if self.get_image_mode == GetImageMode.expect and self.is_pair_process == False:
             return image_backend_adaption(img)
@@ -329,16 +393,27 @@ class ImageDataset(Dataset):
         return None
 
     def data_transform(self, img_data):
+        if self.keep_uint8:
+            return self._uint8_transform(img_data)
         if len(self.transform_funcs) == 0:
             return image_backend_adaption(img_data)
         if isinstance(img_data, np.ndarray):
-            for fc in self.transform_funcs:
+            for fc in self.transform_plans.get(self.transform_funcs):
                 img_data = fc(img_data)
             img_data = image_backend_adaption(img_data)
             return img_data
         else:
             return img_data
 
+    def _uint8_transform(self, img_data):
+        if not isinstance(img_data, np.ndarray):
+            return img_data
+        funcs = self.transform_funcs[:-1] if self.deferred_normalize is not None else self.transform_funcs
+        # every geometric function goes through the warp, which keeps uint8
+        for fc in self.transform_plans.get(funcs, min_run=1):
+            img_data = fc(img_data)
+        return image_backend_adaption(img_data, dtype=np.uint8 if img_data.dtype == np.uint8 else np.float32)
+
     def image_transform(self, data):
         return self.data_transform(data)
 
@@ -448,10 +523,8 @@ class MaskDataset(Dataset):
             return mask_backend_adaptive(mask_data, label_mapping=self.class_names,object_type=self.object_type)
         else:
             if isinstance(mask_data, np.ndarray):
-                for fc in self.transform_funcs:
-                    if not fc.__qualname__.startswith(
-                            'random_') or 'crop' in fc.__qualname__ or 'rescale' in fc.__qualname__ or (
-                            fc.__qualname__.startswith('random_') and random.randint(0, 10) % 2 == 0):
+                for fc in self.transform_plans.get(self.transform_funcs, gate=should_apply):
+                    if should_apply(fc):
                         mask_data = fc(mask_data)
                 mask_data = mask_backend_adaptive(mask_data, label_mapping=self.class_names,object_type=self.object_type)
                 return mask_data
@@ -857,6 +930,9 @@ class Iterator(object):
         self.mode=mode
 
         self.workers = workers
+        self._use_multiprocessing = kwargs.get('use_multiprocessing', False)
+        self.use_shared_memory = kwargs.get('use_shared_memory', True)
+        self.seed = kwargs.get('seed', None)
         self.itr = 0
         if data is not None and isinstance(data, tuple):
             self._data = Dataset.zip(*data)
@@ -915,6 +991,8 @@ class Iterator(object):
 
         self._minibatch_size = minibatch_size
         self.paired_transform_funcs = []
+        self.batch_transform_funcs = []
+        self.device_transform_funcs = []
         self.batch_sampler = BatchSampler(self, self._minibatch_size, is_shuffle=self.is_shuffe, drop_last=False,mode=self.mode)
         self._sample_iter = iter(self.batch_sampler)
         self.buffer_size = buffer_size
@@ -974,6 +1052,29 @@ class Iterator(object):
         else:
             return None
 
+    @property
+    def use_multiprocessing(self):
+        """If True, minibatches are built by `workers` background workers with at most `buffer_size` batches prefetched.
+
+        With `use_shared_memory` (default True) the workers write every minibatch into a preallocated
+        shared-memory slab ring and the returned minibatches are views over it, they stay valid until
+        two more minibatches are fetched.
+
+        """
+        return self._use_multiprocessing
+
+    @use_multiprocessing.setter
+    def use_multiprocessing(self, value):
+        if self._use_multiprocessing != value:
+            self._use_multiprocessing = value
+            self.close()
+
+    def close(self):
+        """Shutdown the loader workers (if any), the next iteration will start a fresh minibatch stream."""
+        if inspect.isgenerator(self._sample_iter):
+            self._sample_iter.close()
+        self._sample_iter = iter(self.batch_sampler)
+
     @property
     def minibatch_size(self):
         return self._minibatch_size
@@ -985,6 +1086,17 @@ class Iterator(object):
         self.batch_sampler.sample_filter = self.sample_filter
         self._sample_iter = iter(self.batch_sampler)
 
+    @property
+    def paired_transform_funcs(self):
+        return self._paired_transform_funcs
+
+    @paired_transform_funcs.setter
+    def paired_transform_funcs(self, value):
+        self._paired_transform_funcs = value
+        if not hasattr(self, 'paired_transform_plans'):
+            self.paired_transform_plans = TransformPlanCache()
+        self.paired_transform_plans.clear()
+
     def update_signature(self, arg_names):
 
         if len(arg_names)!=len(self.datasets_dict):
@@ -1015,13 +1127,65 @@ class Iterator(object):
             return datadict
 
         # if img_data.ndim>=2:
-        for fc in self.paired_transform_funcs:
+        for fc in self.paired_transform_plans.get(self.paired_transform_funcs):
             try:
                 datadict = fc(datadict)
             except:
                 PrintException()
         return datadict
 
+    def batch_transform(self, fields):
+        """Apply batch_transform_funcs to the image fields of a collated minibatch (list of arrays in data_template order)."""
+        if len(self.batch_transform_funcs) == 0 or self.data_template is None:
+            return fields
+        channel_axis = 1 if get_backend() == 'pytorch' else -1
+        for i, spec in enumerate(self.data_template.key_list):
+            if i < len(fields) and spec.object_type in [ObjectType.rgb, ObjectType.rgba, ObjectType.gray] and isinstance(fields[i], np.ndarray) and fields[i].ndim == 4:
+                result = apply_batch_transform_funcs(fields[i], self.batch_transform_funcs, channel_axis=channel_axis)
+                if result.shape == fields[i].shape and result.dtype == fields[i].dtype and fields[i].flags.writeable:
+                    # keep writing into the collation buffer (ex. a shared memory slot)
+                    np.copyto(fields[i], result)
+                else:
+                    fields[i] = result
+        return fields
+
+    def deferred_normalizes(self):
+        """The normalize functions deferred by the uint8 image datasets, {TensorSpec: normalize}."""
+        results = OrderedDict()
+        if self.data_template is None:
+            return results
+        for spec in self.data_template.key_list:
+            fn = getattr(self.datasets_dict.get(spec.name), 'deferred_normalize', None)
+            if fn is not None:
+                results[spec] = fn
+        return results
+
+    def device_transform(self, batch):
+        """Apply device_transform_funcs to a minibatch (tuple or dict in data_template order) with batched tensor kernels,
+        then the normalize deferred by the uint8 image datasets (the queued minibatches stay uint8)."""
+        deferred = self.deferred_normalizes()
+        if len(self.device_transform_funcs) == 0 and len(deferred) == 0:
+            return batch
+        specs = self.data_template.key_list
+        fields = batch.value_list if isinstance(batch, dict) else list(batch)
+        results = OrderedDict(zip(specs, fields))
+        if len(self.device_transform_funcs) > 0:
+            if get_backend() != 'pytorch':
+                raise NotImplementedError('The device transform functions are only supported by the pytorch backend.')
+            results = device_transform(results, self.device_transform_funcs, gate=should_apply)
+        channel_axis = 1 if get_backend() == 'pytorch' else -1
+        for spec, fn in deferred.items():
+            if isinstance(results[spec], np.ndarray):
+                # one pass from uint8 to normalized float32
+                results[spec] = apply_batch_transform_funcs(results[spec], [batch_normalize(fn.mean, fn.std)], channel_axis=channel_axis)
+            else:
+                results[spec] = device_transform(results[spec], [fn], device=results[spec].device)
+        if isinstance(batch, dict):
+            for spec in specs:
+                batch[spec] = results[spec]
+            return batch
+        return tuple(results.value_list)
+
     def get_datasets(self):
         datasets = []
         if self._data and isinstance(self._data, Dataset) and not  isinstance(self._data, ZipDataset) and len(self._data) > 0:
@@ -1127,6 +1291,9 @@ class Iterator(object):
 
     # return a batch , do minimal fetch before return
     def next(self):
+        if self._use_multiprocessing:
+            # the worker pool already keeps buffer_size batches in flight
+            return self.device_transform(self._sample_iter.__next__())
         if self.out_queue.qsize() == 0:
             in_data = self._sample_iter.__next__()
             self.out_queue.put(in_data, False)
@@ -1138,7 +1305,7 @@ class Iterator(object):
                 in_data = self._sample_iter.__next__()
                 self.out_queue.put(in_data, False)
 
-        return out_data
+        return self.device_transform(out_data)
 
     # yield a batch , and trigger following fetch after yield
     def __next__(self):
@@ -1179,6 +1346,7 @@ class MetricIterator(Iterator):
             self._label = LabelDataset(labels=label)
         self._unpair = ImageDataset()
         self.workers = 2
+        self._use_multiprocessing = False
         self.itr = 0
 
         self._minibatch_size = minibatch_size
@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import numbers
+import os
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+__all__ = ['ImageCache']
+
+
+class ImageCache(object):
+    """Cache of decoded (pre-augmentation) images.
+
+    The first tier is an in-RAM LRU bounded by bytes, the optional second tier stores every decoded image as a
+    ``.npy`` file in ``disk_dir`` which is memory-mapped on read, so it survives the epochs (and the loader worker
+    processes, which each hold their own RAM tier). The entries are keyed by the absolute path, the modification
+    time of the file and the target size, an edited image is decoded again.
+
+    The cached arrays are read-only, `get` hands them out as is (a RAM entry or the memory-mapped file, no
+    copy) unless ``writable`` is set, then it returns a private copy that the transforms can modify. Cache the
+    compact decode (uint8) and cast it after retrieval, the cast being the private copy.
+
+    Args:
+        max_bytes (int): the capacity of the RAM tier, 0 disables it.
+        disk_dir (str): the folder of the on-disk tier, None disables it.
+        target_size (int or tuple): resize the decoded images before caching them, an int bounds the longest side
+            (the aspect ratio is kept), a (height, width) tuple is an exact size, None keeps the decoded size.
+
+    Examples:
+        >>> cache = ImageCache(max_bytes=1024 ** 2)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'a.png')
+        >>> _ = cv2.imwrite(path, np.zeros((4, 4, 3), np.uint8))
+        >>> loader = lambda p: cv2.imread(p)
+        >>> cache.get(path, loader).shape, cache.get(path, loader, writable=False).flags.writeable
+        ((4, 4, 3), False)
+        >>> cache.stats()['hits'], cache.stats()['misses']
+        (1, 1)
+
+    """
+
+    def __init__(self, max_bytes=1024 ** 3, disk_dir=None, target_size=None):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = disk_dir
+        self.target_size = target_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir is not None and not os.path.exists(self.disk_dir):
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _key(self, path):
+        path = os.path.abspath(path)
+        return '{0}|{1}|{2}'.format(path, os.stat(path).st_mtime_ns, self.target_size)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _resize(self, image):
+        if self.target_size is None or image is None:
+            return image
+        height, width = image.shape[:2]
+        if isinstance(self.target_size, numbers.Number):
+            scale = float(self.target_size) / max(height, width)
+            size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+        else:
+            size = (int(self.target_size[1]), int(self.target_size[0]))
+        if size == (width, height):
+            return image
+        resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA if size[0] < width else cv2.INTER_LINEAR)
+        return resized.reshape(resized.shape[:2] + image.shape[2:])
+
+    def _put(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            image.setflags(write=False)
+            self._entries[key] = image
+            self.current_bytes += image.nbytes
+            while self.current_bytes > self.max_bytes and len(self._entries) > 0:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def _write_disk(self, key, image):
+        disk_path = self._disk_path(key)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.disk_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(image))
+            # atomic, a concurrent reader sees the complete file or nothing
+            os.replace(tmp_path, disk_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, path, loader, writable=True):
+        """The decoded image of path, loader(path) is only called on a miss.
+
+        Args:
+            path (str): the image path.
+            loader (callable): the decoder, called with the path.
+            writable (bool): return a private copy, otherwise the read-only cached array (or memory-mapped file).
+
+        Returns:
+            the decoded image, None if the loader failed.
+
+        """
+        key = self._key(path)
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image.copy() if writable else image
+
+        if self.disk_dir is not None:
+            disk_path = self._disk_path(key)
+            if os.path.exists(disk_path):
+                try:
+                    image = np.load(disk_path, mmap_mode='r')
+                    with self._lock:
+                        self.disk_hits += 1
+                    if self.max_bytes > 0 and image.nbytes <= self.max_bytes:
+                        # promoted once to the RAM tier, the next hits do not read the file
+                        image = np.array(image)
+                        self._put(key, image)
+                        return image.copy() if writable else image
+                    return np.array(image) if writable else image
+                except (OSError, ValueError):
+                    pass
+
+        image = self._resize(loader(path))
+        if image is None:
+            return None
+        image = np.ascontiguousarray(image)
+        with self._lock:
+            self.misses += 1
+        if self.disk_dir is not None:
+            self._write_disk(key, image)
+        if self.max_bytes > 0 and image.nbytes <= self.max_bytes:
+            self._put(key, image)
+            return image.copy() if writable else image
+        return image
+
+    def stats(self):
+        """Hit/miss counters and the RAM tier usage."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return collections.OrderedDict([('hits', self.hits), ('disk_hits', self.disk_hits), ('misses', self.misses),
+                                            ('hit_rate', (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0),
+                                            ('evictions', self.evictions), ('entries', len(self._entries)),
+                                            ('bytes', self.current_bytes)])
+
+    def clear(self):
+        """Empty the RAM tier (the disk tier is kept)."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        stats = self.stats()
+        return 'ImageCache(entries={0}, bytes={1}, hits={2}, disk_hits={3}, misses={4})'.format(
+            stats['entries'], stats['bytes'], stats['hits'], stats['disk_hits'], stats['misses'])
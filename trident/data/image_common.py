@@ -36,7 +36,10 @@ __all__ = ['transform_func','read_image', 'read_mask', 'save_image', 'save_mask'
            'random_adjust_hue', 'random_channel_shift', 'random_cutout', 'random_rescale_crop', 'random_center_crop',
            'adjust_gamma','adjust_brightness_contrast', 'random_adjust_gamma', 'adjust_contrast', 'random_adjust_contrast', 'clahe',
            'erosion_then_dilation', 'dilation_then_erosion', 'image_erosion', 'image_dilation', 'adaptive_binarization',
-           'random_transform', 'horizontal_flip', 'random_mirror', 'to_low_resolution','random_erasing']
+           'random_transform', 'horizontal_flip', 'random_mirror', 'to_low_resolution','random_erasing',
+           'build_affine_matrix', 'fused_affine', 'compile_transform_funcs', 'TransformPlanCache', 'should_apply', 'batch_normalize',
+           'batch_adjust_gamma', 'batch_random_adjust_gamma', 'batch_random_adjust_contrast', 'batch_random_adjust_hue',
+           'batch_random_channel_shift', 'batch_add_noise', 'batch_random_erasing', 'apply_batch_transform_funcs']
 
 
 
@@ -180,6 +183,8 @@ def add_noise(intensity=0.1):
         image = np.clip(image + noise, orig_min, orig_max)
         return image
 
+    img_op.intensity = intensity
+    img_op.device_op = 'add_noise'
     return img_op
 
 
@@ -206,6 +211,7 @@ def normalize(mean, std):
 
     img_op.mean = mean
     img_op.std = std
+    img_op.device_op = 'normalize'
     return img_op
 
 
@@ -375,6 +381,19 @@ def resize(size, keep_aspect=True, order=1, align_corner=True):
                         im = im.astype(np.float32)
                         results[spec]= transform.resize(im, size, anti_aliasing=True, order=0 if im.ndim == 2 else order)
             return results
+
+    def affine(height, width):
+        if keep_aspect:
+            scale = builtins.min(size[0] / height, size[1] / width)
+            pad_top, pad_left = 0, 0
+            if not align_corner:
+                pad_top = int(np.floor((size[0] - height * scale) / 2))
+                pad_left = int(np.floor((size[1] - width * scale) / 2))
+            return build_affine_matrix((scale, scale), (0, 0), 0, (pad_left, pad_top)), tuple(size)
+        return build_affine_matrix((size[1] / width, size[0] / height), (0, 0), 0), tuple(size)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 
@@ -430,6 +449,13 @@ def rescale(scale, order=1):
             return results.value_list[0]
         elif isinstance(image, OrderedDict):
             return results
+
+    def affine(height, width):
+        new_h, new_w = int(round(height * scale)), int(round(width * scale))
+        return build_affine_matrix((new_w / width, new_h / height), (0, 0), 0), (new_h, new_w)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 def random_rescale_crop(h, w, scale=(0.5, 2), order=1):
@@ -456,6 +482,16 @@ def random_rescale_crop(h, w, scale=(0.5, 2), order=1):
         elif isinstance(image, OrderedDict):
             return results
 
+    crop_fn = random_crop(h, w)
+
+    def affine(height, width):
+        current_scale = np.random.uniform(scale[0], scale[1])
+        rescale_matrix, (new_h, new_w) = rescale(current_scale).affine(height, width)
+        crop_matrix, new_size = crop_fn.affine(new_h, new_w)
+        return np.dot(crop_matrix, rescale_matrix), new_size
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 
@@ -544,6 +580,22 @@ def random_center_crop(h,w, scale=(0.8, 1.2)):
         elif isinstance(image, OrderedDict):
             return results
 
+    def affine(height, width):
+        max_value = max(height, width)
+        i = int(round((max_value - height) / 2.))
+        j = int(round((max_value - width) / 2.))
+        current_scale = min(w / max_value, h / max_value) * np.random.choice(np.arange(scalemin, scalemax, 0.01))
+        img_op.scale = current_scale
+        resized = int(round(max_value * current_scale))
+        i1 = int(round((max(resized, h) - resized) / 2.))
+        j1 = int(round((max(resized, w) - resized) / 2.))
+        i2 = int(round((max(resized, h) - h) / 2.))
+        j2 = int(round((max(resized, w) - w) / 2.))
+        matrix = build_affine_matrix((current_scale, current_scale), (0, 0), 0, (j1 - j2, i1 - i2))
+        return np.dot(matrix, _translation_matrix(j, i)), (h, w)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 
@@ -619,6 +671,16 @@ def random_crop(h, w):
             return results.value_list[0]
         elif isinstance(image, OrderedDict):
             return results
+
+    def affine(height, width):
+        offset_x = random.choice(range(width - w)) if width > w else 0
+        offset_y = random.choice(range(height - h)) if height > h else 0
+        offset_x1 = random.choice(range(w - width)) if w > width else 0
+        offset_y1 = random.choice(range(h - height)) if h > height else 0
+        return _translation_matrix(offset_x1 - offset_x, offset_y1 - offset_y), (h, w)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 
@@ -633,6 +695,21 @@ def random_transform(rotation_range= 15, zoom_range= 0.02, shift_range= 0.02,she
     shift_x = np.random.uniform(-shift_range, shift_range) if shift_range != 0 else 0
     shift_y = np.random.uniform(-shift_range, shift_range)  if shift_range != 0 else 0
     rr = np.random.random()
+
+    def rotation_matrix(height, width):
+        img_op.tx = int(shift_x* width)
+        img_op.ty = int(shift_y* height )
+        mat = cv2.getRotationMatrix2D((width // 2+img_op.tx, height // 2+img_op.ty), rotation,1)
+        #mat[:, 2] += (tx, ty)
+
+        cos = np.abs(mat[0, 0])
+        sin = np.abs(mat[0, 1])
+        new_W = int((height * sin) + (width * cos))
+        new_H = int((height * cos) + (width * sin))
+        mat[0, 2] += (new_W / 2) - width // 2
+        mat[1, 2] += (new_H / 2) - height // 2
+        return mat
+
     def img_op(image: Union[np.ndarray,Dict[TensorSpec,np.ndarray]],**kwargs):
         results = None
         if isinstance(image, np.ndarray):
@@ -651,17 +728,7 @@ def random_transform(rotation_range= 15, zoom_range= 0.02, shift_range= 0.02,she
         elif isinstance(image, OrderedDict):
             height, width = image.value_list[0].shape[:2]
 
-        img_op.tx = int(shift_x* width)
-        img_op.ty = int(shift_y* height )
-        mat = cv2.getRotationMatrix2D((width // 2+img_op.tx, height // 2+img_op.ty), rotation,1)
-        #mat[:, 2] += (tx, ty)
-
-        cos = np.abs(mat[0, 0])
-        sin = np.abs(mat[0, 1])
-        new_W = int((height * sin) + (width * cos))
-        new_H = int((height * cos) + (width * sin))
-        mat[0, 2] += (new_W / 2) - width // 2
-        mat[1, 2] += (new_H / 2) - height // 2
+        mat = rotation_matrix(height, width)
         mat_img = mat.copy()
         mat_box = mat.copy()
 
@@ -750,6 +817,17 @@ def random_transform(rotation_range= 15, zoom_range= 0.02, shift_range= 0.02,she
             return results.value_list[0]
         elif isinstance(image, OrderedDict):
             return results
+
+    def affine(height, width):
+        matrix = np.concatenate([rotation_matrix(height, width), [[0, 0, 1]]], axis=0)
+        if rr < random_flip:
+            matrix = np.dot(build_affine_matrix((-1.0, 1.0), (0, 0), 0, (width, 0)), matrix)
+        return matrix, (height, width)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
+    # the uncovered area of the images is white, as in the warpAffine above
+    img_op.border_value = (255, 255, 255)
     return img_op
 
 
@@ -801,6 +879,11 @@ def horizontal_flip():
         elif isinstance(image, OrderedDict):
             return results
 
+    def affine(height, width):
+        return build_affine_matrix((-1.0, 1.0), (0, 0), 0, (width, 0)), (height, width)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 
@@ -813,6 +896,14 @@ def random_mirror():
         else:
             return image
 
+    def affine(height, width):
+        img_op.rnd = random.randint(0, 10)
+        if img_op.rnd % 2 == 0:
+            return fn.affine(height, width)
+        return np.eye(3), (height, width)
+
+    img_op.affine = affine
+    img_op.device_op = 'affine'
     return img_op
 
 
@@ -984,6 +1075,8 @@ def adjust_gamma(gamma=1):
     def img_op(image: np.ndarray,**kwargs):
         return exposure.adjust_gamma(image/255.0, gamma)*255.0
 
+    img_op.gamma = gamma
+    img_op.device_op = 'adjust_gamma'
     return img_op
 
 
@@ -1001,6 +1094,8 @@ def random_adjust_gamma(gamma=(0.6, 1.4)):
         gamma = np.random.choice(np.arange(gammamin, gammamax, 0.01))
         return exposure.adjust_gamma(image/255.0, gamma)*255.0
 
+    img_op.gamma_range = gamma_range
+    img_op.device_op = 'random_adjust_gamma'
     return img_op
 
 
@@ -1013,6 +1108,8 @@ def adjust_contrast(alpha=1):
             image=image * 255 / (image.max())
         return image.astype(np.float32)
 
+    img_op.alpha = alpha
+    img_op.device_op = 'adjust_contrast'
     return img_op
 
 
@@ -1028,6 +1125,8 @@ def random_adjust_contrast(scale=(0.5, 1.5)):
             image=image*255.0/(image.max())
         return image.astype(np.float32)
 
+    img_op.scale_range = scale
+    img_op.device_op = 'random_adjust_contrast'
     return img_op
 
 
@@ -1061,6 +1160,10 @@ def random_adjust_hue(hue_range=(-20, 20), saturation_range=(0.5, 1.5), lightnes
             image=image* 255.0/image.max()
         return np.clip(image.astype(np.float32),0,255)
 
+    img_op.hue_range = hue_range
+    img_op.saturation_range = saturation_range
+    img_op.lightness_range = lightness_range
+    img_op.device_op = 'random_adjust_hue'
     return img_op
 
 
@@ -1079,19 +1182,21 @@ def auto_level():
 
 
 
-def image_backend_adaption(image):
+def image_backend_adaption(image, dtype=np.float32):
+    """Convert a HWC (or NHWC) image to the layout of the backend, dtype=None keeps the dtype of the image."""
+    dtype = image.dtype if dtype is None else dtype
     if  get_backend() == 'tensorflow':
         if image.ndim==2: #gray-scale image
-            image=np.expand_dims(image,-1).astype(np.float32)
+            image=np.expand_dims(image,-1).astype(dtype)
         elif image.ndim in (3,4):
-            image=image.astype(np.float32)
+            image=image.astype(dtype)
     else:
         if image.ndim==2: #gray-scale image
-            image=np.expand_dims(image,0).astype(np.float32)
+            image=np.expand_dims(image,0).astype(dtype)
         elif image.ndim==3:
-            image = np.transpose(image, [2, 0, 1]).astype(np.float32)
+            image = np.transpose(image, [2, 0, 1]).astype(dtype)
         elif image.ndim==4:
-            image = np.transpose(image, [0, 3, 1, 2]).astype(np.float32)
+            image = np.transpose(image, [0, 3, 1, 2]).astype(dtype)
     return image
 
 
@@ -1116,6 +1221,8 @@ def random_channel_shift(intensity=0.15):
         x = np.rollaxis(x, 0, channel_axis + 1)
         return x
 
+    img_op.intensity = inten
+    img_op.device_op = 'random_channel_shift'
     return img_op
 
 
@@ -1158,9 +1265,216 @@ def random_erasing(size_range=(0.02,0.3),transparency_range=(0.4,0.8),transparan
 
         return image
 
+    img_op.size_range = size_range
+    img_op.transparency_range = transparency_range
+    img_op.transparancy_ratio = transparancy_ratio
+    img_op.device_op = 'random_erasing'
     return img_op
 
 
+# Batch transform functions: every function receives the whole minibatch of images (N,H,W,C) in [0, 255], either
+# float or uint8, and draws its random parameters per sample. They run once per minibatch after the collation.
+
+def _sample_flat(images):
+    return images.reshape(images.shape[0], -1)
+
+
+def _batch_selection(num_samples, prob):
+    """Per-sample coin flips, True for the samples the random op is applied to."""
+    return np.random.random(num_samples) < prob
+
+
+def _apply_lut(images, tables):
+    """Map uint8 images through one 256 entries lookup table per sample."""
+    results = np.empty_like(images)
+    for n in range(images.shape[0]):
+        results[n] = cv2.LUT(images[n], tables[n]).reshape(images.shape[1:])
+    return results
+
+
+def _apply_curve(images, curve):
+    """Apply a per-sample intensity curve ``curve(values, index)``, values broadcast against (N,1,1,1) parameters.
+
+    uint8 images go through a lookup table built for the 256 levels of every sample, other images are computed
+    with one broadcasted expression.
+
+    """
+    if images.dtype == np.uint8:
+        levels = np.arange(256, dtype=np.float32)[None, :]
+        tables = np.clip(np.round(curve(levels, (slice(None), None))), 0, 255).astype(np.uint8)
+        return _apply_lut(images, np.broadcast_to(tables, (images.shape[0], 256)))
+    return curve(images.astype(np.float32), (slice(None), None, None, None)).astype(np.float32)
+
+
+def batch_normalize(mean, std):
+    def batch_op(images: np.ndarray,**kwargs):
+        norm_mean = np.reshape(np.array(mean, dtype=np.float32), (1, 1, 1, -1)) if not isinstance(mean, numbers.Number) else np.float32(mean)
+        norm_std = np.reshape(np.array(std, dtype=np.float32), (1, 1, 1, -1)) if not isinstance(std, numbers.Number) else np.float32(std)
+        # uint8 images are converted within the subtraction
+        results = np.subtract(images, norm_mean, dtype=np.float32)
+        results *= np.float32(1.0) / norm_std
+        return results
+
+    batch_op.mean = mean
+    batch_op.std = std
+    return batch_op
+
+
+def batch_adjust_gamma(gamma=1):
+    def batch_op(images: np.ndarray,**kwargs):
+        return _apply_curve(images, lambda x, axes: 255.0 * np.power(np.clip(x, 0, 255) / 255.0, gamma))
+
+    return batch_op
+
+
+def batch_random_adjust_gamma(gamma=(0.6, 1.4), prob=0.5):
+    gammamin, gammamax = gamma
+
+    def batch_op(images: np.ndarray,**kwargs):
+        num_samples = images.shape[0]
+        avg_pix = _sample_flat(images).mean(-1)
+        # bright images are only darkened, dark images are only brightened
+        low = np.where(avg_pix < 30, builtins.min(1, gammamax), gammamin)
+        high = np.where(avg_pix > 220, builtins.max(gammamin, 1), gammamax)
+        gammas = np.random.uniform(low, high)
+        gammas = np.where(_batch_selection(num_samples, prob), gammas, 1.0).astype(np.float32)
+        return _apply_curve(images, lambda x, axes: 255.0 * np.power(np.clip(x, 0, 255) / 255.0, gammas[axes]))
+
+    return batch_op
+
+
+def batch_random_adjust_contrast(scale=(0.5, 1.5), prob=0.5):
+    scalemin, scalemax = scale
+
+    def batch_op(images: np.ndarray,**kwargs):
+        num_samples = images.shape[0]
+        alphas = np.random.uniform(scalemin, scalemax, num_samples)
+        alphas = np.where(_batch_selection(num_samples, prob), alphas, 1.0)
+        max_pix = np.clip(_sample_flat(images).max(-1).astype(np.float32), 1e-8, 255.0)
+        # the samples exceeding 255 after scaling are rescaled to 255
+        alphas = np.minimum(alphas, 255.0 / max_pix).astype(np.float32)
+        return _apply_curve(images, lambda x, axes: np.clip(x, 0, 255) * alphas[axes])
+
+    return batch_op
+
+
+def batch_random_adjust_hue(hue_range=(-20, 20), saturation_range=(0.5, 1.5), lightness_range=(-50, 50), prob=0.5):
+    def batch_op(images: np.ndarray,**kwargs):
+        num_samples, height, width, channels = images.shape
+        if channels != 3:
+            return images
+        selected = _batch_selection(num_samples, prob)
+        if not selected.any():
+            return images
+        hue_offset = np.where(selected, np.random.uniform(*hue_range, size=num_samples), 0).reshape(-1, 1, 1).astype(np.float32)
+        saturation_offset = np.where(selected, np.random.uniform(*saturation_range, size=num_samples), 1).reshape(-1, 1, 1).astype(np.float32)
+        lightness_offset = np.where(selected, np.random.uniform(*lightness_range, size=num_samples), 0).reshape(-1, 1, 1).astype(np.float32)
+
+        # the minibatch is converted as a single (N*H, W, 3) image
+        hsv = cv2.cvtColor(np.clip(images.astype(np.float32) / 255.0, 0, 1).reshape(num_samples * height, width, 3), cv2.COLOR_RGB2HSV)
+        hsv = hsv.reshape(num_samples, height, width, 3)
+        hsv[..., 0] = np.mod(hsv[..., 0] + hue_offset, 360.0)
+        hsv[..., 1] = np.clip(hsv[..., 1] * saturation_offset, 0, 1)
+        hsv[..., 2] = np.clip(hsv[..., 2] + lightness_offset / 255.0, 0, 1)
+        results = cv2.cvtColor(hsv.reshape(num_samples * height, width, 3), cv2.COLOR_HSV2RGB).reshape(images.shape) * 255.0
+        if images.dtype == np.uint8:
+            return np.clip(np.round(results), 0, 255).astype(np.uint8)
+        return results.astype(np.float32)
+
+    return batch_op
+
+
+def batch_random_channel_shift(intensity=0.15, prob=0.5):
+    def batch_op(images: np.ndarray,**kwargs):
+        num_samples, channels = images.shape[0], images.shape[-1]
+        flat = _sample_flat(images).astype(np.float32)
+        min_x = flat.min(-1).reshape(-1, 1, 1, 1)
+        max_x = flat.max(-1).reshape(-1, 1, 1, 1)
+        shifts = np.random.uniform(-intensity, intensity, (num_samples, 1, 1, channels)) * max_x
+        shifts = shifts * _batch_selection(num_samples, prob).reshape(-1, 1, 1, 1)
+        results = np.clip(images.astype(np.float32) + shifts.astype(np.float32), min_x, max_x)
+        return results.astype(images.dtype) if images.dtype == np.uint8 else results
+
+    return batch_op
+
+
+def batch_add_noise(intensity=0.1, prob=0.5):
+    def batch_op(images: np.ndarray,**kwargs):
+        num_samples = images.shape[0]
+        selected = np.nonzero(_batch_selection(num_samples, prob))[0]
+        if len(selected) == 0:
+            return images
+        results = images.astype(np.float32)
+        flat = _sample_flat(results[selected])
+        orig_min = flat.min(-1).reshape(-1, 1, 1, 1)
+        orig_max = flat.max(-1).reshape(-1, 1, 1, 1)
+        noise = np.random.standard_normal(results[selected].shape).astype(np.float32)
+        # half of the noisy samples get uniform noise instead of gaussian noise
+        uniform = np.random.random(len(selected)) < 0.5
+        if uniform.any():
+            noise[uniform] = np.random.uniform(-1, 1, (int(uniform.sum()),) + results.shape[1:])
+        results[selected] = np.clip(results[selected] + noise * (intensity * (orig_max - orig_min)), orig_min, orig_max)
+        return np.round(results).astype(np.uint8) if images.dtype == np.uint8 else results
+
+    return batch_op
+
+
+def batch_random_erasing(size_range=(0.02, 0.3), transparency_range=(0.4, 0.8), transparancy_ratio=0.5, prob=0.5):
+    def batch_op(images: np.ndarray,**kwargs):
+        num_samples, height, width, channels = images.shape
+        selected = _batch_selection(num_samples, prob)
+        if not selected.any():
+            return images
+        area = np.random.uniform(size_range[0], size_range[1], num_samples) * height * width / 4.0
+        ratio = np.random.uniform(0.3, 1 / 0.3, num_samples)
+        erase_w = np.clip(np.sqrt(area / ratio).astype(np.int64), 1, width)
+        erase_h = np.clip(np.sqrt(area * ratio).astype(np.int64), 1, height)
+        left = (np.random.random(num_samples) * (width - erase_w + 1)).astype(np.int64)
+        top = (np.random.random(num_samples) * (height - erase_h + 1)).astype(np.int64)
+
+        rows = np.arange(height).reshape(1, -1, 1, 1)
+        cols = np.arange(width).reshape(1, 1, -1, 1)
+        mask = (rows >= top.reshape(-1, 1, 1, 1)) & (rows < (top + erase_h).reshape(-1, 1, 1, 1)) & \
+               (cols >= left.reshape(-1, 1, 1, 1)) & (cols < (left + erase_w).reshape(-1, 1, 1, 1)) & selected.reshape(-1, 1, 1, 1)
+
+        # the erased region is either faded, filled with noise or filled with a constant
+        transparent = np.random.random(num_samples) <= transparancy_ratio
+        transparency = np.where(transparent, np.random.uniform(*transparency_range, size=num_samples), 0).reshape(-1, 1, 1, 1)
+        fill = np.random.uniform(0, 255, (num_samples, 1, 1, 1))
+        noisy = np.nonzero(~transparent & selected & (np.random.random(num_samples) < 0.5))[0]
+
+        results = images.astype(np.float32)
+        erased = np.where(transparent.reshape(-1, 1, 1, 1), results * transparency, fill).astype(np.float32)
+        if len(noisy) > 0:
+            erased[noisy] = np.random.uniform(0, 255, (len(noisy), height, width, channels))
+        results = np.where(mask, erased, results)
+        return np.round(results).astype(np.uint8) if images.dtype == np.uint8 else results
+
+    return batch_op
+
+
+def apply_batch_transform_funcs(images, funcs, channel_axis=-1):
+    """Apply the batch transform functions to a minibatch of images.
+
+    Args:
+        images (ndarray): the minibatch, (N,H,W,C) or (N,C,H,W) with ``channel_axis=1``.
+        funcs (list): the batch transform functions.
+        channel_axis (int): the channel axis of images, the result keeps the same layout.
+
+    Examples:
+        >>> apply_batch_transform_funcs(np.full((2, 3, 4, 4), 255, dtype=np.uint8), [batch_normalize(127.5, 127.5)], channel_axis=1).shape
+        (2, 3, 4, 4)
+
+    """
+    if len(funcs) == 0 or images.ndim != 4:
+        return images
+    channel_last = channel_axis in (-1, 3)
+    results = images if channel_last else np.transpose(images, (0, 2, 3, 1))
+    for fc in funcs:
+        results = fc(results)
+    return results if channel_last else np.ascontiguousarray(np.transpose(results, (0, 3, 1, 2)))
+
+
 def random_cutout(img, mask):
     h, w = img.shape[:2] if get_backend() == 'tensorflow' or len(img.shape) == 2 else img.shape[1:3]
     cutx = random.choice(range(0, w // 4))
@@ -1373,6 +1687,217 @@ def build_affine_matrix(s, c, rad, t=(0, 0)):
     return M
 
 
+def _translation_matrix(tx, ty):
+    return build_affine_matrix((1.0, 1.0), (0, 0), 0, (tx, ty))
+
+
+def should_apply(fn):
+    """Whether a transform function is applied to the current sample, the random_* functions (but the crops and the
+    rescales) are only applied to half of the samples."""
+    name = fn.__qualname__
+    return not name.startswith('random_') or 'crop' in name or 'rescale' in name or random.randint(0, 10) % 2 == 0
+
+
+def _warp_image(im, matrix, size, interpolation=cv2.INTER_LINEAR, border_value=0):
+    """Warp an image with a matrix expressed in the bbox coordinates (pixel corners), a strong downscale is first
+    area-resized to avoid aliasing, the uncovered area is filled with border_value."""
+    height, width = im.shape[:2]
+    squeeze = im.ndim == 3 and im.shape[-1] == 1
+    if squeeze:
+        im = im[:, :, 0]
+    dtype = im.dtype
+    if interpolation == cv2.INTER_NEAREST:
+        if dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+            im = im.astype(np.float32)
+    else:
+        # uint8 images stay uint8
+        if dtype != np.uint8:
+            im = im.astype(np.float32)
+        current_scale = np.sqrt(np.abs(np.linalg.det(matrix[:2, :2])))
+        if current_scale < 0.5:
+            new_h, new_w = max(int(round(height * current_scale)), 1), max(int(round(width * current_scale)), 1)
+            im = cv2.resize(im, (new_w, new_h), interpolation=cv2.INTER_AREA)
+            matrix = np.dot(matrix, np.diag([width / new_w, height / new_h, 1.0]))
+    # cv2 maps pixel centers
+    matrix = np.dot(_translation_matrix(-0.5, -0.5), np.dot(matrix, _translation_matrix(0.5, 0.5)))
+    new_im = cv2.warpAffine(im, matrix[:2], (int(size[1]), int(size[0])), flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+    if new_im.ndim == 2 and im.ndim == 3:
+        new_im = new_im[:, :, None]
+    if interpolation == cv2.INTER_NEAREST:
+        new_im = new_im.astype(dtype)
+    if squeeze:
+        new_im = new_im[:, :, None]
+    return new_im
+
+
+def _warp_boxes(boxes, matrix, size):
+    """Transform the 4 corners of the boxes, take their bounding box, clip it and drop the empty ones."""
+    class_info = boxes[:, 4:]
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    corners = np.stack([np.stack([x1, y1], -1), np.stack([x2, y1], -1), np.stack([x1, y2], -1), np.stack([x2, y2], -1)], 1)
+    corners = np.dot(corners, matrix[:2, :2].T) + matrix[:2, 2]
+    new_boxes = np.concatenate([corners.min(1), corners.max(1)], -1)
+    new_boxes[:, 0::2] = np.clip(new_boxes[:, 0::2], 0, size[1])
+    new_boxes[:, 1::2] = np.clip(new_boxes[:, 1::2], 0, size[0])
+    area = (new_boxes[:, 3] - new_boxes[:, 1]) * (new_boxes[:, 2] - new_boxes[:, 0])
+    return np.concatenate([new_boxes, class_info], -1)[area > 0].astype(boxes.dtype)
+
+
+def _warp_points(points, matrix):
+    """Transform landmarks stored as (n, 2) or (n, 2 * k) arrays."""
+    num_coords = 2 * (points.shape[-1] // 2)
+    new_points = points.astype(np.float32) if points.dtype.kind != 'f' else points.copy()
+    coords = new_points[:, :num_coords].reshape(-1, 2)
+    new_points[:, :num_coords] = (np.dot(coords, matrix[:2, :2].T) + matrix[:2, 2]).reshape(len(points), num_coords)
+    return new_points
+
+
+def fused_affine(ops, gate=None):
+    """Apply a chain of geometric transform functions as a single affine warp.
+
+    Every op exposes ``affine(height, width)`` which samples its random parameters and returns its 3x3 matrix
+    (in pixel-corner coordinates) and its output size. The matrices are multiplied, so the images are resampled
+    once (``cv2.warpAffine``, nearest neighbour for the masks), and the boxes and landmarks are transformed with
+    a single matrix product. The uncovered area of the images is filled with the ``border_value`` of the last
+    applied op declaring one (white for random_transform), black otherwise, the masks are filled with zero.
+
+    Args:
+        ops (list): the geometric transform functions (resize, rescale, random_rescale_crop, random_center_crop,
+            random_crop, random_transform, horizontal_flip, random_mirror).
+        gate (callable): called with every op on every sample, the op is skipped when it returns False
+            (ex. `should_apply`).
+
+    Examples:
+        >>> op = fused_affine([rescale(0.5), horizontal_flip()])
+        >>> op(np.ones((64, 32, 3))).shape
+        (32, 16, 3)
+
+    """
+    def img_op(image: Union[np.ndarray,Dict[TensorSpec,np.ndarray]],**kwargs):
+        results = None
+        if isinstance(image, np.ndarray):
+            imspec = kwargs.get("spec")
+            if imspec is None:
+                imspec = TensorSpec(shape=to_tensor(image.shape), object_type=object_type_inference(image))
+            results = OrderedDict()
+            results[imspec] = image
+        elif isinstance(image, dict):
+            results = image
+
+        height, width = None, None
+        for spec, im in results.items():
+            if im is not None and spec.object_type not in [ObjectType.absolute_bbox, ObjectType.relative_bbox, ObjectType.landmarks]:
+                height, width = im.shape[:2]
+                break
+
+        matrix = np.eye(3)
+        size = (height, width)
+        border_value = 0
+        for op in ops:
+            if gate is None or gate(op):
+                op_matrix, size = op.affine(*size)
+                matrix = np.dot(op_matrix, matrix)
+                border_value = getattr(op, 'border_value', border_value)
+        img_op.matrix = matrix
+        img_op.size = size
+
+        for spec, im in results.items():
+            if spec.is_spatial == True:
+                if im is None:
+                    pass
+                elif spec.object_type in [ObjectType.absolute_bbox]:
+                    results[spec] = _warp_boxes(im, matrix, size)
+                elif spec.object_type in [ObjectType.relative_bbox]:
+                    im = im.astype(np.float32)
+                    im[:, 0:4:2] *= width
+                    im[:, 1:4:2] *= height
+                    im = _warp_boxes(im, matrix, size)
+                    im[:, 0:4:2] /= size[1]
+                    im[:, 1:4:2] /= size[0]
+                    results[spec] = im
+                elif spec.object_type in [ObjectType.landmarks]:
+                    results[spec] = _warp_points(im, matrix)
+                elif spec.object_type in [ObjectType.binary_mask, ObjectType.label_mask, ObjectType.color_mask]:
+                    results[spec] = _warp_image(im, matrix, size, cv2.INTER_NEAREST)
+                else:
+                    results[spec] = _warp_image(im, matrix, size, cv2.INTER_LINEAR, border_value)
+        if isinstance(image, np.ndarray):
+            return results.value_list[0]
+        else:
+            return results
+
+    img_op.ops = ops
+    return img_op
+
+
+def compile_transform_funcs(funcs, gate=None, min_run=2):
+    """Replace every run of consecutive geometric transform functions by one `fused_affine`.
+
+    The functions without an ``affine`` attribute and the runs shorter than min_run are kept as they are.
+
+    Args:
+        funcs (list): the transform functions.
+        gate (callable): passed to `fused_affine`.
+        min_run (int): the minimum number of consecutive geometric functions to fuse, 1 routes every geometric
+            function through the warp (which keeps uint8 images uint8).
+
+    Returns:
+        the compiled list of transform functions.
+
+    Examples:
+        >>> funcs = compile_transform_funcs([rescale(0.5), random_crop(16, 16), normalize(0, 255)])
+        >>> [fn.__qualname__ for fn in funcs]
+        ['fused_affine.<locals>.img_op', 'normalize.<locals>.img_op']
+
+    """
+    compiled = []
+    run = []
+    for fn in list(funcs) + [None]:
+        if fn is not None and hasattr(fn, 'affine'):
+            run.append(fn)
+            continue
+        if len(run) >= min_run:
+            compiled.append(fused_affine(run, gate=gate))
+        else:
+            compiled.extend(run)
+        run = []
+        if fn is not None:
+            compiled.append(fn)
+    return compiled
+
+
+class TransformPlanCache(object):
+    """The plans of `compile_transform_funcs`, compiled once and reused for every sample.
+
+    The owner of the transform functions calls `clear` in their setter. A plan is also compiled again when the
+    list it was compiled from has been modified in place.
+
+    Examples:
+        >>> plans = TransformPlanCache()
+        >>> funcs = [rescale(0.5), random_crop(16, 16), normalize(0, 255)]
+        >>> plans.get(funcs) is plans.get(funcs)
+        True
+        >>> [fn.__qualname__ for fn in plans.get(funcs, min_run=3)]
+        ['rescale.<locals>.img_op', 'random_crop.<locals>.img_op', 'normalize.<locals>.img_op']
+
+    """
+    def __init__(self):
+        self._plans = {}
+
+    def get(self, funcs, **kwargs):
+        """The compiled list of funcs, kwargs are passed to `compile_transform_funcs`."""
+        funcs = tuple(funcs)
+        key = tuple(sorted(kwargs.items(), key=lambda item: item[0]))
+        entry = self._plans.get(key)
+        if entry is None or entry[0] != funcs:
+            entry = (funcs, compile_transform_funcs(funcs, **kwargs))
+            self._plans[key] = entry
+        return entry[1]
+
+    def clear(self):
+        self._plans = {}
+
+
 
 
 def to_low_resolution(scale=2):
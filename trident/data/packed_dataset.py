@@ -0,0 +1,275 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import numbers
+import os
+import pickle
+
+import cv2
+import numpy as np
+
+from trident.backend.tensorspec import ObjectType
+from trident.data.dataset import Dataset, ImageDataset, MaskDataset, LabelDataset, BboxDataset, LandmarkDataset, ZipDataset, Iterator
+
+__all__ = ['pack_dataset', 'PackedDataset', 'PackedImageDataset']
+
+_MAX_NDIM = 4
+_index_dtype = np.dtype([('shard', np.int32), ('offset', np.int64), ('length', np.int64)])
+_dataset_classes = {'ImageDataset': ImageDataset, 'MaskDataset': MaskDataset, 'LabelDataset': LabelDataset,
+                    'BboxDataset': BboxDataset, 'LandmarkDataset': LandmarkDataset}
+_image_like_types = [ObjectType.rgb, ObjectType.rgba, ObjectType.gray, ObjectType.multi_channel, ObjectType.label_mask,
+                     ObjectType.binary_mask, ObjectType.alpha_mask, ObjectType.color_mask]
+
+
+def _source_datasets(source):
+    """The datasets of a data provider, an iterator or a (zipped) dataset, in the minibatch order."""
+    if isinstance(source, Iterator):
+        return source.get_datasets()
+    if isinstance(source, ZipDataset):
+        return list(source._datasets)
+    if isinstance(source, Dataset):
+        return [source]
+    if getattr(source, 'traindata', None) is not None:
+        return source.traindata.get_datasets()
+    raise ValueError('pack_dataset expects a data provider, an iterator or a dataset.')
+
+
+def _encode(item, object_type, encode, quality):
+    """The (kind, bytes, shape, dtype) record of a raw sample."""
+    if isinstance(item, str) and os.path.isfile(item) and object_type in _image_like_types:
+        # the original file bytes, no decode and no quality loss
+        with open(item, 'rb') as f:
+            return 'file', f.read(), (), None
+    if isinstance(item, np.ndarray) and item.dtype.kind not in 'OSU':
+        if encode is not None and object_type in _image_like_types and item.dtype == np.uint8 and item.ndim in (2, 3):
+            image = item
+            if image.ndim == 3 and image.shape[-1] in (3, 4):
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR if image.shape[-1] == 3 else cv2.COLOR_RGBA2BGRA)
+            params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)] if encode in ('jpg', 'jpeg') else []
+            success, buffer = cv2.imencode('.' + encode, image, params)
+            if success:
+                return 'encoded', buffer.tobytes(), (), None
+        item = np.ascontiguousarray(item)
+        return 'array', item.tobytes(), item.shape, item.dtype.str
+    if isinstance(item, (numbers.Number, np.number, np.bool_)):
+        item = np.asarray(item)
+        return 'array', item.tobytes(), item.shape, item.dtype.str
+    return 'pickle', pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL), (), None
+
+
+def pack_dataset(data_provider, path, encode=None, quality=95, shard_bytes=1024 ** 3):
+    """Pack the raw samples of a data provider into a sharded, indexed container for `PackedDataset`.
+
+    Every field of a sample is stored as one record, the records of a sample are contiguous and the samples are
+    written in order into shards of about shard_bytes, so an epoch is a sequential read of a few large files
+    instead of many small random reads. The image and mask files are stored as their original encoded bytes, the
+    in-memory images as raw uint8 (or encoded with ``encode``), the other arrays (labels, boxes, landmarks) as raw
+    bytes, and anything else pickled.
+
+    The container is a folder with ``meta.json``, ``index.npy`` (shard, offset and length of every record),
+    ``shapes.npy`` (the shape of every raw array record) and the ``shard-*.bin`` files.
+
+    Args:
+        data_provider: an ImageDataProvider (its training data), an Iterator or a Dataset.
+        path (str): the destination folder.
+        encode (str): 'png' or 'jpg' to encode the in-memory uint8 images and masks, None to keep them raw.
+        quality (int): the jpeg quality.
+        shard_bytes (int): the approximate size of a shard.
+
+    Returns:
+        the path of the container
+
+    """
+    datasets = [ds for ds in _source_datasets(data_provider) if len(ds) > 0]
+    if len(datasets) == 0:
+        raise ValueError('There is no sample to pack.')
+    num_samples = min([len(ds) for ds in datasets])
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    index = np.zeros((num_samples, len(datasets)), dtype=_index_dtype)
+    shapes = np.full((num_samples, len(datasets), _MAX_NDIM), -1, dtype=np.int32)
+    fields = []
+    for ds in datasets:
+        class_names = getattr(ds, 'class_names', None)
+        try:
+            json.dumps(class_names)
+        except TypeError:
+            class_names = None
+        fields.append({'symbol': ds.symbol, 'dataset': ds.__class__.__name__,
+                       'object_type': ds.object_type.value if ds.object_type is not None else None,
+                       'class_names': class_names, 'kinds': [], 'dtype': None})
+
+    shard_id, shard_size = 0, 0
+    shard = open(os.path.join(path, 'shard-{0:05d}.bin'.format(shard_id)), 'wb')
+    try:
+        for i in range(num_samples):
+            if shard_size >= shard_bytes:
+                shard.close()
+                shard_id, shard_size = shard_id + 1, 0
+                shard = open(os.path.join(path, 'shard-{0:05d}.bin'.format(shard_id)), 'wb')
+            for j, ds in enumerate(datasets):
+                object_type = ds.object_type
+                kind, data, shape, dtype = _encode(ds.list[i], object_type, encode, quality)
+                if len(shape) > _MAX_NDIM:
+                    kind, data, shape, dtype = 'pickle', pickle.dumps(np.asarray(ds.list[i])), (), None
+                if kind not in fields[j]['kinds']:
+                    fields[j]['kinds'].append(kind)
+                if dtype is not None:
+                    if fields[j]['dtype'] is not None and fields[j]['dtype'] != dtype:
+                        raise ValueError('The samples of {0} have different dtypes ({1}, {2}).'.format(ds.symbol, fields[j]['dtype'], dtype))
+                    fields[j]['dtype'] = dtype
+                index[i, j] = (shard_id, shard_size, len(data))
+                shapes[i, j, :len(shape)] = shape
+                # the kind of the record is stored in the unused shape slots: -2 encoded, -3 pickled
+                if kind in ('file', 'encoded'):
+                    shapes[i, j, 0] = -2
+                elif kind == 'pickle':
+                    shapes[i, j, 0] = -3
+                shard.write(data)
+                shard_size += len(data)
+    finally:
+        shard.close()
+
+    np.save(os.path.join(path, 'index.npy'), index)
+    np.save(os.path.join(path, 'shapes.npy'), shapes)
+    meta = {'version': 1, 'num_samples': num_samples, 'num_shards': shard_id + 1, 'fields': fields}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+class _PackedField(object):
+    """Read-only list-like view of one field of a packed container, decoded on access."""
+
+    def __init__(self, container, column):
+        self.container = container
+        self.column = column
+
+    def __len__(self):
+        return len(self.container)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.container.read(index, self.column)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class PackedDataset(Dataset):
+    """Random access to a container written by `pack_dataset`.
+
+    The index and the shards are memory-mapped, reading a sample costs a lookup in the index and one slice of a
+    shard (the page cache and the readahead of the sequential layout do the rest). A sample is the tuple of its
+    decoded fields: images and masks as HWC uint8 arrays (rgb order), arrays with their original shape and dtype.
+
+    Args:
+        path (str): the container folder.
+
+    Examples:
+        >>> packed = PackedDataset('cifar10_packed')  # doctest: +SKIP
+        >>> image, label = packed[0]  # doctest: +SKIP
+        >>> images = packed.as_dataset('image')  # an ImageDataset reading from the container  # doctest: +SKIP
+
+    """
+
+    def __init__(self, path, symbol='packed', name=None, **kwargs):
+        super().__init__(symbol=symbol, name=name, **kwargs)
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.fields = [field['symbol'] for field in self.meta['fields']]
+        self.index = np.load(os.path.join(path, 'index.npy'), mmap_mode='r')
+        self.shapes = np.load(os.path.join(path, 'shapes.npy'), mmap_mode='r')
+        self._shards = {}
+
+    def _shard(self, shard_id):
+        shard = self._shards.get(shard_id)
+        if shard is None:
+            shard = np.memmap(os.path.join(self.path, 'shard-{0:05d}.bin'.format(shard_id)), dtype=np.uint8, mode='r')
+            self._shards[shard_id] = shard
+        return shard
+
+    def _column(self, field):
+        if isinstance(field, numbers.Integral):
+            return int(field)
+        if field not in self.fields:
+            raise KeyError('{0} is not a field of the packed dataset, the fields are {1}.'.format(field, self.fields))
+        return self.fields.index(field)
+
+    def read(self, index, field):
+        """Decode one field of one sample."""
+        column = self._column(field)
+        shard_id, offset, length = self.index[index, column]
+        data = self._shard(int(shard_id))[int(offset):int(offset) + int(length)]
+        shape = self.shapes[index, column]
+        if shape[0] == -3:
+            return pickle.loads(data.tobytes())
+        if shape[0] == -2:
+            image = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+            if image is not None and image.ndim == 3 and image.shape[-1] in (3, 4):
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB if image.shape[-1] == 3 else cv2.COLOR_BGRA2RGBA)
+            return image
+        shape = tuple(int(s) for s in shape if s >= 0)
+        # a private copy, the transforms may modify the sample in place
+        return np.frombuffer(data, dtype=np.dtype(self.meta['fields'][column]['dtype'])).reshape(shape).copy()
+
+    def field(self, field):
+        """A list-like view of one field, it can replace the list of a dataset."""
+        return _PackedField(self, self._column(field))
+
+    def as_dataset(self, field, **kwargs):
+        """Build the dataset class the field was packed from (ImageDataset, MaskDataset, LabelDataset...), reading
+        its samples from the container."""
+        column = self._column(field)
+        meta = self.meta['fields'][column]
+        kwargs.setdefault('symbol', meta['symbol'])
+        if meta['object_type'] is not None:
+            kwargs.setdefault('object_type', ObjectType(meta['object_type']))
+        if meta['class_names'] and meta['dataset'] in ('MaskDataset', 'LabelDataset', 'BboxDataset'):
+            kwargs.setdefault('class_names', meta['class_names'])
+        values = self.field(column)
+        cls = _dataset_classes.get(meta['dataset'])
+        if cls is None:
+            ds = Dataset(symbol=kwargs['symbol'], object_type=kwargs.get('object_type'))
+        else:
+            # built with the first sample (the constructors infer the element spec from it), then switched to the lazy view
+            ds = cls([values[0]], **kwargs)
+        ds.list = values
+        return ds
+
+    def __getitem__(self, index: int):
+        return tuple([self.read(index, column) for column in range(len(self.fields))])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __len__(self):
+        return int(self.meta['num_samples'])
+
+
+class PackedImageDataset(ImageDataset):
+    """An `ImageDataset` whose images are read from a container written by `pack_dataset`.
+
+    Args:
+        path (str): the container folder.
+        field (str): the image field, the first rgb/rgba/gray field by default.
+
+    """
+
+    def __init__(self, path, field=None, object_type: ObjectType = None, symbol="image", name=None, **kwargs):
+        packed = PackedDataset(path)
+        if field is None:
+            image_fields = [f['symbol'] for f in packed.meta['fields'] if f['object_type'] in ('rgb', 'rgba', 'gray')]
+            if len(image_fields) == 0:
+                raise ValueError('There is no image field in {0}.'.format(path))
+            field = image_fields[0]
+        if object_type is None:
+            object_type = ObjectType(packed.meta['fields'][packed.fields.index(field)]['object_type'])
+        super().__init__(images=None, object_type=object_type, symbol=symbol, name=name, **kwargs)
+        self.packed = packed
+        self.list = packed.field(field)
@@ -0,0 +1,335 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import builtins
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from trident.backend.common import OrderedDict
+from trident.backend.pytorch_backend import get_device
+from trident.backend.tensorspec import TensorSpec, ObjectType
+from trident.data.image_common import _warp_boxes, _warp_points
+
+__all__ = ['has_device_impl', 'device_transform']
+
+_image_types = [ObjectType.rgb, ObjectType.rgba, ObjectType.gray]
+_mask_types = [ObjectType.binary_mask, ObjectType.label_mask, ObjectType.color_mask, ObjectType.alpha_mask]
+
+
+def _selection(fn, num_samples, gate, device):
+    """Per-sample decision of the gate (ex. the 50% draw of the random_* functions), as a (N,1,1,1) bool tensor."""
+    selected = [gate is None or gate(fn) for _ in range(num_samples)]
+    return torch.tensor(selected, dtype=torch.bool, device=device).view(-1, 1, 1, 1)
+
+
+def _uniform(low, high, shape, device):
+    return torch.empty(shape, device=device).uniform_(low, high)
+
+
+def _sample_min_max(images):
+    flat = images.reshape(images.shape[0], -1)
+    return flat.min(-1)[0].view(-1, 1, 1, 1), flat.max(-1)[0].view(-1, 1, 1, 1)
+
+
+def _normalize(images, fn, gate):
+    mean = torch.as_tensor(np.array(fn.mean, dtype=np.float32), device=images.device).view(1, -1, 1, 1)
+    std = torch.as_tensor(np.array(fn.std, dtype=np.float32), device=images.device).view(1, -1, 1, 1)
+    return (images - mean) / std
+
+
+def _adjust_gamma(images, fn, gate):
+    return 255.0 * torch.pow(images.clamp(0, 255) / 255.0, fn.gamma)
+
+
+def _random_adjust_gamma(images, fn, gate):
+    num_samples = images.shape[0]
+    gammamin, gammamax = fn.gamma_range
+    avg_pix = images.reshape(num_samples, -1).mean(-1).view(-1, 1, 1, 1)
+    # bright images are only darkened, dark images are only brightened
+    low = torch.where(avg_pix < 30, torch.full_like(avg_pix, builtins.min(1, gammamax)), torch.full_like(avg_pix, gammamin))
+    high = torch.where(avg_pix > 220, torch.full_like(avg_pix, builtins.max(gammamin, 1)), torch.full_like(avg_pix, gammamax))
+    gammas = low + (high - low) * torch.rand_like(avg_pix)
+    gammas = torch.where(_selection(fn, num_samples, gate, images.device), gammas, torch.ones_like(gammas))
+    return 255.0 * torch.pow(images.clamp(0, 255) / 255.0, gammas)
+
+
+def _contrast(images, alphas):
+    max_pix = images.reshape(images.shape[0], -1).max(-1)[0].view(-1, 1, 1, 1).clamp(1e-8, 255.0)
+    # the samples exceeding 255 after scaling are rescaled to 255
+    return images.clamp(0, 255) * torch.min(alphas, 255.0 / max_pix)
+
+
+def _adjust_contrast(images, fn, gate):
+    return _contrast(images, torch.full((images.shape[0], 1, 1, 1), float(fn.alpha), device=images.device))
+
+
+def _random_adjust_contrast(images, fn, gate):
+    num_samples = images.shape[0]
+    alphas = _uniform(fn.scale_range[0], fn.scale_range[1], (num_samples, 1, 1, 1), images.device)
+    alphas = torch.where(_selection(fn, num_samples, gate, images.device), alphas, torch.ones_like(alphas))
+    return _contrast(images, alphas)
+
+
+def _rgb_to_hsv(images):
+    """(N,3,H,W) rgb in [0, 1] to hue in degrees, saturation and value in [0, 1] (the opencv float convention)."""
+    r, g, b = images[:, 0], images[:, 1], images[:, 2]
+    max_c, argmax_c = images.max(1)
+    min_c = images.min(1)[0]
+    delta = max_c - min_c
+    safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+    hue = torch.where(argmax_c == 0, (g - b) / safe_delta, torch.where(argmax_c == 1, 2.0 + (b - r) / safe_delta, 4.0 + (r - g) / safe_delta))
+    hue = torch.remainder(hue * 60.0, 360.0) * (delta > 0)
+    saturation = torch.where(max_c > 0, delta / torch.where(max_c > 0, max_c, torch.ones_like(max_c)), torch.zeros_like(max_c))
+    return torch.stack([hue, saturation, max_c], 1)
+
+
+def _hsv_to_rgb(hsv):
+    hue, saturation, value = hsv[:, 0:1] / 60.0, hsv[:, 1:2], hsv[:, 2:3]
+    # k = (n + h/60) mod 6 for the r, g, b channels (n = 5, 3, 1)
+    k = torch.remainder(torch.tensor([5.0, 3.0, 1.0], device=hsv.device).view(1, 3, 1, 1) + hue, 6.0)
+    return value - value * saturation * torch.clamp(torch.min(k, 4.0 - k), 0, 1)
+
+
+def _random_adjust_hue(images, fn, gate):
+    num_samples = images.shape[0]
+    if images.shape[1] != 3:
+        return images
+    selected = _selection(fn, num_samples, gate, images.device).view(-1, 1, 1)
+    hue_offset = _uniform(fn.hue_range[0], fn.hue_range[1], (num_samples, 1, 1), images.device) * selected
+    saturation_offset = torch.where(selected, _uniform(fn.saturation_range[0], fn.saturation_range[1], (num_samples, 1, 1), images.device), torch.ones(1, device=images.device))
+    lightness_offset = _uniform(fn.lightness_range[0], fn.lightness_range[1], (num_samples, 1, 1), images.device) * selected
+
+    hsv = _rgb_to_hsv(images.clamp(0, 255) / 255.0)
+    hsv = torch.stack([torch.remainder(hsv[:, 0] + hue_offset, 360.0), (hsv[:, 1] * saturation_offset).clamp(0, 1),
+                       (hsv[:, 2] + lightness_offset / 255.0).clamp(0, 1)], 1)
+    return _hsv_to_rgb(hsv) * 255.0
+
+
+def _random_channel_shift(images, fn, gate):
+    num_samples, channels = images.shape[:2]
+    min_x, max_x = _sample_min_max(images)
+    shifts = _uniform(-fn.intensity, fn.intensity, (num_samples, channels, 1, 1), images.device) * max_x
+    shifts = shifts * _selection(fn, num_samples, gate, images.device)
+    return torch.max(torch.min(images + shifts, max_x), min_x)
+
+
+def _add_noise(images, fn, gate):
+    num_samples = images.shape[0]
+    min_x, max_x = _sample_min_max(images)
+    # half of the samples get uniform noise instead of gaussian noise
+    uniform = torch.rand((num_samples, 1, 1, 1), device=images.device) < 0.5
+    noise = torch.where(uniform, torch.rand_like(images) * 2 - 1, torch.randn_like(images))
+    noise = noise * (fn.intensity * (max_x - min_x)) * _selection(fn, num_samples, gate, images.device)
+    return torch.max(torch.min(images + noise, max_x), min_x)
+
+
+def _random_erasing(images, fn, gate):
+    num_samples, channels, height, width = images.shape
+    device = images.device
+    selected = _selection(fn, num_samples, gate, device) & (torch.rand((num_samples, 1, 1, 1), device=device) <= 0.5)
+    area = _uniform(fn.size_range[0], fn.size_range[1], (num_samples,), device) * height * width / 4.0
+    ratio = _uniform(0.3, 1 / 0.3, (num_samples,), device)
+    erase_w = torch.sqrt(area / ratio).long().clamp(1, width)
+    erase_h = torch.sqrt(area * ratio).long().clamp(1, height)
+    left = (torch.rand(num_samples, device=device) * (width - erase_w + 1).float()).long()
+    top = (torch.rand(num_samples, device=device) * (height - erase_h + 1).float()).long()
+
+    rows = torch.arange(height, device=device).view(1, 1, -1, 1)
+    cols = torch.arange(width, device=device).view(1, 1, 1, -1)
+    mask = (rows >= top.view(-1, 1, 1, 1)) & (rows < (top + erase_h).view(-1, 1, 1, 1)) & \
+           (cols >= left.view(-1, 1, 1, 1)) & (cols < (left + erase_w).view(-1, 1, 1, 1)) & selected
+
+    # the erased region is either faded, filled with noise or filled with a constant
+    transparent = torch.rand((num_samples, 1, 1, 1), device=device) <= fn.transparancy_ratio
+    noisy = torch.rand((num_samples, 1, 1, 1), device=device) < 0.5
+    transparency = _uniform(fn.transparency_range[0], fn.transparency_range[1], (num_samples, 1, 1, 1), device)
+    fill = torch.where(noisy, torch.rand_like(images) * 255.0, _uniform(0, 255, (num_samples, 1, 1, 1), device).expand_as(images))
+    erased = torch.where(transparent, images * transparency, fill)
+    return torch.where(mask, erased, images)
+
+
+_device_kernels = {
+    'normalize': _normalize,
+    'adjust_gamma': _adjust_gamma,
+    'random_adjust_gamma': _random_adjust_gamma,
+    'adjust_contrast': _adjust_contrast,
+    'random_adjust_contrast': _random_adjust_contrast,
+    'random_adjust_hue': _random_adjust_hue,
+    'random_channel_shift': _random_channel_shift,
+    'add_noise': _add_noise,
+    'random_erasing': _random_erasing,
+}
+
+
+def has_device_impl(fn):
+    """Whether a transform function declares a batched tensor implementation (its ``device_op`` attribute)."""
+    device_op = getattr(fn, 'device_op', None)
+    return device_op == 'affine' or device_op in _device_kernels
+
+
+def _affine_matrices(ops, num_samples, height, width, gate):
+    """Compose the sampled matrices of the geometric functions for every sample of the minibatch, with the border
+    value of every sample (the one of the last applied function declaring it, as in `fused_affine`)."""
+    matrices = []
+    border_values = []
+    sizes = set()
+    for n in range(num_samples):
+        matrix = np.eye(3)
+        size = (height, width)
+        border_value = 0
+        for op in ops:
+            if gate is None or gate(op):
+                op_matrix, size = op.affine(*size)
+                matrix = np.dot(op_matrix, matrix)
+                border_value = getattr(op, 'border_value', border_value)
+        matrices.append(matrix)
+        border_values.append(border_value)
+        sizes.add(tuple(int(v) for v in size))
+    if len(sizes) > 1:
+        raise ValueError('The geometric transform functions produce different output sizes {0} in one minibatch.'.format(sorted(sizes)))
+    return np.stack(matrices, 0), border_values, sizes.pop()
+
+
+def _grid_sample(images, matrices, size, mode, border_values=None):
+    """Warp (N,C,H,W) tensors with per-sample matrices expressed in the bbox coordinates (pixel corners), the
+    uncovered area is filled with the per-sample border values (zero by default)."""
+    num_samples, _, height, width = images.shape
+    out_h, out_w = size
+    if mode == 'bilinear':
+        # area-resize the strong downscales first to avoid aliasing
+        current_scale = np.sqrt(np.abs(np.linalg.det(matrices[:, :2, :2]))).max()
+        if current_scale < 0.5:
+            new_h, new_w = max(int(round(height * current_scale)), 1), max(int(round(width * current_scale)), 1)
+            images = F.interpolate(images, size=(new_h, new_w), mode='area')
+            matrices = np.matmul(matrices, np.diag([width / new_w, height / new_h, 1.0])[None])
+            height, width = new_h, new_w
+    # output pixel coordinates -> input pixel coordinates -> input normalized coordinates
+    to_pixel = np.array([[out_w / 2.0, 0, out_w / 2.0], [0, out_h / 2.0, out_h / 2.0], [0, 0, 1]])
+    to_normalized = np.array([[2.0 / width, 0, -1], [0, 2.0 / height, -1], [0, 0, 1]])
+    theta = np.matmul(to_normalized[None], np.matmul(np.linalg.inv(matrices), to_pixel[None]))[:, :2]
+    theta = torch.as_tensor(theta, dtype=images.dtype, device=images.device)
+    grid = F.affine_grid(theta, [num_samples, images.shape[1], out_h, out_w], align_corners=False)
+    warped = F.grid_sample(images, grid, mode=mode, padding_mode='zeros', align_corners=False)
+    if border_values is None or not any(np.any(np.asarray(v) != 0) for v in border_values):
+        return warped
+    # the coverage of the source image, the fill color is blended in the uncovered (or partially covered) pixels
+    coverage = F.grid_sample(torch.ones_like(images[:, :1]), grid, mode=mode, padding_mode='zeros', align_corners=False)
+    fill = np.zeros((num_samples, images.shape[1]), dtype=np.float32)
+    for n, value in enumerate(border_values):
+        value = np.ravel(np.asarray(value, dtype=np.float32))
+        fill[n] = value[:images.shape[1]] if len(value) >= images.shape[1] else value[0]
+    fill = torch.as_tensor(fill, dtype=images.dtype, device=images.device)[:, :, None, None]
+    return warped + (1 - coverage) * fill
+
+
+def _apply_affine(results, ops, gate):
+    images = [v for k, v in results.items() if k.object_type in _image_types + _mask_types]
+    num_samples, height, width = images[0].shape[0], images[0].shape[2], images[0].shape[3]
+    matrices, border_values, size = _affine_matrices(ops, num_samples, height, width, gate)
+    for spec, data in results.items():
+        if spec.object_type in _image_types:
+            results[spec] = _grid_sample(data, matrices, size, 'bilinear', border_values)
+        elif spec.object_type in _mask_types:
+            results[spec] = _grid_sample(data.float(), matrices, size, 'nearest').to(data.dtype)
+        elif spec.object_type == ObjectType.absolute_bbox:
+            results[spec] = [_warp_boxes(np.asarray(item, dtype=np.float32).reshape(-1, np.shape(item)[-1]), matrices[n], size) for n, item in enumerate(data)]
+        elif spec.object_type == ObjectType.landmarks:
+            results[spec] = [_warp_points(np.asarray(item), matrices[n]) for n, item in enumerate(data)]
+    return results
+
+
+def _apply_fallback(results, fn, gate):
+    """Run a transform function without device implementation on every image of the minibatch (through the host)."""
+    for spec, data in results.items():
+        if spec.object_type in _image_types:
+            host = data.permute(0, 2, 3, 1).detach().cpu().numpy()
+            samples = []
+            for n in range(host.shape[0]):
+                image = host[n] if host.shape[-1] > 1 else host[n, :, :, 0]
+                if gate is None or gate(fn):
+                    image = fn(image)
+                samples.append(image.reshape(image.shape[:2] + (-1,)))
+            results[spec] = torch.as_tensor(np.stack(samples, 0).astype(np.float32)).permute(0, 3, 1, 2).contiguous().to(data.device)
+    return results
+
+
+def _upload(data, spec, channel_axis, device):
+    data = torch.as_tensor(np.ascontiguousarray(data)) if isinstance(data, np.ndarray) else data
+    data = data.to(device, non_blocking=True)
+    if data.ndim == 3:
+        data = data.unsqueeze(1)
+    elif channel_axis in (-1, 3):
+        data = data.permute(0, 3, 1, 2)
+    # uint8 batches are uploaded as they are and only converted on the device
+    return data.float() if spec.object_type in _image_types else data
+
+
+def device_transform(batch, funcs, device=None, channel_axis=1, gate=None):
+    """Apply image transform functions to a whole minibatch with batched torch kernels.
+
+    The geometric functions (the ones with an ``affine`` method) are composed per sample and applied with a single
+    ``F.grid_sample`` (nearest for the masks, the boxes and landmarks are transformed with the same matrices), the
+    photometric functions with a ``device_op`` run as batched tensor kernels with per-sample random parameters. The
+    other functions fall back to their numpy implementation, sample by sample.
+
+    Args:
+        batch (ndarray, Tensor or OrderedDict): the images (N,C,H,W) or (N,H,W,C) (uint8 or float in [0, 255]), or a
+            {TensorSpec: minibatch} dictionary, the boxes and landmarks being sequences of per-sample arrays.
+        funcs (list): the image transform functions.
+        device (str): the torch device, the current trident device by default.
+        channel_axis (int): the channel axis of the uploaded images and masks (1 or -1).
+        gate (callable): called with a function for every sample, the function is skipped for the samples where it
+            returns False (ex. `should_apply`).
+
+    Returns:
+        the transformed minibatch, images as float (N,C,H,W) tensors on device, masks as (N,H,W) or (N,C,H,W)
+        tensors (the layout they were given in), boxes and landmarks as lists of arrays.
+
+    Examples:
+        >>> from trident.data.image_common import random_crop, random_mirror, normalize
+        >>> images = np.random.randint(0, 255, (4, 3, 32, 32)).astype(np.uint8)
+        >>> device_transform(images, [random_crop(24, 24), random_mirror(), normalize(127.5, 127.5)], device='cpu').shape
+        torch.Size([4, 3, 24, 24])
+
+    """
+    if device is None:
+        device = get_device()
+    is_dict = isinstance(batch, dict)
+    # the single channel masks uploaded as (N,H,W) are returned as (N,H,W), as in the host path
+    squeezed = []
+    if is_dict:
+        results = OrderedDict()
+        for spec, data in batch.items():
+            if spec.object_type in _image_types + _mask_types:
+                if spec.object_type in _mask_types and np.ndim(data) == 3:
+                    squeezed.append(spec)
+                results[spec] = _upload(data, spec, channel_axis, device)
+            else:
+                results[spec] = data
+    else:
+        spec = TensorSpec(shape=None, object_type=ObjectType.rgb)
+        results = OrderedDict([(spec, _upload(batch, spec, channel_axis, device))])
+
+    index = 0
+    while index < len(funcs):
+        fn = funcs[index]
+        if getattr(fn, 'device_op', None) == 'affine':
+            run = [fn]
+            while index + 1 < len(funcs) and getattr(funcs[index + 1], 'device_op', None) == 'affine':
+                index += 1
+                run.append(funcs[index])
+            results = _apply_affine(results, run, gate)
+        elif has_device_impl(fn):
+            kernel = _device_kernels[fn.device_op]
+            for spec, data in results.items():
+                if spec.object_type in _image_types:
+                    results[spec] = kernel(data, fn, gate)
+        else:
+            results = _apply_fallback(results, fn, gate)
+        index += 1
+    for spec in squeezed:
+        results[spec] = results[spec].squeeze(1)
+    return results if is_dict else results.value_list[0]
@@ -12,6 +12,7 @@ import numbers
 import numpy as np
 
 from trident.data.image_common import check_same_size
+from trident.data.worker_pool import BatchWorkerPool, SharedSlabRing
 from trident.backend.common import OrderedDict
 from trident.backend.load_backend import get_backend
 
@@ -136,7 +137,100 @@ class BatchSampler(Sampler):
         if inspect.isfunction(sample_filter) or callable(sample_filter):
             self.sample_filter = sample_filter
 
+    def _stack_field(self, items, out=None):
+        if out is not None and len(items) <= len(out):
+            try:
+                return np.stack(items, axis=0, out=out[:len(items)])
+            except (ValueError, TypeError):
+                # variable sized or uncastable samples, fallback to a private array
+                pass
+        if all([isinstance(item, numbers.Integral) for item in items]):
+            return np.array(list(items)).astype(np.int64)
+        return np.array(list(items))
+
+    def collate(self, batch_data, out=None):
+        """Stack a list of samples (each sample is the value_list of data_template) into one minibatch.
+
+        The batch transform functions of the data source (ex. the photometric augmentations) are applied to the
+        stacked minibatch.
+
+        Args:
+            batch_data (list): the samples.
+            out (list of ndarray): optional preallocated buffers (one per field) to stack the samples into.
+
+        """
+        unzip_batch_data = list(zip(*batch_data))
+        fields = [self._stack_field(unzip_batch_data[i], out[i] if out is not None and i < len(out) else None) for i in range(len(unzip_batch_data))]
+        if hasattr(self.data_source, 'batch_transform'):
+            fields = self.data_source.batch_transform(fields)
+        if self.mode == 'tuple':
+            return tuple(fields)
+        elif self.mode == 'dict':
+            returnData = copy.deepcopy(self.data_source.data_template)
+            for i in range(len(fields)):
+                returnData[returnData.key_list[i]] = fields[i]
+            return returnData
+
+    def build_slab_ring(self, num_slots):
+        """Preallocate the shared-memory slab ring used by the loader workers, None if the samples cannot be placed in fixed slots."""
+        data_template = getattr(self.data_source, 'data_template', None)
+        if data_template is None or len(data_template) == 0 or len(self.data_source) == 0:
+            return None
+        try:
+            sample = self.data_source[0]
+            if sample is None or len(sample) != len(data_template):
+                return None
+            return SharedSlabRing.from_sample(sample.value_list, self.batch_size, num_slots)
+        except Exception as e:
+            print(e)
+            return None
+
+    def build_batch(self, indices, out=None):
+        """Fetch, filter and collate the samples of one minibatch, used by the loader workers.
+
+        Samples rejected by sample_filter (or failed to load) are replaced by random samples,
+        so the minibatch always has batch_size samples.
+
+        """
+        batch_data = []
+        candidates = list(indices)
+        retry = 0
+        while len(batch_data) < self.batch_size and retry <= 10 * self.batch_size:
+            if len(candidates) > 0:
+                idx = candidates.pop(0)
+            else:
+                idx = np.random.randint(0, len(self.data_source))
+                retry += 1
+            try:
+                _return_data = self.data_source[idx]
+                if self.sample_filter is None or self.sample_filter(_return_data.value_list):
+                    batch_data.append(_return_data.value_list)
+            except Exception as e:
+                print(e)
+        return self.collate(batch_data, out=out)
+
+    def index_batches(self):
+        """Yield the sample indices of every minibatch drawn from sampler."""
+        while True:
+            indices = list(itertools.islice(self.sampler, self.batch_size))
+            if len(indices) == 0:
+                return
+            yield indices
+
     def __iter__(self):
+        workers = getattr(self.data_source, 'workers', 0)
+        if getattr(self.data_source, 'use_multiprocessing', False) and workers is not None and workers > 0:
+            buffer_size = max(getattr(self.data_source, 'buffer_size', 10), workers)
+            slab_ring = self.build_slab_ring(buffer_size + 2) if getattr(self.data_source, 'use_shared_memory', False) else None
+            pool = BatchWorkerPool(self.build_batch, self.index_batches(), workers=workers, buffer_size=buffer_size,
+                                   base_seed=getattr(self.data_source, 'seed', None), slab_ring=slab_ring)
+            try:
+                for batch in pool:
+                    yield batch
+            finally:
+                pool.shutdown()
+            self.reset()
+            return
 
         batch_data = []
 
@@ -151,26 +245,9 @@ class BatchSampler(Sampler):
                 print(e)
 
             if len(batch_data) == self.batch_size:
-                returnData = copy.deepcopy(self.data_source.data_template)
-                unzip_batch_data = list(zip(*batch_data))
-                if self.mode=='tuple':
-                    for i in range(len(unzip_batch_data)):
-                        if all([isinstance(item, numbers.Integral) for item in unzip_batch_data[i]]):
-                            unzip_batch_data[i]= np.array(list(unzip_batch_data[i])).astype(np.int64)
-                        else:
-                            unzip_batch_data[i] = np.array(list(unzip_batch_data[i]))
-                    yield tuple(unzip_batch_data)
-                elif self.mode=='dict':
-                    for i in range(len(unzip_batch_data)):
-                        if all([isinstance(item,numbers.Integral) for item in unzip_batch_data[i]]):
-                            returnData[returnData.key_list[i]] =np.array(list(unzip_batch_data[i])).astype(np.int64)
-                        else:
-                            returnData[returnData.key_list[i]] = np.array(list(unzip_batch_data[i]))
-                    yield returnData
+                yield self.collate(batch_data)
                 batch_data = []
 
-
-
         self.reset()
         # raise StopIteration
 
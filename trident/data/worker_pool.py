@@ -0,0 +1,347 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import mmap
+import multiprocessing
+import numbers
+import os
+import random
+import sys
+import threading
+import traceback
+import weakref
+
+import numpy as np
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from trident.backend.load_backend import get_backend
+
+__all__ = ['BatchWorkerPool', 'SharedSlabRing', 'seed_worker']
+
+_POLL_INTERVAL = 0.1
+_SHUTDOWN_TIMEOUT = 5.0
+
+_live_pools = weakref.WeakSet()
+
+
+def seed_worker(seed: int):
+    """Seed every random generator used by the data pipeline inside a loader worker.
+
+    Args:
+        seed (int): the worker seed, usually ``base_seed + worker_id``.
+
+    """
+    seed = int(seed) % (2 ** 32)
+    random.seed(seed)
+    np.random.seed(seed)
+    if get_backend() == 'pytorch':
+        try:
+            import torch
+            torch.manual_seed(seed)
+            # every worker is one process, avoid intra-op thread oversubscription
+            torch.set_num_threads(1)
+        except Exception:
+            pass
+
+
+class _SlabRef(object):
+    """Placeholder sent through the result queue instead of an array already written into the slab ring."""
+
+    def __init__(self, length):
+        self.length = length
+
+
+class SharedSlabRing(object):
+    """A ring of preallocated shared-memory minibatch slots.
+
+    Every field of the minibatch owns one anonymous shared mapping shaped ``(num_slots, batch_size, *sample_shape)``,
+    it is created before the workers are forked, so workers write the collated minibatch straight into
+    its slot and only a tiny reference goes through the result queue. The trainer receives numpy views
+    over the slot instead of an unpickled copy.
+
+    A slot is reused ``num_slots`` batches later, the pool dispatches at most ``buffer_size`` batches ahead,
+    so with ``num_slots = buffer_size + 2`` a yielded minibatch stays valid while the next one is consumed.
+
+    Args:
+        layout (list of tuple): (sample_shape, dtype) of every field, in data_template order.
+        batch_size (int): the number of samples of one slot.
+        num_slots (int): the number of slots of the ring.
+
+    Examples:
+        >>> ring = SharedSlabRing([((2,), np.float32), ((), np.int64)], batch_size=4, num_slots=3)
+        >>> [v.shape for v in ring.slot(0)]
+        [(4, 2), (4,)]
+
+    """
+
+    def __init__(self, layout, batch_size, num_slots):
+        self.layout = [(tuple(shape), np.dtype(dtype)) for shape, dtype in layout]
+        self.batch_size = batch_size
+        self.num_slots = num_slots
+        self._buffers = []
+        self.slabs = []
+        for shape, dtype in self.layout:
+            slab_shape = (num_slots, batch_size) + shape
+            nbytes = int(np.prod(slab_shape)) * dtype.itemsize
+            buffer = mmap.mmap(-1, max(nbytes, 1))
+            self._buffers.append(buffer)
+            self.slabs.append(np.frombuffer(buffer, dtype=dtype, count=int(np.prod(slab_shape))).reshape(slab_shape))
+
+    @classmethod
+    def from_sample(cls, sample, batch_size, num_slots):
+        """Build the ring layout from one sample (the value_list of a data_template), None if any field is not a fixed numeric array."""
+        layout = []
+        for value in sample:
+            if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+                layout.append(((), np.int64))
+            elif isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+                layout.append((value.shape, value.dtype))
+            else:
+                return None
+        if len(layout) == 0:
+            return None
+        return cls(layout, batch_size, num_slots)
+
+    @property
+    def nbytes(self):
+        return sum([slab.nbytes for slab in self.slabs])
+
+    def slot(self, slot_id):
+        """The writable views of one slot, one array per field."""
+        return [slab[slot_id % self.num_slots] for slab in self.slabs]
+
+    def pack(self, slot_id, batch):
+        """Replace the arrays living in the slot by lightweight references before sending the batch back."""
+        values = list(batch) if isinstance(batch, tuple) else batch.value_list
+        views = self.slot(slot_id)
+        for i in range(min(len(values), len(views))):
+            v = values[i]
+            if isinstance(v, np.ndarray) and v.base is not None and np.shares_memory(v, views[i]):
+                values[i] = _SlabRef(len(v))
+        return self._rebuild(batch, values)
+
+    def unpack(self, slot_id, batch):
+        """Resolve the references of a packed batch into views over the slot."""
+        values = list(batch) if isinstance(batch, tuple) else batch.value_list
+        views = self.slot(slot_id)
+        for i in range(len(values)):
+            if isinstance(values[i], _SlabRef):
+                values[i] = views[i][:values[i].length]
+        return self._rebuild(batch, values)
+
+    def _rebuild(self, batch, values):
+        if isinstance(batch, tuple):
+            return tuple(values)
+        for k, v in zip(batch.key_list, values):
+            batch[k] = v
+        return batch
+
+    def close(self):
+        """Drop the ring references, the mappings are released once the last view handed out is gone."""
+        self.slabs = []
+        self._buffers = []
+
+
+def _worker_loop(collate_fn, index_queue, result_queue, done_event, seed, worker_id, slab_ring=None):
+    """Receive (batch_id, indices) tasks, build the minibatch and send back (batch_id, batch, error)."""
+    try:
+        if seed is not None:
+            seed_worker(seed)
+        while not done_event.is_set():
+            try:
+                task = index_queue.get(timeout=_POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            if task is None:
+                break
+            batch_id, indices = task
+            try:
+                if slab_ring is None:
+                    result_queue.put((batch_id, collate_fn(indices), None))
+                else:
+                    batch = collate_fn(indices, out=slab_ring.slot(batch_id))
+                    result_queue.put((batch_id, slab_ring.pack(batch_id, batch), None))
+            except Exception:
+                result_queue.put((batch_id, None, 'worker {0}:\n{1}'.format(worker_id, traceback.format_exc())))
+    except KeyboardInterrupt:
+        pass
+
+
+@atexit.register
+def _shutdown_live_pools():
+    for pool in list(_live_pools):
+        pool.shutdown()
+
+
+class BatchWorkerPool(object):
+    """Build minibatches in background workers with a bounded prefetch queue.
+
+    The main process keeps pulling index batches from ``index_source`` and dispatches them round-robin
+    to ``workers`` workers, each worker owns its index queue and is seeded with ``base_seed + worker_id``,
+    so the content of every batch is reproducible. Finished batches are yielded in dispatch order and at
+    most ``buffer_size`` batches are in flight at any time.
+
+    Workers are forked processes when the platform supports ``fork``, otherwise (Windows, or when
+    ``use_threads`` is True) they fall back to threads sharing the same protocol, thread workers are
+    not reseeded since they share the random state of the main process.
+
+    When a ``slab_ring`` is given, ``collate_fn`` is called with ``out=`` (the views of the batch slot),
+    the workers write the minibatch into shared memory once and the yielded batches are views over the
+    ring (see `SharedSlabRing`), a yielded batch is only valid until two more batches are fetched.
+
+    Args:
+        collate_fn (callable): build one minibatch from a list of sample indices.
+        index_source (iterator): yields lists of sample indices, exhausted means end of iteration.
+        workers (int): number of background workers.
+        buffer_size (int): maximum number of prefetched (in-flight) batches.
+        base_seed (int): base of the per-worker seeds, random if None.
+        use_threads (bool): force thread workers.
+        slab_ring (SharedSlabRing): optional shared-memory transport, needs at least buffer_size + 2 slots.
+
+    Examples:
+        >>> pool = BatchWorkerPool(lambda idx: np.array(idx) * 2, iter([[0, 1], [2, 3], [4, 5]]), workers=2, buffer_size=2, use_threads=True)
+        >>> [b.tolist() for b in pool]
+        [[0, 2], [4, 6], [8, 10]]
+
+    """
+
+    def __init__(self, collate_fn, index_source, workers=2, buffer_size=10, base_seed=None, use_threads=False, slab_ring=None):
+        self.collate_fn = collate_fn
+        self.index_source = index_source
+        self.workers = max(int(workers), 1)
+        self.buffer_size = max(int(buffer_size), self.workers)
+        self.slab_ring = slab_ring
+        if self.slab_ring is not None and self.slab_ring.num_slots < self.buffer_size + 2:
+            raise ValueError('slab_ring needs at least buffer_size + 2 = {0} slots, got {1}.'.format(self.buffer_size + 2, self.slab_ring.num_slots))
+        self.base_seed = int(np.random.randint(0, 2 ** 31 - 1)) if base_seed is None else int(base_seed)
+        self.use_threads = use_threads or 'fork' not in multiprocessing.get_all_start_methods()
+
+        self._send_idx = 0
+        self._rcvd_idx = 0
+        self._reorder_dict = {}
+        self._exhausted = False
+        self._is_shutdown = False
+        self._worker_pids = set()
+
+        if self.use_threads:
+            self.done_event = threading.Event()
+            self.result_queue = Queue.Queue()
+            self.index_queues = [Queue.Queue() for _ in range(self.workers)]
+            worker_class = threading.Thread
+        else:
+            ctx = multiprocessing.get_context('fork')
+            self.done_event = ctx.Event()
+            self.result_queue = ctx.Queue()
+            self.index_queues = [ctx.Queue() for _ in range(self.workers)]
+            worker_class = ctx.Process
+
+        self._workers = []
+        for worker_id in range(self.workers):
+            # thread workers share the global random state (and torch threads) with the trainer, leave them untouched
+            seed = None if self.use_threads else self.base_seed + worker_id
+            w = worker_class(target=_worker_loop, args=(self.collate_fn, self.index_queues[worker_id], self.result_queue, self.done_event, seed, worker_id, self.slab_ring))
+            w.daemon = True
+            w.start()
+            self._workers.append(w)
+            if not self.use_threads:
+                self._worker_pids.add(w.pid)
+        self._owner_pid = os.getpid()
+        _live_pools.add(self)
+
+        for _ in range(self.buffer_size):
+            self._try_put_index()
+
+    def _try_put_index(self):
+        if self._exhausted:
+            return False
+        try:
+            indices = next(self.index_source)
+        except StopIteration:
+            self._exhausted = True
+            return False
+        self.index_queues[self._send_idx % self.workers].put((self._send_idx, indices))
+        self._send_idx += 1
+        return True
+
+    def _check_workers_alive(self):
+        if self.use_threads:
+            return
+        dead = [w for w in self._workers if not w.is_alive()]
+        if len(dead) > 0:
+            pids = ', '.join([str(w.pid) for w in dead])
+            self.shutdown()
+            raise RuntimeError('Loader worker(s) (pid {0}) exited unexpectedly.'.format(pids))
+
+    def _get_batch(self):
+        while True:
+            try:
+                return self.result_queue.get(timeout=_POLL_INTERVAL)
+            except Queue.Empty:
+                self._check_workers_alive()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._is_shutdown:
+            raise StopIteration
+        if self._rcvd_idx >= self._send_idx:
+            self.shutdown()
+            raise StopIteration
+        while self._rcvd_idx not in self._reorder_dict:
+            batch_id, batch, error = self._get_batch()
+            self._reorder_dict[batch_id] = (batch, error)
+        batch, error = self._reorder_dict.pop(self._rcvd_idx)
+        self._rcvd_idx += 1
+        self._try_put_index()
+        if error is not None:
+            sys.stderr.write('Batch {0} failed in loader {1}\n'.format(self._rcvd_idx - 1, error))
+            return self.__next__()
+        if self.slab_ring is not None:
+            batch = self.slab_ring.unpack(self._rcvd_idx - 1, batch)
+        return batch
+
+    next = __next__
+
+    def __len__(self):
+        return self._send_idx - self._rcvd_idx
+
+    def shutdown(self):
+        """Stop all workers and release the queues, safe to call more than once."""
+        if self._is_shutdown:
+            return
+        self._is_shutdown = True
+        _live_pools.discard(self)
+        if os.getpid() != self._owner_pid:
+            return
+        self.done_event.set()
+        for q in self.index_queues:
+            try:
+                q.put(None)
+            except Exception:
+                pass
+        for w in self._workers:
+            w.join(timeout=_SHUTDOWN_TIMEOUT)
+            if not self.use_threads and w.is_alive():
+                w.terminate()
+        if not self.use_threads:
+            for q in self.index_queues + [self.result_queue]:
+                q.cancel_join_thread()
+                q.close()
+        self._reorder_dict = {}
+        if self.slab_ring is not None:
+            self.slab_ring.close()
+
+    close = shutdown
+
+    def __del__(self):
+        try:
+            self.shutdown()
+        except Exception:
+            pass
@@ -673,3 +673,14 @@ def get_activation(fn_name):
     except Exception as e:
         print(e)
         return None
+
+
+def _same_output_shape(self, input_shape):
+    """Elementwise, the output shape is the input shape."""
+    return input_shape
+
+
+# the shape rule of the activation layers (see Layer.compute_output_shape), they are all elementwise
+for _name in __all__:
+    if inspect.isclass(globals()[_name]) and issubclass(globals()[_name], Layer):
+        globals()[_name].compute_output_shape = _same_output_shape
@@ -23,7 +23,7 @@ from trident.layers.pytorch_layers import *
 from trident.layers.pytorch_normalizations import get_normalization, SpectralNorm
 from trident.layers.pytorch_pooling import *
 from trident.backend.common import *
-from trident.backend.pytorch_backend import Layer, Sequential, ModuleList
+from trident.backend.pytorch_backend import Layer, Sequential, ModuleList, symbolic_build
 from trident.backend.pytorch_ops import *
 
 __all__ = ['Conv2d_Block', 'Conv1d_Block', 'DepthwiseConv2d_Block', 'SeparableConv2d_Block', 'GcdConv2d_Block',
@@ -49,6 +49,21 @@ _triple = _ntuple(3)
 _quadruple = _ntuple(4)
 
 
+def _conv_block_output_shape(block, input_shape):
+    """The shape rule of the convolution blocks, the normalization and the activation keep the shape."""
+    sequence_rank = getattr(block, 'sequence_rank', 'cna')
+    if sequence_rank == 'nac':
+        for module in [block.norm, block.activation]:
+            if isinstance(module, Layer):
+                symbolic_build(module, input_shape)
+    output_shape = symbolic_build(block.conv, input_shape)
+    if sequence_rank != 'nac':
+        for module in [block.norm, block.activation]:
+            if isinstance(module, Layer):
+                symbolic_build(module, output_shape)
+    return output_shape
+
+
 class Conv1d_Block(Layer):
     def __init__(self, kernel_size=3, num_filters=None, strides=1, auto_pad=True, padding_mode='zero', activation=None,
                  normalization=None, use_spectral=False,use_bias=False, dilation=1, groups=1, add_noise=False, noise_intensity=0.005,
@@ -130,6 +145,9 @@ class Conv1d_Block(Layer):
             x = F.dropout(x, p=self.dropout_rate, training=self.training)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return _conv_block_output_shape(self, input_shape)
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, {num_filters}, strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -247,6 +265,9 @@ class Conv2d_Block(Layer):
             x = F.dropout(x, p=self.dropout_rate, training=self.training)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return _conv_block_output_shape(self, input_shape)
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, {num_filters}, strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -327,6 +348,9 @@ class TransConv2d_Block(Layer):
             x = F.dropout(x, p=self.dropout_rate, training=self.training)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return _conv_block_output_shape(self, input_shape)
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, num_filters={num_filters}, strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -412,6 +436,9 @@ class DepthwiseConv2d_Block(Layer):
             x = F.dropout(x, p=self.dropout_rate, training=self.training)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return _conv_block_output_shape(self, input_shape)
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, depth_multiplier={depth_multiplier}, strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -508,6 +535,9 @@ class SeparableConv2d_Block(Layer):
             x = F.dropout(x, p=self.dropout_rate, training=self.training)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return _conv_block_output_shape(self, input_shape)
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, depth_multiplier={depth_multiplier}, strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -856,6 +886,21 @@ class ShortCut2d(Layer):
         if self.activation is not None:
             x = self.activation(x)
         return x
+
+    def compute_output_shape(self, input_shape):
+        if self.branch_from is not None or self.mode not in ('add', 'dot', 'concate'):
+            # the branched tensor is only known at runtime
+            return None
+        shapes = [symbolic_build(v, input_shape) for v in self._modules.values()]
+        if len(shapes) == 0 or not all([len(shape) == len(shapes[0]) for shape in shapes]):
+            return None
+        if self.mode != 'concate':
+            return shapes[0]
+        axis = self.axis - 1 if self.axis > 0 else self.axis
+        output_shape = list(shapes[0])
+        output_shape[axis] = int(np.sum([shape[axis] for shape in shapes]))
+        return tuple(output_shape)
+
     def extra_repr(self):
         s = ('mode={mode}, keep_output={keep_output},axis={axis}')
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -130,6 +130,9 @@ class Dense(Layer):
             x = self.activation(x)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (int(self.num_filters),)
+
     def extra_repr(self):
         s = 'output_shape={0}'.format(self.output_shape.tolist()) + ',use_bias={use_bias}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -335,6 +338,9 @@ class Flatten(Layer):
         x = enforce_singleton(x)
         return x.view(x.size()[0], -1)
 
+    def compute_output_shape(self, input_shape):
+        return (int(np.prod(input_shape)),)
+
 
 class Concate(Layer):
     """Concate layer to splice  tensors ."""
@@ -472,6 +478,9 @@ class SoftMax(Layer):
             x = torch.softmax(x, dim=self.axis)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
 
 class Scale(Layer):
     """The Scale layer implements a per-tensor, per-channel, or per-element affine transformation and/or exponentiation by constant values.
@@ -689,6 +698,7 @@ class _ConvNd(Layer):
                     self.padding = list(self.padding) * 2
                 elif len(self.padding) == 2 * self.rank:
                     pass
+            self._classify_padding()
 
             if self.depthwise or self.separable:
                 if self.depth_multiplier is None:
@@ -728,6 +738,49 @@ class _ConvNd(Layer):
             self.to(get_device())
             self._built = True
 
+    def _classify_padding(self):
+        """Symmetric zero padding is done by the convolution kernel itself (no padded copy of the input), the
+        asymmetric and the non-zero paddings keep the explicit F.pad.
+
+        Returns:
+            the per spatial dimension padding for F.convNd, or None if the explicit F.pad is needed
+
+        """
+        self.native_padding = None
+        self._classified_padding = self.padding
+        if self.transposed or self.padding is None or self.padding_mode not in ('zero', 'constant'):
+            return None
+        padding = [int(p) for p in self.padding]
+        if len(padding) != 2 * self.rank or any([padding[2 * k] != padding[2 * k + 1] for k in range(self.rank)]):
+            return None
+        # F.pad order is (last dim begin, last dim end, ...), the conv padding is in the dimension order
+        self.native_padding = tuple([padding[2 * (self.rank - 1 - d)] for d in range(self.rank)])
+        return self.native_padding
+
+    def compute_output_shape(self, input_shape):
+        if self.separable:
+            # the depthwise then the pointwise convolution
+            for name in ['conv1', 'pointwise']:
+                if not isinstance(self._modules.get(name), Layer):
+                    return None
+                input_shape = symbolic_build(self._modules[name], input_shape)
+            return input_shape
+        if self.transposed or self.padding is None or len(self.padding) != 2 * self.rank or len(input_shape) != self.rank + 1:
+            return None
+        if self.padding_mode == 'circular' or (self.rank == 3 and self.get_native_padding() is None):
+            return None
+        spatial = []
+        for d in range(self.rank):
+            pad = int(self.padding[2 * (self.rank - 1 - d)]) + int(self.padding[2 * (self.rank - 1 - d) + 1])
+            spatial.append((int(input_shape[1 + d]) + pad - self.dilation[d] * (self.kernel_size[d] - 1) - 1) // self.strides[d] + 1)
+        return (int(self.num_filters),) + tuple(spatial)
+
+    def get_native_padding(self):
+        """The classified padding, classified again when self.padding was replaced since the build."""
+        if getattr(self, '_classified_padding', None) is self.padding:
+            return self.native_padding
+        return self._classify_padding()
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, num_filters={num_filters},strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -872,6 +925,9 @@ class Conv1d(_ConvNd):
         self.activation = get_activation(activation)
 
     def conv1d_forward(self, x):
+        native_padding = self.get_native_padding()
+        if native_padding is not None:
+            return F.conv1d(x, self.weight, self.bias, self.strides, native_padding, self.dilation, self.groups)
         x = F.pad(x, self.padding, mode='constant' if self.padding_mode == 'zero' else self.padding_mode)
         return F.conv1d(x, self.weight, self.bias, self.strides, _single(0), self.dilation, self.groups)
 
@@ -1010,6 +1066,9 @@ class Conv2d(_ConvNd):
         # for backward compatibility
         if len(self.padding) != len(self.kernel_size) + 2:
             self.padding = normalize_padding(self.padding, len(self.kernel_size))
+        native_padding = self.get_native_padding()
+        if native_padding is not None:
+            return F.conv2d(x, self.weight, self.bias, self.strides, native_padding, self.dilation, self.groups)
         if self.padding_mode == 'circular':
             expanded_padding = ((self.padding[0] + 1) // 2, self.padding[1] // 2, (self.padding[2] + 1) // 2, self.padding[3] // 2)
             x = F.pad(x, expanded_padding, mode='circular')
@@ -1050,6 +1109,9 @@ class Conv3d(_ConvNd):
         self.activation = get_activation(activation)
 
     def conv3d_forward(self, x):
+        native_padding = self.get_native_padding()
+        if native_padding is not None:
+            return F.conv3d(x, self.weight, self.bias, self.strides, native_padding, self.dilation, self.groups)
         if self.padding_mode == 'circular':
             expanded_padding = (
             (self.padding[2] + 1) // 2, self.padding[2] // 2, (self.padding[1] + 1) // 2, self.padding[1] // 2, (self.padding[0] + 1) // 2, self.padding[0] // 2)
@@ -1381,6 +1443,9 @@ class DepthwiseConv1d(_ConvNd):
         self.activation = get_activation(activation)
 
     def conv1d_forward(self, x):
+        native_padding = self.get_native_padding()
+        if native_padding is not None:
+            return F.conv1d(x, self.weight, self.bias, self.strides, native_padding, self.dilation, self.groups)
         x = F.pad(x, self.padding, mode='constant' if self.padding_mode == 'zero' else self.padding_mode)
         return F.conv1d(x, self.weight, self.bias, self.strides, _single(0), self.dilation, self.groups)
 
@@ -1495,6 +1560,9 @@ class DepthwiseConv2d(_ConvNd):
         self.rank = 2
         if len(self.padding) == self.rank:
             self.padding = (self.padding[1], self.padding[1], self.padding[0], self.padding[0])
+        native_padding = self.get_native_padding()
+        if native_padding is not None:
+            return F.conv2d(x, self.weight, self.bias, self.strides, native_padding, self.dilation, self.groups)
         if self.padding_mode == 'circular':
             expanded_padding = ((self.padding[0] + 1) // 2, self.padding[1] // 2, (self.padding[2] + 1) // 2, self.padding[3] // 2)
             x = F.pad(x, expanded_padding, mode='circular')
@@ -1840,6 +1908,10 @@ class GatedConv2d(Conv2d):
         x = x * g.sigmoid_()
         return x
 
+    def compute_output_shape(self, input_shape):
+        # the gate split and the stride subsampling are not covered by the convolution rule
+        return None
+
 
 class GcdConv2d(_ConvNd):
     def __init__(self, kernel_size, num_filters=None, strides=1, auto_pad=True, padding_mode='zero', activation=None,
@@ -1980,6 +2052,10 @@ class GcdConv2d(_ConvNd):
             x = self.activation(x)
         return x
 
+    def compute_output_shape(self, input_shape):
+        # grouped channel convolution (conv3d), not covered by the convolution rule
+        return None
+
     def extra_repr(self):
         s = 'kernel_size={kernel_size}, {num_filters},strides={strides}'
         if 'activation' in self.__dict__ and self.__dict__['activation'] is not None:
@@ -2045,6 +2121,13 @@ class Reshape(Layer):
             new_shape = concate([to_tensor(-1), shp], axis=0)
         return torch.reshape(x, tuple(to_list(new_shape)))
 
+    def compute_output_shape(self, input_shape):
+        target_shape = [int(d) for d in to_list(self.target_shape)]
+        if -1 in target_shape:
+            known = int(np.prod([d for d in target_shape if d != -1]))
+            target_shape[target_shape.index(-1)] = int(np.prod(input_shape)) // known
+        return tuple(target_shape)
+
 
 class Permute(Layer):
     """Permute Layer
@@ -2228,6 +2311,9 @@ class Dropout(Layer):
         x = enforce_singleton(x)
         return F.dropout(x, self.dropout_rate, self.training, self.inplace)
 
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
     def extra_repr(self):
         return 'p={}, inplace={}'.format(self.dropout_rate, self.inplace)
 
@@ -2256,6 +2342,9 @@ class AlphaDropout(Layer):
         x = enforce_singleton(x)
         return F.alpha_dropout(x, self.dropout_rate, self.training, self.inplace)
 
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
     def extra_repr(self):
         return 'p={}, inplace={}'.format(self.dropout_rate, self.inplace)
 
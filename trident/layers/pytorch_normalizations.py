@@ -749,3 +749,13 @@ def get_normalization(fn_name):
     normalization_fn_ = get_class(fn_name, fn_modules)
     normalization_fn = normalization_fn_
     return normalization_fn
+
+
+def _same_output_shape(self, input_shape):
+    """The normalizations keep the shape of their input."""
+    return input_shape
+
+
+# the shape rule of the normalization layers (see Layer.compute_output_shape)
+for _layer_class in [BatchNorm, GroupNorm, InstanceNorm, LayerNorm, L2Norm, PixelNorm, EvoNormB0, EvoNormS0]:
+    _layer_class.compute_output_shape = _same_output_shape
@@ -48,6 +48,18 @@ _triple = _ntuple(3)
 _quadruple = _ntuple(4)
 
 
+def _pooled_length(length, kernel_size, stride, padding, dilation=1, ceil_mode=False):
+    """The output length of a pooling along one axis (the formula of torch pooling)."""
+    span = length + 2 * padding - dilation * (kernel_size - 1) - 1
+    if ceil_mode:
+        output_length = -(-span // stride) + 1
+        # the last window has to start inside the input or the left padding
+        if (output_length - 1) * stride >= length + padding:
+            output_length -= 1
+        return output_length
+    return span // stride + 1
+
+
 class _PoolNd(Layer):
     __constants__ = ['kernel_size', 'strides', 'auto_pad', 'padding', 'dilation', 'ceil_mode']
 
@@ -233,6 +245,14 @@ class MaxPool2d(_PoolNd):
         return F.max_pool2d(x, self.kernel_size, self.strides, self.padding, self.dilation, self.ceil_mode,
                             self.return_indices)
 
+    def compute_output_shape(self, input_shape):
+        if self.return_indices:
+            return None
+        dilation = _pair(self.dilation)
+        return (input_shape[0],) + tuple(
+            _pooled_length(int(input_shape[i + 1]), self.kernel_size[i], self.strides[i], self.padding[i], dilation[i],
+                           self.ceil_mode) for i in range(2))
+
 
 class MaxPool3d(_PoolNd):
     """Applies a 3D max pooling over an input signal composed of several input
@@ -661,6 +681,11 @@ class AvgPool2d(_PoolNd):
         return F.avg_pool2d(x, self.kernel_size, self.strides, self.padding, self.ceil_mode, self.count_include_pad,
                             self.divisor_override)
 
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0],) + tuple(
+            _pooled_length(int(input_shape[i + 1]), self.kernel_size[i], self.strides[i], self.padding[i], 1,
+                           self.ceil_mode) for i in range(2))
+
 
 class AvgPool3d(_PoolNd):
     """Applies a 3D average pooling over an input signal composed of several input
@@ -772,6 +797,9 @@ class GlobalAvgPool2d(Layer):
         x = x.view(N, C, -1).mean(dim=-1, keepdim=self.keepdims)
         return x
 
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], 1) if self.keepdims else (input_shape[0],)
+
 
 class AdaptiveAvgPool2d(Layer):
     """AdaptiveAverage Pooling Imprementation """
@@ -784,3 +812,6 @@ class AdaptiveAvgPool2d(Layer):
         x = enforce_singleton(x)
         return F.adaptive_avg_pool2d(x, self.output_size)
 
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0],) + tuple(self.output_size)
+
@@ -0,0 +1,176 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import multiprocessing
+import pickle
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+
+__all__ = ['RenderWorker', 'get_render_worker']
+
+_render_worker = None
+
+
+def _render_loop(conn):
+    """The loop of the rendering process: unpickle a (fn, args, kwargs) job, call it, acknowledge it."""
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    while True:
+        try:
+            payload = conn.recv_bytes()
+        except (EOFError, OSError):
+            return
+        if len(payload) == 0:
+            return
+        try:
+            fn, args, kwargs = pickle.loads(payload)
+            fn(*args, **kwargs)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            plt.close('all')
+        try:
+            conn.send_bytes(b'1')
+        except (EOFError, OSError):
+            return
+
+
+class RenderWorker(object):
+    """Render the plots of the training loop (matplotlib figures saved as png) in a dedicated process.
+
+    `submit` pickles the job right away, so the arguments are a snapshot of the histories and images at the time
+    of the call, and returns without waiting for matplotlib. The pending jobs are keyed (one key per callback):
+    a new frame replaces the pending frame of the same key, and at most ``max_pending`` keys wait for the
+    process, the oldest frame is dropped first. So a slow render never queues up nor blocks a training step,
+    only the latest frames are drawn.
+
+    If the process cannot be started or the job cannot be pickled, the job is rendered synchronously.
+
+    Args:
+        max_pending (int): the maximum number of frames waiting for the rendering process.
+
+    Examples:
+        >>> worker = RenderWorker()  # doctest: +SKIP
+        >>> worker.submit('loss', loss_metric_curve, losses, metrics, save_path='results/loss_{0}.png')  # doctest: +SKIP
+
+    """
+
+    def __init__(self, max_pending=2):
+        self.max_pending = max(int(max_pending), 1)
+        self.submitted = 0
+        self.dropped = 0
+        self.rendered = 0
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._process = None
+        self._conn = None
+        self._thread = None
+        self._closed = False
+        self._failed = False
+
+    def _start(self):
+        if self._process is not None and self._process.is_alive():
+            return True
+        if self._failed:
+            return False
+        try:
+            # fork does not re-run the main script of the training, the rendering process never touches the device
+            context = multiprocessing.get_context('fork' if sys.platform.startswith('linux') else 'spawn')
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_render_loop, args=(child_conn,), name='render_worker')
+            process.daemon = True
+            process.start()
+            child_conn.close()
+        except Exception as e:
+            sys.stderr.write('Cannot start the rendering process, plots are rendered synchronously: {0}\n'.format(e))
+            self._failed = True
+            return False
+        self._process, self._conn = process, parent_conn
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._feed, name='render_feeder')
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def _feed(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+                _, payload = self._pending.popitem(last=False)
+                self._condition.notify_all()
+            try:
+                self._conn.send_bytes(payload)
+                # one frame in flight, the next ones stay replaceable until it is drawn
+                self._conn.recv_bytes()
+                self.rendered += 1
+            except (EOFError, OSError):
+                with self._condition:
+                    self._failed = True
+                    self._pending.clear()
+                    self._condition.notify_all()
+                return
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Render fn(*args, **kwargs) in the rendering process, replacing the pending frame of key."""
+        self.submitted += 1
+        try:
+            payload = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            payload = None
+        if payload is None or self._closed or not self._start():
+            fn(*args, **kwargs)
+            self.rendered += 1
+            return
+        with self._condition:
+            if key in self._pending:
+                del self._pending[key]
+                self.dropped += 1
+            self._pending[key] = payload
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until the pending frames are handed to the rendering process."""
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._pending) == 0 or self._failed, timeout)
+
+    def close(self, timeout=10):
+        """Render the pending frames and stop the rendering process."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._process is not None:
+            try:
+                self._conn.send_bytes(b'')
+            except (EOFError, OSError):
+                pass
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._conn.close()
+            self._process = None
+
+    def __repr__(self):
+        return 'RenderWorker(submitted={0}, rendered={1}, dropped={2})'.format(self.submitted, self.rendered, self.dropped)
+
+
+def get_render_worker():
+    """The rendering worker shared by the visualization callbacks, stopped at exit."""
+    global _render_worker
+    if _render_worker is None:
+        _render_worker = RenderWorker()
+        atexit.register(_render_worker.close)
+    return _render_worker
@@ -29,6 +29,7 @@ from trident.backend.pytorch_backend import *
 from trident.backend.pytorch_backend import to_numpy, to_tensor, Layer, Sequential, Combine, load
 from trident.backend.pytorch_ops import *
 from trident.data.bbox_common import clip_boxes_to_image, nms
+from trident.data.bbox_nms import nms as nms_indexes, batched_nms
 from trident.data.image_common import *
 from trident.data.utils import download_model_from_google_drive
 from trident.layers.pytorch_activations import get_activation, Identity, PRelu
@@ -363,44 +364,17 @@ class Mtcnn(ImageDetectionModel):
     def boxes_nms(self,box_scores, overlap_threshold=0.5, top_k=-1):
         """Non-maximum suppression.
         Arguments:
-            box_scores: a float numpy array of shape [n, 5],
-                where each row is (xmin, ymin, xmax, ymax, score).
+            box_scores: a float tensor of shape [n, 5+],
+                where each row is (xmin, ymin, xmax, ymax, score, ...).
             overlap_threshold: a float number.
         Returns:
-            list with indices of the selected boxes
+            the selected rows of box_scores
         """
         # 如果沒有有效的候選區域則回傳空的清單
         box_scores = to_tensor(box_scores)
         if len(box_scores) == 0:
             return []
-        score = box_scores[:, 4]
-        boxes = box_scores[:, :4]
-        # 存放過關的索引值
-        picked = []
-        # 依照機率信心水準升冪排序
-        indexes = argsort(score, descending=False)
-
-        while len(indexes) > 0:
-            # 如此一來，最後一筆即是信心水準最高值
-            # 加入至過關清單中
-            current = indexes[-1]
-            picked.append(current.item())
-
-            # 計算其餘所有候選框與此當前框之間的IOU
-
-            if 0 < top_k == len(picked) or len(indexes) == 1:
-                break
-            current_box = boxes[current, :]
-            current_score = score[current]
-            # 除了最後一筆以外的都是其餘框
-            indexes = indexes[:-1]
-            rest_boxes = boxes[indexes, :]
-            iou = self.iou_of(
-                rest_boxes,
-                expand_dims(current_box, axis=0),
-            )
-            # IOU未超過門檻值的表示未與當前框重疊，則留下，其他排除
-            indexes = indexes[iou <= overlap_threshold]
+        picked = nms_indexes(box_scores[:, :4], box_scores[:, 4], iou_threshold=overlap_threshold, top_k=top_k)
         return box_scores[picked]
 
 
@@ -534,6 +508,167 @@ class Mtcnn(ImageDetectionModel):
 
         else:
             raise  ValueError('the model is not built yet.')
+    def _stack_images(self, images):
+        """Pad the images to a common size and stack them as one (N, 3, H, W) float tensor on the model device."""
+        arrays = []
+        for img in images:
+            img = image2array(img)
+            if img.ndim == 2:
+                img = np.stack([img, img, img], -1)
+            if img.shape[-1] == 4:
+                img = img[:, :, :3]
+            arrays.append(img)
+        sizes = np.array([img.shape[:2] for img in arrays])
+        height, width = sizes.max(0)
+        batch = np.zeros((len(arrays), int(height), int(width), 3), dtype=np.float32)
+        for i in range(len(arrays)):
+            batch[i, :arrays[i].shape[0], :arrays[i].shape[1]] = arrays[i]
+        weight = self.pnet.weights[0].data
+        batch = torch.from_numpy(batch).to(weight.device).permute(0, 3, 1, 2).contiguous().to(weight.dtype)
+        return batch, sizes
+
+    def _normalize_batch(self, x):
+        """Apply the normalize steps of preprocess_flow to a (N, 3, H, W) tensor."""
+        for func in self.preprocess_flow:
+            if inspect.isfunction(func) and func.__qualname__ == 'normalize.<locals>.img_op':
+                mean = torch.as_tensor(np.array(func.mean, dtype=np.float32), device=x.device).reshape(1, -1, 1, 1).to(x.dtype)
+                std = torch.as_tensor(np.array(func.std, dtype=np.float32), device=x.device).reshape(1, -1, 1, 1).to(x.dtype)
+                x = (x - mean) / std
+        return x
+
+    def _run_in_chunks(self, net, x, max_batch):
+        outputs = [net(x[i:i + max_batch]) for i in range(0, len(x), max_batch)]
+        return [torch.cat([out[k] for out in outputs], dim=0) for k in range(len(outputs[0]))]
+
+    def _clip_to_images(self, boxes, image_index, sizes):
+        limits = torch.as_tensor(sizes, dtype=boxes.dtype, device=boxes.device)[image_index]
+        boxes[:, 0] = torch.min(boxes[:, 0].clamp(min=0), limits[:, 1])
+        boxes[:, 1] = torch.min(boxes[:, 1].clamp(min=0), limits[:, 0])
+        boxes[:, 2] = torch.min(boxes[:, 2].clamp(min=0), limits[:, 1])
+        boxes[:, 3] = torch.min(boxes[:, 3].clamp(min=0), limits[:, 0])
+        return boxes
+
+    def _pnet_batch(self, batch, sizes, max_batch, factor=0.709):
+        """Run P-Net on every pyramid level of all the images, one padded batch per level."""
+        heads = [module for module in self.pnet.modules() if isinstance(module, DetectorHead)]
+        threshould = heads[0].threshould if len(heads) > 0 else 0.5
+        layers = [module for module in self.pnet._modules.values() if not isinstance(module, DetectorHead)]
+
+        min_side = sizes.min(1)
+        m = 12.0 / self.min_size
+        image_index_list, boxes_list = [], []
+        factor_count = 0
+        while min_side.max() * m * np.power(factor, factor_count) >= 12:
+            scale = m * np.power(factor, factor_count)
+            factor_count += 1
+            active = np.nonzero(min_side * m * np.power(factor, factor_count - 1) >= 12)[0]
+            canvas = sizes[active].max(0)
+            scaled = F.interpolate(batch[active][:, :, :canvas[0], :canvas[1]], size=(int(round(canvas[0] * scale)), int(round(canvas[1] * scale))),
+                                   mode='bilinear', align_corners=False, antialias=True)
+            for start in range(0, len(active), max_batch):
+                x = self._normalize_batch(scaled[start:start + max_batch])
+                for layer in layers:
+                    x = layer(x)
+                probs, regs = x[0][:, -1], x[1]
+                n, y, x = torch.where(probs >= threshould)
+                # cells whose 12x12 window falls in the padding are dropped
+                valid = torch.as_tensor(np.round(sizes[active[start:start + max_batch]] * scale), device=probs.device)[n]
+                inside = (2 * y + 12 <= valid[:, 0]) & (2 * x + 12 <= valid[:, 1])
+                n, y, x = n[inside], y[inside], x[inside]
+                if len(n) == 0:
+                    continue
+                reg = regs[n, :, y, x]
+                q1 = torch.stack([x, y, x, y], dim=-1).to(reg.dtype) * 2 + 1
+                q1[:, 2:] += 11
+                box = (q1 + reg * 12) / scale
+                boxes_list.append(torch.cat([box.round_(), probs[n, y, x].unsqueeze(-1)], dim=-1))
+                image_index_list.append(torch.as_tensor(active[start:start + max_batch], device=n.device)[n])
+        if len(boxes_list) == 0:
+            return None, None
+        return torch.cat(boxes_list, dim=0), torch.cat(image_index_list, dim=0)
+
+    def _crop_and_resize(self, batch, image_index, boxes, size):
+        """Bilinear crop-and-resize of every box from its own image in a single gather, the area outside the image is zero."""
+        height, width = batch.shape[2:]
+        x1, y1, x2, y2 = [boxes[:, i:i + 1].floor() for i in range(4)]
+        grid = (torch.arange(size, device=boxes.device, dtype=boxes.dtype) + 0.5) / size
+        xs = torch.max(torch.min(x1 + grid[None, :] * (x2 - x1) - 0.5, x2 - 1), x1)
+        ys = torch.max(torch.min(y1 + grid[None, :] * (y2 - y1) - 0.5, y2 - 1), y1)
+        x0, y0 = xs.floor(), ys.floor()
+        wx, wy = (xs - x0)[:, None, :, None], (ys - y0)[:, :, None, None]
+        index = image_index[:, None, None]
+
+        def gather(yy, xx):
+            inside = ((yy >= 0) & (yy < height))[:, :, None] & ((xx >= 0) & (xx < width))[:, None, :]
+            values = batch[index, :, yy.clamp(0, height - 1).long()[:, :, None], xx.clamp(0, width - 1).long()[:, None, :]]
+            return values * inside.unsqueeze(-1).to(values.dtype)
+
+        crops = (gather(y0, x0) * (1 - wx) + gather(y0, x0 + 1) * wx) * (1 - wy) + (gather(y0 + 1, x0) * (1 - wx) + gather(y0 + 1, x0 + 1) * wx) * wy
+        empty = ((x2 <= x1) | (y2 <= y1)).reshape(-1, 1, 1, 1)
+        return crops.masked_fill(empty, 0).permute(0, 3, 1, 2).contiguous()
+
+    def infer_batch(self, images, max_batch=256):
+        """Detect the faces of many images, every stage of the cascade runs once for the whole batch.
+
+        The pyramid levels of all images are packed into padded tensors, the R-Net and O-Net inputs are cropped
+        and resized on the device with one gather instead of a Python loop per box.
+
+        Args:
+            images (list): the images (path, PIL image or ndarray).
+            max_batch (int): the maximum number of images (P-Net) or crops (R-Net, O-Net) per forward pass.
+
+        Returns:
+            list of (n, 15) arrays (x1, y1, x2, y2, score, 5 landmarks x, 5 landmarks y), one per image.
+
+        """
+        if not self.model.built:
+            raise ValueError('the model is not built yet.')
+        self.model.to(self.device)
+        self.model.eval()
+        if len(images) == 0:
+            return []
+        results = [np.zeros((0, 15), dtype=np.float32) for _ in range(len(images))]
+        with torch.no_grad():
+            batch, sizes = self._stack_images(images)
+
+            #########pnet
+            boxes, image_index = self._pnet_batch(batch, sizes, max_batch)
+            if boxes is None:
+                return results
+            boxes = self._clip_to_images(boxes, image_index, sizes)
+            keep = batched_nms(boxes[:, :4], boxes[:, 4], image_index, iou_threshold=self.detection_threshould[0])
+            boxes, image_index = self.rerec(boxes[keep], None), image_index[keep]
+
+            #########rnet
+            r_out1, r_out2, r_out3 = self._run_in_chunks(self.rnet, self._normalize_batch(self._crop_and_resize(batch, image_index, boxes, 24)), max_batch)
+            keep = r_out1[:, 0] > self.detection_threshould[1]
+            boxes, image_index = boxes[keep], image_index[keep]
+            if len(boxes) == 0:
+                return results
+            boxes[:, 4] = r_out1[keep][:, 0]
+            boxes = calibrate_box(boxes, r_out2[keep])
+            keep = batched_nms(boxes[:, :4], boxes[:, 4], image_index, iou_threshold=self.detection_threshould[1])
+            boxes, image_index = self._clip_to_images(boxes[keep], image_index[keep], sizes), image_index[keep]
+            boxes = self.rerec(boxes, None)
+
+            #########onet
+            o_out1, o_out2, o_out3 = self._run_in_chunks(self.onet, self._normalize_batch(self._crop_and_resize(batch, image_index, boxes, 48)), max_batch)
+            keep = o_out1[:, 0] > self.detection_threshould[2]
+            boxes, image_index = boxes[keep], image_index[keep]
+            if len(boxes) == 0:
+                return results
+            boxes[:, 4] = o_out1[keep][:, 0]
+            boxes = calibrate_box(boxes, o_out2[keep])
+            o_out3 = o_out3[keep]
+            landmarks_x = boxes[:, 0:1] + o_out3[:, 0::2] * (boxes[:, 2:3] - boxes[:, 0:1] + 1)
+            landmarks_y = boxes[:, 1:2] + o_out3[:, 1::2] * (boxes[:, 3:4] - boxes[:, 1:2] + 1)
+            boxes = torch.cat([boxes, landmarks_x, landmarks_y], dim=-1)
+            keep = batched_nms(boxes[:, :4], boxes[:, 4], image_index, iou_threshold=self.detection_threshould[2])
+            boxes, image_index = to_numpy(boxes[keep]), to_numpy(image_index[keep])
+        for i in range(len(images)):
+            results[i] = boxes[image_index == i]
+        return results
+
     def generate_bboxes(self,*outputs,threshould=0.5,scale=1):
         raise NotImplementedError
     def nms(self,bboxes):
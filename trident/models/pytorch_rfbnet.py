@@ -27,6 +27,7 @@ from trident.backend.common import *
 from trident.backend.pytorch_backend import to_numpy, to_tensor, Layer, Sequential, ModuleList, fix_layer, load
 from trident.backend.pytorch_ops import *
 from trident.data.bbox_common import xywh2xyxy, xyxy2xywh
+from trident.data.bbox_nms import nms as nms_indexes, batched_nms
 from trident.data.image_common import *
 from trident.data.utils import download_model_from_google_drive
 from trident.layers.pytorch_activations import get_activation, Identity, Relu
@@ -356,25 +357,7 @@ class RFBnet(Layer):
         Returns:
              picked: a list of indexes of the kept boxes
         """
-        scores = box_scores[:, -1]
-        boxes = box_scores[:, :-1]
-        picked = []
-        _, indexes = scores.sort(descending=True)
-        indexes = indexes[:candidate_size]
-        while len(indexes) > 0:
-            current = indexes[0]
-            picked.append(current.item())
-            if 0 < top_k == len(picked) or len(indexes) == 1:
-                break
-            current_box = boxes[current, :]
-            indexes = indexes[1:]
-            rest_boxes = boxes[indexes, :]
-            iou = self.iou_of(
-                rest_boxes,
-                current_box.unsqueeze(0),
-            )
-            indexes = indexes[iou <= iou_threshold]
-
+        picked = nms_indexes(box_scores[:, :4], box_scores[:, -1], iou_threshold=iou_threshold, top_k=top_k, candidate_size=candidate_size)
         return box_scores[picked, :]
 
     def predict(self, width, height, confidences, boxes, prob_threshold=None, iou_threshold=0.3, top_k=-1):
@@ -382,30 +365,20 @@ class RFBnet(Layer):
         confidences = confidences
         if prob_threshold is not None:
             self.prob_threshold=prob_threshold
-        picked_box_probs = []
-        picked_labels = []
-        for class_index in range(1, confidences.shape[1]):
-            probs = confidences[:, class_index]
-            mask = probs > self.prob_threshold
-            probs = probs[mask]
-            if probs.shape[0] == 0:
-                continue
-            subset_boxes = boxes[mask, :]
-            box_probs = concate([subset_boxes, probs.reshape(-1, 1)], axis=1)
-            box_probs = self.hard_nms(box_probs,
-                                      iou_threshold=iou_threshold,
-                                      top_k=top_k,
-                                      )
-            picked_box_probs.append(box_probs)
-            picked_labels.extend([class_index] * box_probs.shape[0])
-        if not picked_box_probs:
+        # all the (box, class) candidates above the threshold, the suppression runs once for all classes
+        mask = confidences[:, 1:] > self.prob_threshold
+        box_index, class_index = mask.nonzero(as_tuple=True)
+        if len(box_index) == 0:
             return np.array([]), np.array([]), np.array([])
-        picked_box_probs = concate(picked_box_probs)
+        probs = confidences[:, 1:][box_index, class_index]
+        picked = batched_nms(boxes[box_index, :4], probs, class_index, iou_threshold=iou_threshold, top_k=top_k, candidate_size=200)
+        picked_box_probs = concate([boxes[box_index[picked], :4], probs[picked].reshape(-1, 1)], axis=1)
+        picked_labels = to_numpy(class_index[picked] + 1)
         picked_box_probs[:, 0] *= width
         picked_box_probs[:, 1] *= height
         picked_box_probs[:, 2] *= width
         picked_box_probs[:, 3] *= height
-        return to_numpy(picked_box_probs[:, :4]).astype(np.int32), np.array(picked_labels), to_numpy(picked_box_probs[:, 4])
+        return to_numpy(picked_box_probs[:, :4]).astype(np.int32), picked_labels, to_numpy(picked_box_probs[:, 4])
 
     def rerec(self, box, img_shape):
         """Convert box to square."""
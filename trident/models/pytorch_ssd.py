@@ -17,6 +17,7 @@ from trident.backend.tensorspec import *
 from trident.backend.pytorch_backend import to_numpy, to_tensor, Layer, Sequential,ModuleList
 from trident.backend.pytorch_ops import *
 from trident.data.bbox_common import xywh2xyxy, xyxy2xywh,bbox_giou,bbox_giou_numpy
+from trident.data.bbox_nms import nms as nms_indexes
 from trident.data.image_common import *
 from trident.data.utils import download_model_from_google_drive
 from trident.layers.pytorch_activations import get_activation, Identity, Relu, softmax
@@ -31,7 +32,7 @@ image_size = [640, 480]
 cfg = {'min_sizes': [[10, 16, 24], [32, 48], [64, 96], [128, 192, 256]], 'steps': [8, 16, 32, 64],
        'variance': [0.1, 0.2], 'clip': False, }
 
-__all__ = ['Ssd', 'encode', 'decode', 'SsdBboxDataset', 'SsdBboxDatasetV2', 'SsdDetectionModel', 'MultiBoxLoss',
+__all__ = ['Ssd', 'encode', 'decode', 'match_batch', 'pad_ground_truths', 'SsdBboxDataset', 'SsdBboxDatasetV2', 'SsdDetectionModel', 'MultiBoxLoss',
            'MultiBoxLossV2', 'IoULoss']
 
 
@@ -73,91 +74,129 @@ def jaccard(box_a, box_b):
     return inter / union  # [A,B]
 
 
+def match_batch(truths, labels, priors, variances, threshold=0.3):
+    """Match the priors with the padded ground truth boxes of a whole minibatch, then encode the location targets.
+
+    Every prior is assigned to the ground truth box of the highest jaccard overlap, every ground truth box is
+    forced on its best prior (bipartite matching, the ground truth boxes whose best overlap is under 0.2 are
+    ignored), the priors whose overlap is under threshold are background. Everything is computed by a few batched
+    tensor operations on the device of truths, without any python loop over the samples or the boxes.
+
+    Args:
+        truths (tensor): Ground truth boxes in xyxy, Shape: [batch, num_obj, 4], padded.
+        labels (tensor): Class labels of the ground truth boxes, Shape: [batch, num_obj], the padding is negative.
+        priors (tensor): Prior boxes in center-offset form, Shape: [num_priors, 4].
+        variances (list[float]): Variances of priorboxes.
+        threshold (float): The overlap threshold used when matching boxes.
+
+    Returns:
+        the location targets, Shape: [batch, num_priors, 4] and the confidence targets, Shape: [batch, num_priors].
+
+    """
+    truths = truths.float()
+    labels = labels.long()
+    priors = priors.to(truths.device).float()
+    batch, num_obj = labels.shape[0], labels.shape[1]
+    num_priors = priors.shape[0]
+    if num_obj == 0:
+        return torch.zeros((batch, num_priors, 4), device=truths.device), torch.zeros((batch, num_priors), dtype=torch.int64, device=truths.device)
+    # exact corners, xywh2xyxy rounds to pixels and the priors are normalized
+    corner_priors = torch.cat([priors[:, 0:2] - priors[:, 2:4] / 2, priors[:, 0:2] + priors[:, 2:4] / 2], 1)
+    # [batch, num_obj, num_priors] jaccard overlaps, one coordinate at a time to keep the operands contiguous
+    corner_priors = corner_priors.t().contiguous()
+    inter = torch.min(truths[:, :, 2, None], corner_priors[2]).sub_(torch.max(truths[:, :, 0, None], corner_priors[0])).clamp_(min=0)
+    inter.mul_(torch.min(truths[:, :, 3, None], corner_priors[3]).sub_(torch.max(truths[:, :, 1, None], corner_priors[1])).clamp_(min=0))
+    area_a = ((truths[:, :, 2] - truths[:, :, 0]) * (truths[:, :, 3] - truths[:, :, 1]))[:, :, None]
+    area_b = (corner_priors[2] - corner_priors[0]) * (corner_priors[3] - corner_priors[1])
+    overlaps = inter.div_((area_a + area_b).sub_(inter))
+    is_object = labels >= 0
+    overlaps = overlaps.masked_fill(~is_object[:, :, None], -1)
+
+    # (Bipartite Matching) best prior for each ground truth, best ground truth for each prior
+    best_prior_overlap, best_prior_idx = overlaps.max(2)
+    best_truth_overlap, best_truth_idx = overlaps.max(1)
+    # ensure every gt matches with its prior of max overlap, the last gt wins when they share a prior
+    objects_idx = torch.arange(num_obj, device=truths.device)[None, :].expand(batch, num_obj)
+    forced_idx = torch.full((batch, num_priors), -1, dtype=torch.int64, device=truths.device)
+    forced_idx.scatter_reduce_(1, best_prior_idx, objects_idx.masked_fill(~is_object, -1), reduce='amax')
+    best_truth_idx = torch.where(forced_idx >= 0, forced_idx, best_truth_idx)
+    # ensure best prior, the hard gt (best overlap under 0.2) are ignored
+    valid_gt = is_object & (best_prior_overlap >= 0.2)
+    forced_overlap = torch.zeros((batch, num_priors), device=truths.device)
+    forced_overlap.scatter_reduce_(1, best_prior_idx, valid_gt.float(), reduce='amax')
+    best_truth_overlap = torch.where(forced_overlap > 0, torch.full_like(best_truth_overlap, 2), best_truth_overlap)
+
+    matches = truths.gather(1, best_truth_idx[:, :, None].expand(batch, num_priors, 4))
+    conf = labels.gather(1, best_truth_idx)
+    conf = conf.masked_fill(best_truth_overlap < threshold, 0)  # label as background
+    loc = encode(matches, priors, variances)
+
+    # no valid gt at all, the sample is background only
+    has_valid = valid_gt.any(1)
+    loc = loc.masked_fill(~has_valid[:, None, None], 0)
+    conf = conf.masked_fill(~has_valid[:, None], 0)
+    return loc, conf
+
+
 def match(truths, priors, variances, labels, threshold=0.3):
     """Match each prior box with the ground truth box of the highest jaccard
     overlap, encode the bounding boxes, then return the matched indices
     corresponding to both confidence and location preds.
+
+    It is `match_batch` on a single sample, so the prior corners are exact. Formerly they were computed by
+    xywh2xyxy, which rounds them to pixels and collapses the normalized priors, the targets differ from the
+    ones of that version.
+
     Args:
 
-        truths: (tensor) Ground truth boxes, Shape: [num_obj, num_priors].
+        truths: (tensor) Ground truth boxes, Shape: [num_obj, 4].
         priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4].
         variances: (tensor) Variances corresponding to each prior coord,
             Shape: [num_priors, 4].
         labels: (tensor) All the class labels for the image, Shape: [num_obj].
-        loc_t: (tensor) Tensor to be filled w/ endcoded location targets.
-        conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds.
-        idx: (int) current batch index
         threshold: (float) The overlap threshold used when mathing boxes.
 
     Return:
         The matched indices corresponding to 1)location and 2)confidence preds.
     """
-    # jaccard index
-    priors2 = priors.clone()
-    num_priors = len(priors)
-    overlaps = jaccard(truths, xywh2xyxy(priors.clone()))
-    # (Bipartite Matching)
-    # [1,num_objects] best prior for each ground truth
-    best_prior_overlap, best_prior_idx = overlaps.max(1, keepdim=True)
-
-    # ignore hard gt
-    valid_gt_idx = best_prior_overlap[:, 0] >= 0.2
-    best_prior_idx_filter = best_prior_idx[valid_gt_idx, :]
-    if best_prior_idx_filter.shape[0] <= 0:
-        return np.zeros((num_priors, 4)).astype(np.float32), np.zeros(num_priors).astype(np.int64)
-
-    # [1,num_priors] best ground truth for each prior
-    best_truth_overlap, best_truth_idx = overlaps.max(0, keepdim=True)
-    best_truth_idx.squeeze_(0)
-    best_truth_overlap.squeeze_(0)
-    best_prior_idx.squeeze_(1)
-    best_prior_idx_filter.squeeze_(1)
-    best_prior_overlap.squeeze_(1)
-    best_truth_overlap.index_fill_(0, best_prior_idx_filter, 2)  # ensure best prior
-    # TODO refactor: index  best_prior_idx with long tensor
-    # ensure every gt matches with its prior of max overlap
-    for j in range(best_prior_idx.size(0)):
-        best_truth_idx[best_prior_idx[j]] = j
-    matches = truths[best_truth_idx]  # Shape: [num_priors,14]
-    conf = labels[best_truth_idx]  # Shape: [num_priors]
-
-    conf[best_truth_overlap < threshold] = 0  # label as background
-
-    loc = encode(matches, priors2, variances)
-    return loc, conf
+    loc, conf = match_batch(truths.unsqueeze(0), labels.unsqueeze(0), priors, variances, threshold)
+    return loc[0], conf[0]
+
+
+def pad_ground_truths(bbox, max_objects):
+    """Pad the [num_obj, 5] (xyxy, label) ground truth boxes of a sample to [max_objects, 5], the padding label is -1,
+    so the samples can be stacked in a minibatch for `match_batch`."""
+    padded = np.zeros((max_objects, 5), dtype=np.float32)
+    padded[:, 4] = -1
+    if bbox is not None and len(bbox) > 0:
+        bbox = np.asarray(bbox, dtype=np.float32)[:max_objects]
+        padded[:len(bbox)] = bbox[:, :5]
+    return padded
 
 
 def encode(matched, priors, variances):
     """
 
     Args:
-        matched (tensor): Coords of ground truth for each prior in xyxy Shape: [num_priors, 4].
+        matched (tensor): Coords of ground truth for each prior in xyxy Shape: [num_priors, 4] or [batch, num_priors, 4].
         priors (tensor): Prior boxes in center-offset form Shape: [num_priors,4].
         variances (list[float]):  Variances of priorboxes
 
     Returns:
-        encoded boxes and landmarks (tensor), Shape: [num_priors, 14]
+        encoded boxes (tensor), Shape: [num_priors, 4] or [batch, num_priors, 4]
 
     """
 
     # dist b/t match center and prior's center
-    priors = priors.clone()
-    g_cxcy = (matched[:, 0:2] + matched[:, 2:4]) / 2 - priors[:, 0:2]
+    g_cxcy = (matched[..., 0:2] + matched[..., 2:4]) / 2 - priors[:, 0:2]
     # encode variance
-    g_cxcy /= (variances[0] * priors[:, 2:4])
+    g_cxcy = g_cxcy / (variances[0] * priors[:, 2:4])
     # match wh / prior wh
-    g_wh = (matched[:, 2:4] - matched[:, 0:2]) / priors[:, 2:4]
+    g_wh = (matched[..., 2:4] - matched[..., 0:2]) / priors[:, 2:4]
     g_wh = torch.log(g_wh) / variances[1]
 
-    # # landmarks
-    # g_xy1 = (matched[:, 4:6] - priors[:, 0:2]) / (variances[0] * priors[:, 2:4])
-    # g_xy2 = (matched[:, 6:8] - priors[:, 0:2]) / (variances[0] * priors[:, 2:4])
-    # g_xy3 = (matched[:, 8:10] - priors[:, 0:2]) / (variances[0] * priors[:, 2:4])
-    # g_xy4 = (matched[:, 10:12] - priors[:, 0:2]) / (variances[0] * priors[:, 2:4])
-    # g_xy5 = (matched[:, 12:14] - priors[:, 0:2]) / (variances[0] * priors[:, 2:4])
-
     # return target for loss
-    return torch.cat([g_cxcy, g_wh], 1)  # [num_priors,14]
+    return torch.cat([g_cxcy, g_wh], -1)
 
 
 
@@ -185,14 +224,23 @@ def decode(loc, priors, variances):
 
 
 class SsdBboxDataset(BboxDataset):
+    """Bounding boxes dataset producing the SSD targets.
+
+    By default every sample is matched with the priors in the data pipeline (location and confidence targets of
+    every prior). With max_objects, the samples are only normalized and padded to max_objects boxes (the padding
+    label is -1), and the whole minibatch is matched with the priors on the training device by `MultiBoxLoss` /
+    `MultiBoxLossV2` (see `match_batch`).
+
+    """
     def __init__(self, boxes=None, image_size=None, priors=None, center_variance=0.1, size_variance=0.2,
                  gt_overlap_tolerance=0.5, expect_data_type=ExpectDataType.absolute_bbox, class_names=None,
-                 symbol='bbox', name=''):
+                 symbol='bbox', name='', max_objects=None):
         super().__init__(boxes=boxes, image_size=image_size, expect_data_type=expect_data_type, class_names=class_names,
                          symbol=symbol, name=name)
         self.priors = priors
         self.label_transform_funcs = []
         self.gt_overlap_tolerance = gt_overlap_tolerance
+        self.max_objects = max_objects
         self.bbox_post_transform_funcs = []
 
     def binding_class_names(self, class_names=None, language=None):
@@ -205,6 +253,15 @@ class SsdBboxDataset(BboxDataset):
             self._idx2lab = {k: v for k, v in enumerate(self.class_names[language])}
 
     def bbox_transform(self, bbox):
+        if self.max_objects is not None:
+            # matched with the priors by the loss, on the whole minibatch
+            if bbox is not None and len(bbox) > 0:
+                height, width = self.image_size
+                bbox = np.asarray(bbox, dtype=np.float32).copy()
+                bbox[:, 0:4:2] /= width
+                bbox[:, 1:4:2] /= height
+            padded = pad_ground_truths(bbox, self.max_objects)
+            return padded[:, :4], padded[:, 4].astype(np.int64)
         num_priors = self.priors.shape[0]
         if bbox is None or len(bbox) == 0:
             return np.zeros((num_priors, 4)).astype(np.float32), np.zeros(num_priors).astype(np.int64)
@@ -316,13 +373,10 @@ class SsdBboxDatasetV2(BboxDataset):
         best_target_per_prior, best_target_per_prior_index = np.max(ious, axis=1), np.argmax(ious, axis=1)
         # size: num_targets
         best_prior_per_target, best_prior_per_target_index = np.max(ious, axis=0), np.argmax(ious, axis=0)
-        for target_index, prior_index in enumerate(best_prior_per_target_index):
-            best_target_per_prior_index[prior_index] = target_index
+        # the last target wins when they share a prior
+        best_target_per_prior_index[best_prior_per_target_index] = np.arange(len(best_prior_per_target_index))
         # 2.0 is used to make sure every target has a prior assigned
-        best_prior_per_target_index_list = best_prior_per_target_index.tolist()
-        for i in range(best_target_per_prior.shape[0]):
-            if i in best_prior_per_target_index_list:
-                best_target_per_prior[i] = 2
+        best_target_per_prior[best_prior_per_target_index] = 2
         labels = gt_labels[best_target_per_prior_index]
         labels[best_target_per_prior < iou_threshold] = 0  # the backgournd id
         boxes = gt_boxes[best_target_per_prior_index]
@@ -384,17 +438,27 @@ def hard_negative_mining(loss, labels, neg_pos_ratio):
     return pos_mask | neg_mask
 
 
+def _assign_targets(loss, confidence, target_confidence, target_locations):
+    """The prior targets of the minibatch, matched on device when the targets are padded ground truth boxes."""
+    if target_confidence.size(1) == confidence.size(1):
+        return target_confidence, target_locations
+    with torch.no_grad():
+        return match_batch(target_locations, target_confidence, loss.priors, (loss.center_variance, loss.size_variance), loss.iou_threshold)[::-1]
+
+
 class MultiBoxLoss(nn.Module):
-    def __init__(self, priors, neg_pos_ratio, center_variance, size_variance):
+    def __init__(self, priors, neg_pos_ratio, center_variance, size_variance, iou_threshold=0.5):
         """Implement SSD Multibox Loss.
 
         Basically, Multibox loss combines classification loss
-         and Smooth L1 regression loss.
+         and Smooth L1 regression loss. The targets are either matched with the priors (num_priors per sample), or
+         the padded ground truth boxes of `SsdBboxDataset` with max_objects, matched on device by `match_batch`.
         """
         super(MultiBoxLoss, self).__init__()
         self.neg_pos_ratio = neg_pos_ratio
         self.center_variance = center_variance
         self.size_variance = size_variance
+        self.iou_threshold = iou_threshold
         self.priors = to_tensor(priors)
 
     def forward(self, confidence, locations, target_confidence, target_locations):
@@ -407,6 +471,7 @@ class MultiBoxLoss(nn.Module):
             boxes (batch_size, num_priors, 4): real boxes corresponding all the priors.
         """
         num_classes = confidence.size(2)
+        target_confidence, target_locations = _assign_targets(self, confidence, target_confidence, target_locations)
 
         # derived from cross_entropy=sum(log(p))
         with torch.no_grad():
@@ -428,16 +493,18 @@ class MultiBoxLoss(nn.Module):
 
 
 class MultiBoxLossV2(nn.Module):
-    def __init__(self, priors, neg_pos_ratio, center_variance, size_variance):
+    def __init__(self, priors, neg_pos_ratio, center_variance, size_variance, iou_threshold=0.5):
         """Implement SSD Multibox Loss.
 
         Basically, Multibox loss combines classification loss
-         and Smooth L1 regression loss.
+         and Smooth L1 regression loss. The targets are either matched with the priors (num_priors per sample), or
+         the padded ground truth boxes of `SsdBboxDataset` with max_objects, matched on device by `match_batch`.
         """
         super(MultiBoxLossV2, self).__init__()
         self.neg_pos_ratio = neg_pos_ratio
         self.center_variance = center_variance
         self.size_variance = size_variance
+        self.iou_threshold = iou_threshold
         self.priors = to_tensor(priors)
 
     def forward(self, confidence, locations, target_confidence, target_locations):
@@ -450,6 +517,7 @@ class MultiBoxLossV2(nn.Module):
             target_locations (batch_size, num_priors, 4): real boxes corresponding all the priors.
         """
         num_classes = confidence.size(2)
+        target_confidence, target_locations = _assign_targets(self, confidence, target_confidence, target_locations)
         # derived from cross_entropy=sum(log(p))
         with torch.no_grad():
             loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
@@ -753,89 +821,15 @@ class SsdDetectionModel(ImageDetectionModel):
         """
         if box_scores is None or len(box_scores) == 0:
             return None, None
-        scores = box_scores[:, -1]
-        boxes = box_scores[:, :4]
-        picked = []
-        # _, indexes = scores.sort(descending=True)
-        indexes = argsort(scores)
-        # indexes = indexes[:candidate_size]
-        indexes = indexes[-candidate_size:]
-        while len(indexes) > 0:
-            # current = indexes[0]
-            current = indexes[-1]
-            picked.append(current)
-            if 0 < top_k == len(picked) or len(indexes) == 1:
-                break
-            current_box = boxes[current, :]
-            # indexes = indexes[1:]
-            indexes = indexes[:-1]
-            rest_boxes = boxes[indexes, :]
-            iou = self.iou_of(rest_boxes, expand_dims(current_box, axis=0), )
-            indexes = indexes[iou <= iou_threshold]
-
+        picked = nms_indexes(box_scores[:, :4], box_scores[:, -1], iou_threshold=iou_threshold, top_k=top_k, candidate_size=candidate_size)
         return box_scores[picked, :], picked
 
     def nms(self, boxes, threshold=0.3):
         # if there are no boxes, return an empty list
         if len(boxes) == 0:
             return []
-
-        # initialize the list of picked indexes
-        pick = []
-
-        # grab the coordinates of the bounding boxes
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
-
-        # compute the area of the bounding boxes and sort the bounding
-        # boxes by the bottom-right y-coordinate of the bounding box
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-        idxs = np.argsort(y2)
-
-        # keep looping while some indexes still remain in the indexes
-        # list
-        while len(idxs) > 0:
-            # grab the last index in the indexes list, add the index
-            # value to the list of picked indexes, then initialize
-            # the suppression list (i.e. indexes that will be deleted)
-            # using the last index
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
-            suppress = [last]
-
-            # loop over all indexes in the indexes list
-            for pos in range(0, last):
-                # grab the current index
-                j = idxs[pos]
-
-                # find the largest (x, y) coordinates for the start of
-                # the bounding box and the smallest (x, y) coordinates
-                # for the end of the bounding box
-                xx1 = max(x1[i], x1[j])
-                yy1 = max(y1[i], y1[j])
-                xx2 = min(x2[i], x2[j])
-                yy2 = min(y2[i], y2[j])
-
-                # compute the width and height of the bounding box
-                w = max(0, xx2 - xx1 + 1)
-                h = max(0, yy2 - yy1 + 1)
-
-                # compute the ratio of overlap between the computed
-                # bounding box and the bounding box in the area list
-                overlap = float(w * h) / area[j]
-
-                # if there is sufficient overlap, suppress the
-                # current bounding box
-                if overlap > threshold:
-                    suppress.append(pos)
-
-            # delete all indexes from the index list that are in the
-            # suppression list
-            idxs = np.delete(idxs, suppress)
-
+        # boxes are visited by their bottom-right y-coordinate, the overlap is measured over the area of the suppressed box
+        pick = nms_indexes(boxes[:, :4], boxes[:, 3], iou_threshold=threshold, mode='iof', offset=1)
         # return only the bounding boxes that were picked
         return boxes[pick], pick
 
@@ -860,7 +854,7 @@ class SsdDetectionModel(ImageDetectionModel):
                     torch.device("cuda" if self._model.weights[0].data.is_cuda else "cpu")).to(
                     self._model.weights[0].data.dtype)
 
-                confidence, boxes = self._model(inp)
+                confidence, boxes = self.inference_model(inp)
                 boxes = boxes[0]
                 confidence = confidence[0]
                 probs, label = confidence.data.max(-1)
@@ -26,6 +26,7 @@ from trident.backend.pytorch_backend import Layer, Sequential, get_device
 from trident.backend.pytorch_ops import *
 from trident.data.image_common import *
 from trident.data.bbox_common import *
+from trident.data.bbox_nms import nms as nms_indexes
 from trident.data.utils import download_model_from_google_drive
 from trident.layers.pytorch_activations import get_activation, Identity, Mish, LeakyRelu
 from trident.layers.pytorch_blocks import *
@@ -362,89 +363,15 @@ class YoloDetectionModel(ImageDetectionModel):
         """
         if box_scores is None or len(box_scores) == 0:
             return None, None
-        scores = box_scores[:, -1]
-        boxes = box_scores[:, :4]
-        picked = []
-        # _, indexes = scores.sort(descending=True)
-        indexes = np.argsort(scores)
-        # indexes = indexes[:candidate_size]
-        indexes = indexes[-candidate_size:]
-        while len(indexes) > 0:
-            # current = indexes[0]
-            current = indexes[-1]
-            picked.append(current)
-            if 0 < top_k == len(picked) or len(indexes) == 1:
-                break
-            current_box = boxes[current, :]
-            # indexes = indexes[1:]
-            indexes = indexes[:-1]
-            rest_boxes = boxes[indexes, :]
-            iou = self.iou_of(rest_boxes, np.expand_dims(current_box, axis=0), )
-            indexes = indexes[iou <= iou_threshold]
-
+        picked = nms_indexes(box_scores[:, :4], box_scores[:, -1], iou_threshold=iou_threshold, top_k=top_k, candidate_size=candidate_size)
         return box_scores[picked, :], picked
 
     def nms(self, boxes, threshold=0.3):
         # if there are no boxes, return an empty list
         if len(boxes) == 0:
             return []
-
-        # initialize the list of picked indexes
-        pick = []
-
-        # grab the coordinates of the bounding boxes
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
-
-        # compute the area of the bounding boxes and sort the bounding
-        # boxes by the bottom-right y-coordinate of the bounding box
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-        idxs = np.argsort(y2)
-
-        # keep looping while some indexes still remain in the indexes
-        # list
-        while len(idxs) > 0:
-            # grab the last index in the indexes list, add the index
-            # value to the list of picked indexes, then initialize
-            # the suppression list (i.e. indexes that will be deleted)
-            # using the last index
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
-            suppress = [last]
-
-            # loop over all indexes in the indexes list
-            for pos in range(0, last):
-                # grab the current index
-                j = idxs[pos]
-
-                # find the largest (x, y) coordinates for the start of
-                # the bounding box and the smallest (x, y) coordinates
-                # for the end of the bounding box
-                xx1 = max(x1[i], x1[j])
-                yy1 = max(y1[i], y1[j])
-                xx2 = min(x2[i], x2[j])
-                yy2 = min(y2[i], y2[j])
-
-                # compute the width and height of the bounding box
-                w = max(0, xx2 - xx1 + 1)
-                h = max(0, yy2 - yy1 + 1)
-
-                # compute the ratio of overlap between the computed
-                # bounding box and the bounding box in the area list
-                overlap = float(w * h) / area[j]
-
-                # if there is sufficient overlap, suppress the
-                # current bounding box
-                if overlap > threshold:
-                    suppress.append(pos)
-
-            # delete all indexes from the index list that are in the
-            # suppression list
-            idxs = np.delete(idxs, suppress)
-
+        # boxes are visited by their bottom-right y-coordinate, the overlap is measured over the area of the suppressed box
+        pick = nms_indexes(boxes[:, :4], boxes[:, 3], iou_threshold=threshold, mode='iof', offset=1)
         # return only the bounding boxes that were picked
         return boxes[pick], pick
 
@@ -466,7 +393,7 @@ class YoloDetectionModel(ImageDetectionModel):
 
                 img = image_backend_adaption(img)
                 inp = to_tensor(np.expand_dims(img, 0)).to(self.device).to(self._model.weights[0].data.dtype)
-                boxes = self._model(inp)[0]
+                boxes = self.inference_model(inp)[0]
                 if verbose:
                     print(min(boxes[:, 4]),max(boxes[:, 4]))
                 mask = boxes[:, 4] > self.detection_threshold
@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from trident.backend.common import PrintException, split_path
+
+__all__ = ['CheckpointWriter']
+
+_live_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_live_writers():
+    for writer in list(_live_writers):
+        writer.close()
+
+
+class CheckpointWriter(object):
+    """Write checkpoints in a background thread with a single atomic rename per file.
+
+    The caller snapshots everything it needs to host memory and submits a ``write_fn(path)``, the writer
+    calls it with a temporary file in the destination folder and then renames it over the destination
+    (`os.replace` is atomic), so a crash in the middle of a save never leaves a truncated checkpoint.
+
+    With ``max_to_keep`` every save is also kept as a versioned file ``<name>-<version><ext>``, the
+    destination becomes a hard link of the latest version and only the last ``max_to_keep`` versions
+    are kept.
+
+    Args:
+        max_to_keep (int): the number of versioned checkpoints to keep, None to only keep the latest one.
+        asynchronous (bool): write in the background thread, if False the write happens in submit.
+        max_pending (int): maximum number of queued writes, submit blocks when the disk cannot keep up.
+
+    Examples:
+        >>> import pickle
+        >>> writer = CheckpointWriter(asynchronous=False)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'model.pkl')
+        >>> writer.submit(path, lambda p: pickle.dump({'a': 1}, open(p, 'wb')))
+        >>> pickle.load(open(path, 'rb'))
+        {'a': 1}
+
+    """
+
+    def __init__(self, max_to_keep=None, asynchronous=True, max_pending=2):
+        self.max_to_keep = max_to_keep
+        self.asynchronous = asynchronous
+        self.queue = Queue.Queue(maxsize=max(int(max_pending), 1))
+        self.last_error = None
+        self._thread = None
+        self._lock = threading.Lock()
+        _live_writers.add(self)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='checkpoint_writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                self._write(*task)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, save_path, write_fn, version):
+        folder, filename, ext = split_path(save_path)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + filename, suffix='.tmp', dir=folder if len(folder) > 0 else None)
+            os.close(fd)
+            write_fn(tmp_path)
+            if self.max_to_keep is None or version is None:
+                os.replace(tmp_path, save_path)
+            else:
+                versioned_path = os.path.join(folder, '{0}-{1}{2}'.format(filename, version, ext))
+                os.replace(tmp_path, versioned_path)
+                tmp_path = versioned_path + '.tmp'
+                try:
+                    os.link(versioned_path, tmp_path)
+                except OSError:
+                    shutil.copy(versioned_path, tmp_path)
+                os.replace(tmp_path, save_path)
+                self._rotate(folder, filename, ext)
+            tmp_path = None
+        except Exception as e:
+            self.last_error = e
+            print(e)
+            PrintException()
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _rotate(self, folder, filename, ext):
+        versions = glob.glob(os.path.join(glob.escape(folder), glob.escape(filename) + '-*' + glob.escape(ext)))
+        versions = sorted(versions, key=os.path.getmtime)
+        for path in versions[:max(len(versions) - int(self.max_to_keep), 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def submit(self, save_path, write_fn, version=None):
+        """Schedule a checkpoint write.
+
+        Args:
+            save_path (str): the destination.
+            write_fn (callable): write the checkpoint into the path it receives, everything it uses
+                should already be a host copy, the training keeps running while it is written.
+            version (int or str): the version suffix used by the keep-last-N rotation (ex. the step).
+
+        """
+        if not self.asynchronous:
+            self._write(save_path, write_fn, version)
+            return
+        self._ensure_thread()
+        self.queue.put((save_path, write_fn, version))
+
+    def wait(self):
+        """Block until all the submitted checkpoints are written."""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Write the pending checkpoints and stop the background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+        _live_writers.discard(self)
@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.parameter import Parameter
+
+from trident.backend.common import enforce_singleton
+from trident.backend.pytorch_backend import Layer, Sequential
+from trident.backend.pytorch_ops import relu, relu6, leaky_relu, sigmoid, tanh
+from trident.layers.pytorch_activations import Identity, Relu, Relu6, LeakyRelu, Sigmoid, Tanh
+from trident.layers.pytorch_layers import Dense, Dropout, Conv1d, Conv2d, Conv3d, DepthwiseConv1d, DepthwiseConv2d, SeparableConv2d
+from trident.layers.pytorch_normalizations import BatchNorm
+
+__all__ = ['optimize_for_inference', 'fold_batchnorm']
+
+
+class _InplaceActivation(Layer):
+    """An elementwise activation computed in place, it replaces the activation of a freshly computed output."""
+
+    def __init__(self, activation='relu', slope=0.2, name=None):
+        super(_InplaceActivation, self).__init__(name=name)
+        self.activation = activation
+        self.slope = slope
+        self._built = True
+
+    def forward(self, *x):
+        x = enforce_singleton(x)
+        if self.activation == 'relu':
+            return torch.relu_(x)
+        elif self.activation == 'relu6':
+            return F.hardtanh_(x, 0., 6.)
+        elif self.activation == 'leaky_relu':
+            return F.leaky_relu_(x, self.slope)
+        elif self.activation == 'sigmoid':
+            return torch.sigmoid_(x)
+        elif self.activation == 'tanh':
+            return torch.tanh_(x)
+        raise ValueError('{0} has no in-place implementation.'.format(self.activation))
+
+    def extra_repr(self):
+        return 'activation={0}'.format(self.activation) + (', slope={0}'.format(self.slope) if self.activation == 'leaky_relu' else '')
+
+
+def _inplace_activation(activation):
+    """The in-place equivalent of an activation (function or layer), None if it has none."""
+    if activation is relu or isinstance(activation, (Relu, nn.ReLU)):
+        return _InplaceActivation('relu')
+    elif activation is relu6 or isinstance(activation, (Relu6, nn.ReLU6)):
+        return _InplaceActivation('relu6')
+    elif activation is leaky_relu:
+        return _InplaceActivation('leaky_relu', 0.2)
+    elif isinstance(activation, LeakyRelu):
+        return _InplaceActivation('leaky_relu', activation.alpha)
+    elif isinstance(activation, nn.LeakyReLU):
+        return _InplaceActivation('leaky_relu', activation.negative_slope)
+    elif activation is sigmoid or isinstance(activation, (Sigmoid, nn.Sigmoid)):
+        return _InplaceActivation('sigmoid')
+    elif activation is tanh or isinstance(activation, (Tanh, nn.Tanh)):
+        return _InplaceActivation('tanh')
+    return None
+
+
+def _is_observed(module):
+    """Its output is kept or hooked, so it cannot be overwritten by an in-place activation."""
+    return getattr(module, 'keep_output', False) == True or len(module._forward_hooks) > 0
+
+
+def _foldable_target(module):
+    """The layer owning the weight and bias a following batch normalization can be folded into, None if there is none."""
+    if isinstance(module, SeparableConv2d):
+        # the depthwise part is followed by the pointwise convolution, the batchnorm folds into the latter
+        return _foldable_target(module.pointwise) if module.pointwise is not None else None
+    if isinstance(module, (Conv1d, Conv2d, Conv3d, DepthwiseConv1d, DepthwiseConv2d)):
+        if module.transposed or getattr(module, 'activation', None) is not None:
+            return None
+    elif isinstance(module, Dense):
+        if module.activation is not None or getattr(module, 'kernel_regularizer', None) is not None:
+            return None
+    elif not isinstance(module, (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.Linear)):
+        return None
+    # spectral normalization recomputes the weight on every call
+    if not isinstance(getattr(module, 'weight', None), torch.Tensor) or hasattr(module, 'weight_orig'):
+        return None
+    return module
+
+
+def _is_foldable_batchnorm(module):
+    if isinstance(module, BatchNorm):
+        if getattr(module, 'in_sequence', False) or not module._built:
+            return False
+    elif not isinstance(module, nn.modules.batchnorm._BatchNorm):
+        return False
+    return getattr(module, 'running_mean', None) is not None and getattr(module, 'running_var', None) is not None
+
+
+def fold_batchnorm(layer, norm):
+    """Fold the (eval mode) batch normalization that follows a convolution or a dense layer into its weight and bias.
+
+    Args:
+        layer (Layer): the convolution or dense layer.
+        norm (BatchNorm): the batch normalization applied to its output.
+
+    Returns:
+        True if the batch normalization was folded, the layer is then unchanged otherwise.
+
+    """
+    target = _foldable_target(layer)
+    if target is None or not _is_foldable_batchnorm(norm) or target.weight.shape[0] != norm.running_mean.shape[0]:
+        return False
+    with torch.no_grad():
+        scale = torch.rsqrt(norm.running_var.float() + norm.eps)
+        shift = -norm.running_mean.float() * scale
+        if norm.weight is not None:
+            scale = scale * norm.weight.float()
+            shift = shift * norm.weight.float() + norm.bias.float()
+        weight = target.weight
+        weight.mul_(scale.reshape([-1] + [1] * (weight.dim() - 1)).to(weight.dtype))
+        if target.bias is None:
+            target.bias = Parameter(shift.to(device=weight.device, dtype=weight.dtype))
+            if hasattr(target, 'use_bias'):
+                target.use_bias = True
+        else:
+            target.bias.mul_(scale.to(target.bias.dtype)).add_(shift.to(target.bias.dtype))
+    return True
+
+
+def _optimize_sequential(module, counter):
+    names = list(module._modules.keys())
+    # conv -> batchnorm
+    for i in range(len(names) - 1):
+        current, following = module._modules[names[i]], module._modules[names[i + 1]]
+        if current is not None and following is not None and fold_batchnorm(current, following):
+            module._modules[names[i + 1]] = Identity()
+            counter['folded_batchnorm'] += 1
+    # identity and dropout are no-op at inference
+    for name in names:
+        if isinstance(module._modules[name], (Identity, Dropout, nn.Identity, nn.Dropout)) and len(module._modules) > 1:
+            del module._modules[name]
+            counter['removed'] += 1
+    # an elementwise activation of a fresh output runs in place
+    names = list(module._modules.keys())
+    for i in range(1, len(names)):
+        previous, current = module._modules[names[i - 1]], module._modules[names[i]]
+        if (_foldable_target(previous) is not None or _is_foldable_batchnorm(previous)) and not _is_observed(previous) and not _is_observed(current):
+            inplace = _inplace_activation(current)
+            if inplace is not None:
+                module._modules[names[i]] = inplace
+                counter['inplace_activation'] += 1
+
+
+def _optimize_block(module, counter):
+    """The conv -> norm -> activation blocks (Conv2d_Block, DepthwiseConv2d_Block...)."""
+    if getattr(module, 'sequence_rank', 'cna') != 'cna' or not isinstance(module._modules.get('conv'), nn.Module):
+        return
+    norm = module._modules.get('norm')
+    if norm is not None and fold_batchnorm(module.conv, norm):
+        module._modules['norm'] = None
+        counter['folded_batchnorm'] += 1
+    activation = getattr(module, 'activation', None)
+    if activation is not None and not _is_observed(module.conv) and (module.norm is None or not _is_observed(module.norm)):
+        inplace = _inplace_activation(activation)
+        if inplace is not None:
+            module.activation = inplace
+            counter['inplace_activation'] += 1
+
+
+def _optimize(module, counter):
+    for child in list(module.children()):
+        _optimize(child, counter)
+    if isinstance(module, (Sequential, nn.Sequential)):
+        _optimize_sequential(module, counter)
+    elif 'conv' in module._modules and 'norm' in module._modules:
+        _optimize_block(module, counter)
+
+
+def optimize_for_inference(model, inplace=False, sample_input=None, atol=1e-4):
+    """Return a frozen copy of the model for inference.
+
+    The batch normalizations following a convolution or a dense layer (in a Sequential or in a conv -> norm ->
+    activation block) are folded into their weights and bias, the Identity and Dropout layers of the Sequentials are
+    removed and the elementwise activations (relu, relu6, leaky relu, sigmoid, tanh) of a freshly computed output
+    are computed in place. The model is in eval mode, its parameters do not require gradient and its layers use the
+    fast dispatch (see `set_fast_dispatch`).
+
+    Args:
+        model (Layer): the model to optimize.
+        inplace (bool): modify the model itself instead of a copy.
+        sample_input (Tensor): if given, the outputs of the original and the optimized model are compared on it.
+        atol (float): the tolerance of the comparison.
+
+    Returns:
+        the optimized model
+
+    Examples:
+        >>> net = Sequential(Conv2d((3, 3), 8, use_bias=False), BatchNorm(), Relu(), Dropout(0.2))  # doctest: +SKIP
+        >>> fast_net = optimize_for_inference(net, sample_input=torch.randn(2, 3, 32, 32))  # doctest: +SKIP
+
+    """
+    if not isinstance(model, nn.Module):
+        raise ValueError('Only Layer or nn.Module can be optimized, yours model is {0}'.format(type(model)))
+    optimized = model if inplace else copy.deepcopy(model)
+    optimized.eval()
+    counter = {'folded_batchnorm': 0, 'removed': 0, 'inplace_activation': 0}
+    _optimize(optimized, counter)
+    for param in optimized.parameters():
+        param.requires_grad_(False)
+    if isinstance(optimized, Layer):
+        optimized.enable_fast_dispatch(True)
+    object.__setattr__(optimized, 'inference_optimizations', counter)
+
+    if sample_input is not None and not inplace:
+        was_training = model.training
+        model.eval()
+        with torch.no_grad():
+            expected = enforce_singleton(model(sample_input))
+            result = enforce_singleton(optimized(sample_input))
+        model.train(was_training)
+        if isinstance(expected, torch.Tensor) and isinstance(result, torch.Tensor):
+            difference = (expected.float() - result.float()).abs().max().item()
+            if difference > atol:
+                raise ValueError('The optimized model differs from the original model by {0:.6f} (> {1}).'.format(difference, atol))
+    return optimized
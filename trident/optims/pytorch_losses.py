@@ -149,6 +149,9 @@ class _ClassificationLoss(Loss):
         elif target.dtype != str2dtype('long') and (target.min() >= 0 and target.max() <= 1 and abs(output_exp.sum(-1).mean() - 1) < 1e-4):
             target = clip(target, min=1e-8, max=1 - 1e-8)
             self.is_target_onehot = True
+        elif target.is_floating_point() and target.shape == output.shape:
+            # a class distribution per sample (mixup, cutmix, distillation)
+            self.is_target_onehot = True
 
         # need target onehot but currently not
         if  target.dtype==torch.long and self.need_target_onehot == True and self.is_target_onehot == False:
@@ -415,9 +418,8 @@ class CrossEntropyLoss(_ClassificationLoss):
         Returns:
 
         """
-        if not self.need_target_onehot:
-            if self.is_target_onehot:
-                target=argmax(target,self.axis)
+        if not self.need_target_onehot and not self.is_target_onehot:
+            # class indexes, the one-hot and soft targets are handled below as class distributions
             if self.is_logsoftmax == False:
                 loss = torch.nn.functional.cross_entropy(output, target, self.sample_weight, ignore_index=self.ignore_index, reduction='none')
             else:
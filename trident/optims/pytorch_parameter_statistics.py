@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+__all__ = ['parameter_statistics', 'ParameterStatistics']
+
+_statistic_names = ['norm', 'mean_abs', 'mean', 'max_abs', 'nonfinite']
+
+
+def _foreach_norm(tensors, ord):
+    if hasattr(torch, '_foreach_norm'):
+        try:
+            return list(torch._foreach_norm(tensors, ord))
+        except (RuntimeError, TypeError):
+            pass
+    return [torch.linalg.vector_norm(t, ord) for t in tensors]
+
+
+def parameter_statistics(tensors, bins=16, log_range=(-10, 2)):
+    """Summary statistics of a list of tensors (gradients or weights), computed on device without synchronization.
+
+    The norms, absolute sums and maxima of all the tensors are computed by batched reductions
+    (``torch._foreach_norm``). The sums, the NaN/Inf counts and the histograms are segment reductions over a single
+    concatenated buffer, the histogram of every tensor is the histogram of ``log10(|x|)`` on the fixed range
+    ``log_range`` (the values out of range are clamped to the first or last bin), so no range has to be read back
+    from the device. The tensors without elements have a row of zeros.
+
+    Args:
+        tensors (list of Tensor): the tensors, on the same device.
+        bins (int): the number of histogram bins.
+        log_range (tuple): the range of the log10 magnitudes covered by the histogram.
+
+    Returns:
+        a float32 tensor of shape (len(tensors), 5 + bins) on the device of the tensors, the columns are the l2
+        norm, the mean absolute value, the mean, the maximum absolute value, the number of NaN/Inf elements and
+        the histogram.
+
+    Examples:
+        >>> stats = parameter_statistics([torch.ones(2, 2), torch.zeros(0), torch.tensor([3., -4.])], bins=4)
+        >>> stats[:, :5].tolist()
+        [[2.0, 1.0, 1.0, 1.0, 0.0], [0.0, 0.0, 0.0, 0.0, 0.0], [5.0, 3.5, -0.5, 4.0, 0.0]]
+        >>> stats[:, 5:].sum(1).tolist()
+        [4.0, 0.0, 2.0]
+
+    """
+    device = tensors[0].device
+    results = torch.zeros(len(tensors), len(_statistic_names) + bins, dtype=torch.float32, device=device)
+    indexes = [i for i, t in enumerate(tensors) if t.numel() > 0]
+    if len(indexes) == 0:
+        return results
+    tensors = [tensors[i].detach() for i in indexes]
+    numels = torch.tensor([t.numel() for t in tensors], dtype=torch.int64, device=device)
+    norms = torch.stack(_foreach_norm(tensors, 2)).float()
+    l1_norms = torch.stack(_foreach_norm(tensors, 1)).float()
+    max_abs = torch.stack(_foreach_norm(tensors, float('inf'))).float()
+
+    # one buffer, the segment of every element is its tensor
+    values = torch.cat([t.reshape(-1).float() for t in tensors])
+    layers = torch.arange(len(tensors), dtype=torch.int32, device=device)
+    segments = torch.cat([layers[i].expand(t.numel()) for i, t in enumerate(tensors)])
+    sums = torch.zeros(len(tensors), dtype=torch.float32, device=device).index_add_(0, segments, values)
+
+    # the buffer is reused in place for the log magnitudes then the bins, every tensor has two extra bins counting
+    # its NaN and its Inf (the Inf are also in the last bin)
+    low, high = float(log_range[0]), float(log_range[1])
+    values.abs_().add_(1e-30).log10_()
+    is_nan, is_inf = torch.isnan(values), values == float('inf')
+    values.clamp_(low, high).sub_(low).mul_(bins / (high - low)).clamp_(max=bins - 1)
+    values.masked_fill_(is_nan, bins).masked_fill_(is_inf, bins + 1)
+    bin_indexes = values.to(torch.int32).add_(segments.mul_(bins + 2))
+    counts = torch.zeros(len(tensors) * (bins + 2), dtype=torch.float32, device=device)
+    counts = counts.index_add_(0, bin_indexes, torch.ones(1, dtype=torch.float32, device=device).expand_as(values)).reshape(len(tensors), bins + 2)
+    histograms = counts[:, :bins].clone()
+    histograms[:, -1] += counts[:, bins + 1]
+    nonfinite = counts[:, bins] + counts[:, bins + 1]
+
+    statistics = torch.cat([torch.stack([norms, l1_norms / numels, sums / numels, max_abs, nonfinite], dim=1), histograms], dim=1)
+    if len(indexes) == len(results):
+        return statistics
+    results[torch.tensor(indexes, dtype=torch.int64, device=device)] = statistics
+    return results
+
+
+class ParameterStatistics(object):
+    """Bounded history of the per-layer statistics of the gradients or the weights of a model.
+
+    `collect` computes the statistics of all the layers on device (see `parameter_statistics`) and keeps the small
+    summary tensor on device, the pending summaries are brought to host, all at once with a single transfer, when
+    the history is read. Only the last ``capacity`` steps are kept, in a ring buffer of shape
+    (capacity, layers, statistics).
+
+    Args:
+        capacity (int): the number of steps kept.
+        bins (int): the number of histogram bins.
+        log_range (tuple): the range of the log10 magnitudes covered by the histograms.
+
+    Examples:
+        >>> history = ParameterStatistics(capacity=2, bins=4)
+        >>> for step in range(3):
+        ...     history.collect(step, [('weight', torch.full((2, 2), float(step + 1)))])
+        >>> history.steps.tolist(), history.get('norm')[:, 0].tolist()
+        ([1, 2], [4.0, 6.0])
+
+    """
+
+    def __init__(self, capacity=256, bins=16, log_range=(-10, 2)):
+        self.capacity = max(int(capacity), 1)
+        self.bins = bins
+        self.log_range = log_range
+        self.reset()
+
+    def reset(self):
+        self.names = []
+        self._steps = np.zeros(self.capacity, dtype=np.int64)
+        self._values = None
+        self._size = 0
+        self._next = 0
+        self._pending = []
+
+    def collect(self, step, named_tensors):
+        """Append the statistics of the (name, tensor) pairs at step, the None tensors are skipped."""
+        named_tensors = [(k, v) for k, v in named_tensors if v is not None]
+        if len(named_tensors) == 0:
+            return
+        names = [k for k, _ in named_tensors]
+        if names != self.names:
+            # another set of layers (frozen or unfrozen parameters), the history restarts
+            self.flush()
+            self.reset()
+            self.names = names
+        self._pending.append((int(step), parameter_statistics([v for _, v in named_tensors], self.bins, self.log_range)))
+        if len(self._pending) >= self.capacity:
+            self.flush()
+
+    def flush(self):
+        """Bring the pending device summaries to host with a single transfer."""
+        if len(self._pending) == 0:
+            return
+        pending = self._pending[-self.capacity:]
+        self._pending = []
+        values = torch.stack([v for _, v in pending], dim=0).cpu().numpy()
+        if self._values is None:
+            self._values = np.zeros((self.capacity,) + values.shape[1:], dtype=np.float32)
+        for (step, _), value in zip(pending, values):
+            self._steps[self._next] = step
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def _order(self):
+        self.flush()
+        if self._size < self.capacity:
+            return np.arange(self._size)
+        return (np.arange(self.capacity) + self._next) % self.capacity
+
+    @property
+    def steps(self):
+        return self._steps[self._order()]
+
+    def get(self, statistic, name=None):
+        """The history of a statistic ('norm', 'mean_abs', 'mean', 'max_abs', 'nonfinite' or 'histogram'), of shape
+        (steps, layers) (or (steps, layers, bins) for the histogram), or (steps,) for a single layer."""
+        order = self._order()
+        if self._values is None:
+            return np.zeros((0,))
+        if statistic == 'histogram':
+            values = self._values[order][:, :, len(_statistic_names):]
+        elif statistic in _statistic_names:
+            values = self._values[order][:, :, _statistic_names.index(statistic)]
+        else:
+            raise ValueError('{0} is not a valid statistic, valid statistics are {1}.'.format(statistic, _statistic_names + ['histogram']))
+        return values if name is None else values[:, self.names.index(name)]
+
+    def last(self):
+        """The statistics of the last step as an OrderedDict keyed by the layer names."""
+        order = self._order()
+        if len(order) == 0:
+            return OrderedDict()
+        value = self._values[order[-1]]
+        return OrderedDict([(name, OrderedDict([(s, float(value[i, j])) for j, s in enumerate(_statistic_names)] + [('histogram', value[i, len(_statistic_names):].copy())]))
+                            for i, name in enumerate(self.names)])
+
+    def __len__(self):
+        return min(self._size + len(self._pending), self.capacity)
+
+    def __repr__(self):
+        return 'ParameterStatistics(layers={0}, steps={1}, capacity={2})'.format(len(self.names), len(self), self.capacity)
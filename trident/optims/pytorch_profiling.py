@@ -1,126 +1,294 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import os
 import time
+from collections import OrderedDict
 
+import numpy as np
 import torch
-from torch.autograd import Function
-from torch.autograd import Variable
-
-"""
-https://raw.githubusercontent.com/zhuwenxi/pytorch-profiling-tool/master/profiling.py
-"""
-
-class Profiling(object):
-    def __init__(self, model):
-        if isinstance(model, torch.nn.Module) is False:
-            print("Not a valid model, please provide a 'nn.Module' instance.")
-
+import torch.nn as nn
+
+__all__ = ['Profiler', 'Profiling']
+
+
+def _first_tensor(x):
+    if isinstance(x, torch.Tensor):
+        return x
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple)):
+        for item in x:
+            t = _first_tensor(item)
+            if t is not None:
+                return t
+    return None
+
+
+def _activation_bytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple)):
+        return sum([_activation_bytes(item) for item in x])
+    return 0
+
+
+def _layer_flops(module, output):
+    """Multiply-accumulate based FLOPs of the layers owning a weight matrix or kernel (dense and convolution), 0 for the others."""
+    weight = getattr(module, 'weight', None)
+    output = _first_tensor(output)
+    if not isinstance(weight, torch.Tensor) or weight.dim() < 2 or output is None or weight.shape[0] == 0:
+        return 0
+    return int(2 * weight.numel() * (output.numel() // weight.shape[0]))
+
+
+class _Event(object):
+    """Host timestamp and, on cuda, a timing event recorded on the current stream."""
+    __slots__ = ('wall', 'cuda')
+
+    def __init__(self, use_cuda):
+        self.wall = time.perf_counter()
+        self.cuda = None
+        if use_cuda:
+            self.cuda = torch.cuda.Event(enable_timing=True)
+            self.cuda.record()
+
+
+class Profiler(object):
+    """Per-layer and per-phase profiler of a training step.
+
+    Only the steps between `start_step` and `end_step` are recorded, the layer hooks are attached for those steps
+    only, so the other steps run untouched. For every leaf layer it records the forward and backward wall time,
+    the cuda time when the model runs on cuda, the activation memory and the FLOPs of dense and convolution layers.
+    The training loop reports its own phases (data loading, host to device copy, loss, backward, optimizer step,
+    callbacks...) with `phase` or `record`.
+
+    The backward time of a layer is measured between the moment the gradient of its output is ready and the moment
+    the gradient of its input is ready, a layer whose input does not require gradient (the first layer) has no
+    backward record.
+
+    Args:
+        model (nn.Module): the model to profile, None to only record phases.
+        use_cuda (bool): also record cuda time with cuda events, default when the model parameters are on cuda.
+        record_layers (bool): attach the per-layer hooks.
+
+    Examples:
+        >>> profiler = Profiler(nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 2)))
+        >>> profiler.start_step(0)
+        >>> with profiler.phase('forward'):
+        ...     loss = profiler.model(torch.randn(3, 4, requires_grad=True)).sum()
+        >>> with profiler.phase('backward'):
+        ...     loss.backward()
+        >>> profiler.end_step()
+        >>> sorted(profiler.layer_stats.keys())
+        ['0', '1', '2']
+        >>> profiler.layer_stats['0']['flops']
+        192
+
+    """
+
+    def __init__(self, model=None, use_cuda=None, record_layers=True):
         self.model = model
-        self.record = {'forward': [], 'backward': []}
-        self.profiling_on = True
-        self.origin_call = {}
-        self.hook_done = False
-        self.layer_num = 0
+        if use_cuda is None:
+            use_cuda = False
+            if isinstance(model, nn.Module) and torch.cuda.is_available():
+                use_cuda = any([p.is_cuda for p in model.parameters()])
+        self.use_cuda = use_cuda
+        self.record_layers = record_layers and isinstance(model, nn.Module)
+        self.is_active = False
+        self.num_steps = 0
+        self.trace_events = []
+        self.phase_stats = OrderedDict()
+        self.layer_stats = OrderedDict()
+        self._handles = []
+        self._pending = []
+        self._phases = []
+        self._step = None
+        self._origin = time.perf_counter()
+
+    def _timestamp(self, wall):
+        return (wall - self._origin) * 1e6
+
+    def _attach(self):
+        for name, module in self.model.named_modules():
+            if len(module._modules) > 0:
+                continue
+            if name == '':
+                name = module.__class__.__name__
+            self._handles.append(module.register_forward_pre_hook(self._make_pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._make_post_hook(name)))
+
+    def _detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _make_pre_hook(self, name):
+        def pre_hook(module, input):
+            if not self.is_active:
+                return None
+            start = _Event(self.use_cuda)
+            module._profiler_start = start
+            first_input = _first_tensor(input)
+            if first_input is not None and first_input.requires_grad:
+                pending = {}
+                module._profiler_backward = pending
+
+                def input_grad_hook(grad):
+                    pending['end'] = _Event(self.use_cuda)
+                first_input.register_hook(input_grad_hook)
+            else:
+                module._profiler_backward = None
+            return None
+        return pre_hook
+
+    def _make_post_hook(self, name):
+        def post_hook(module, input, output):
+            if not self.is_active or getattr(module, '_profiler_start', None) is None:
+                return None
+            end = _Event(self.use_cuda)
+            record = {'name': name, 'layer': module.__class__.__name__, 'forward': (module._profiler_start, end),
+                      'memory': _activation_bytes(output), 'flops': _layer_flops(module, output), 'backward': None}
+            pending = module._profiler_backward
+            first_output = _first_tensor(output)
+            if pending is not None and first_output is not None and first_output.requires_grad:
+                def output_grad_hook(grad):
+                    pending['start'] = _Event(self.use_cuda)
+                first_output.register_hook(output_grad_hook)
+                record['backward'] = pending
+            module._profiler_start = None
+            module._profiler_backward = None
+            self._pending.append(record)
+            return None
+        return post_hook
+
+    def start_step(self, step=None):
+        """Start recording a training step."""
+        self.is_active = True
+        self._step = step
+        self._pending = []
+        self._phases = []
+        if self.record_layers and len(self._handles) == 0:
+            self._attach()
+
+    def end_step(self):
+        """Stop recording, resolve the cuda timings (one synchronization) and aggregate the step."""
+        if not self.is_active:
+            return
+        self.is_active = False
+        self._detach()
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        self.num_steps += 1
+        for name, category, start, end in self._phases:
+            self._collect(self.phase_stats, name, category, start, end, {'category': category})
+        for record in self._pending:
+            info = self._collect(self.layer_stats, record['name'], 'forward', record['forward'][0], record['forward'][1],
+                                 {'layer': record['layer'], 'memory': record['memory'], 'flops': record['flops']}, prefix='forward')
+            backward = record['backward']
+            if backward is not None and 'start' in backward and 'end' in backward:
+                self._collect(self.layer_stats, record['name'], 'backward', backward['start'], backward['end'], {}, prefix='backward')
+            info['calls'] += 1
+        self._pending = []
+        self._phases = []
+
+    def _collect(self, stats, name, category, start, end, extra, prefix=None):
+        wall = (end.wall - start.wall) * 1000
+        cuda = start.cuda.elapsed_time(end.cuda) if start.cuda is not None and end.cuda is not None else None
+        if name not in stats:
+            stats[name] = OrderedDict([('calls', 0), ('wall_ms', 0.0), ('cuda_ms', 0.0)])
+            if prefix is not None:
+                stats[name] = OrderedDict([('calls', 0), ('forward_ms', 0.0), ('forward_cuda_ms', 0.0), ('backward_ms', 0.0), ('backward_cuda_ms', 0.0)])
+        info = stats[name]
+        info.update(extra)
+        if prefix is None:
+            info['calls'] += 1
+            info['wall_ms'] += wall
+            info['cuda_ms'] += cuda or 0.0
+        else:
+            info[prefix + '_ms'] += wall
+            info[prefix + '_cuda_ms'] += cuda or 0.0
+        args = {'step': self._step}
+        if cuda is not None:
+            args['cuda_ms'] = round(cuda, 4)
+        if prefix is not None and prefix == 'forward':
+            args.update({'memory': extra['memory'], 'flops': extra['flops']})
+        self.trace_events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': self._timestamp(start.wall),
+                                  'dur': max(wall * 1000, 0.0), 'pid': os.getpid(),
+                                  'tid': 'layers' if prefix is not None else 'phases', 'args': args})
+        return info
+
+    @contextlib.contextmanager
+    def phase(self, name, category='phase'):
+        """Time a phase of the step (ex. 'loss'), the nested layers are recorded as usual, no-op when inactive."""
+        if not self.is_active:
+            yield
+            return
+        start = _Event(self.use_cuda)
+        try:
+            yield
+        finally:
+            self._phases.append((name, category, start, _Event(self.use_cuda)))
+
+    def record(self, name, start_time, end_time, category='phase'):
+        """Record a phase measured outside of the profiler with time.perf_counter (ex. waiting for the data loader)."""
+        if not self.is_active:
+            return
+        start, end = _Event(False), _Event(False)
+        start.wall, end.wall = start_time, end_time
+        self._phases.append((name, category, start, end))
+
+    def summary(self, sort_by='forward_ms', top_k=None):
+        """The aggregated table of the recorded steps, the times are averaged per step."""
+        steps = max(self.num_steps, 1)
+        lines = ['Profiled steps: {0}'.format(self.num_steps), '',
+                 '{0:<28s}{1:>8s}{2:>12s}{3:>12s}'.format('Phase', 'calls', 'wall(ms)', 'cuda(ms)')]
+        for name, info in self.phase_stats.items():
+            lines.append('{0:<28s}{1:>8d}{2:>12.3f}{3:>12.3f}'.format(name[:27], info['calls'] // steps, info['wall_ms'] / steps, info['cuda_ms'] / steps))
+        if len(self.layer_stats) > 0:
+            lines.append('')
+            lines.append('{0:<36s}{1:<18s}{2:>12s}{3:>12s}{4:>12s}{5:>12s}{6:>14s}{7:>12s}'.format(
+                'Layer', 'type', 'fwd(ms)', 'fwd cuda', 'bwd(ms)', 'bwd cuda', 'memory(MB)', 'GFLOPs'))
+            layers = sorted(self.layer_stats.items(), key=lambda kv: kv[1].get(sort_by, 0), reverse=True)
+            for name, info in layers[:top_k]:
+                lines.append('{0:<36s}{1:<18s}{2:>12.3f}{3:>12.3f}{4:>12.3f}{5:>12.3f}{6:>14.3f}{7:>12.4f}'.format(
+                    name[-35:], info.get('layer', '')[:17], info['forward_ms'] / steps, info['forward_cuda_ms'] / steps,
+                    info['backward_ms'] / steps, info['backward_cuda_ms'] / steps, info.get('memory', 0) / 1024 ** 2, info.get('flops', 0) / 1e9))
+            total_forward = np.sum([info['forward_ms'] for info in self.layer_stats.values()]) / steps
+            total_backward = np.sum([info['backward_ms'] for info in self.layer_stats.values()]) / steps
+            lines.append('{0:<54s}{1:>12.3f}{2:>12s}{3:>12.3f}'.format('Total', total_forward, '', total_backward))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        """Write the recorded events as a Chrome trace (chrome://tracing or Perfetto)."""
+        folder = os.path.dirname(path)
+        if len(folder) > 0 and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+    def reset(self):
+        self.num_steps = 0
+        self.trace_events = []
+        self.phase_stats = OrderedDict()
+        self.layer_stats = OrderedDict()
 
     def __enter__(self):
-        self.start()
-
+        self.start_step(self.num_steps)
         return self
 
     def __exit__(self, *args):
-        self.stop()
+        self.end_step()
 
     def __str__(self):
-        ret = ""
-
-        iter = len(self.record['forward']) / self.layer_num
-
-        for i in xrange(iter):
-            ret += "\n================================= Iteration {} =================================\n".format(i + 1)
-
-            ret += "\nFORWARD TIME:\n\n"
-            for j in xrange(self.layer_num):
-                record_item = self.record['forward'][i * self.layer_num + j]
-                ret += "layer{:3d}:          {:.6f} ms          ({})\n".format(j + 1, record_item[2] - record_item[1],
-                                                                               record_item[0])
-
-            ret += "\nBACKWARD TIME:\n\n"
-            for j in (xrange(self.layer_num)):
-                record_item = self.record['backward'][i * self.layer_num + self.layer_num - j - 1]
-                try:
-                    ret += "layer{:3d}:          {:.6f} ms          ({})\n".format(j + 1,
-                                                                                   record_item[2] - record_item[1],
-                                                                                   record_item[0])
-                except:
-                    # Oops, this layer doesn't execute backward post-hooks
-                    pass
-
-        return ret
-
-    def start(self):
-        if self.hook_done is False:
-            self.hook_done = True
-            self.hook_modules(self.model)
-
-        self.profiling_on = True
-
-        return self
-
-    def stop(self):
-        self.profiling_on = False
-
-        return self
-
-    def hook_modules(self, module):
-
-        this_profiler = self
-
-        sub_modules = module.__dict__['_modules']
-
-        for name, sub_module in sub_modules.items():
-            # nn.Module is the only thing we care about.
-            if sub_module is None or isinstance(sub_module, torch.nn.Module) is False:
-                break
-
-            if isinstance(sub_module, torch.nn.Container) or isinstance(sub_module, torch.nn.Sequential):
-                #
-                # nn.Container or nn.Sequential who have sub nn.Module. Recursively visit and hook their decendants.
-                #
-                self.hook_modules(sub_module)
-            else:
-
-                self.layer_num += 1
-
-                #
-                # nn.Module who doesn't have sub nn.Module, hook it.
-                #
-
-                # Wrapper function to "__call__", with time counter in it.
-                def wrapper_call(self, *input, **kwargs):
-                    start_time = time.time()
-                    result = this_profiler.origin_call[self.__class__](self, *input, **kwargs)
-                    stop_time = time.time()
-
-                    that = self
-
-                    def backward_pre_hook(*args):
-                        if (this_profiler.profiling_on):
-                            this_profiler.record['backward'].append((that, time.time()))
-
-                    result.grad_fn.register_pre_hook(backward_pre_hook);
-
-                    if (this_profiler.profiling_on):
-                        global record
-                        this_profiler.record['forward'].append((self, start_time, stop_time))
-
-                    return result
-
-                # Replace "__call__" with "wrapper_call".
-                if sub_module.__class__ not in this_profiler.origin_call:
-                    this_profiler.origin_call.update({sub_module.__class__: sub_module.__class__.__call__})
-                    sub_module.__class__.__call__ = wrapper_call
+        return self.summary()
 
-                def backward_post_hook(*args):
-                    if (this_profiler.profiling_on):
-                        this_profiler.record['backward'][-1] = (
-                        this_profiler.record['backward'][-1][0], this_profiler.record['backward'][-1][1], time.time())
 
-                sub_module.register_backward_hook(backward_post_hook)
\ No newline at end of file
+# the former name of the profiler
+Profiling = Profiler
@@ -5,6 +5,7 @@ import numbers
 import copy
 import gc
 import inspect
+import itertools
 import os
 import random
 import shutil
@@ -21,6 +22,7 @@ import torch.nn as nn
 
 from trident.data.dataset import Iterator,NumpyDataset,LabelDataset
 from trident.optims.trainers import TrainingPlan
+from trident.optims.checkpoint import CheckpointWriter
 from trident.data.data_provider import DataProvider
 
 from trident import __version__
@@ -35,6 +37,8 @@ from trident.optims.pytorch_losses import get_loss,_ClassificationLoss
 from trident.optims.pytorch_metrics import get_metric
 from trident.optims.pytorch_optimizers import get_optimizer
 from trident.optims.pytorch_regularizers import get_reg
+from trident.optims.pytorch_inference import optimize_for_inference
+from trident.optims.pytorch_parameter_statistics import ParameterStatistics
 
 
 from trident.layers.pytorch_layers import *
@@ -88,6 +92,18 @@ def make_deterministic(seed: int = 19260817, cudnn_deterministic: bool = False):
 class Model(ModelBase):
     def __init__(self, inputs=None,  input_shape=None,output=None):
         super(Model, self).__init__(inputs, input_shape,output)
+        self._staging_stream = None
+        self._prefetched = []
+        self.checkpoint_writer = None
+        self.save_optimizer_state = False
+        self.optimize_inference = True
+        self._inference_model = None
+        self._inference_key = None
+        self._module_template = None
+        self._module_template_keys = None
+        # per-layer statistics computed on device, the last 256 collected steps
+        self.weights_history = ParameterStatistics()
+        self.gradients_history = ParameterStatistics()
 
 
     def _initial_graph(self, inputs=None, input_shape=None,output=None,initializer=None):
@@ -171,16 +187,23 @@ class Model(ModelBase):
                         out =output(inputs)
 
                 else:
-
-                    output.input_shape =to_tensor( input_shape)
-                    dummay_input = to_tensor(np.random.standard_normal((1,)+tuple(input_shape)).astype(np.float32)).to(get_device())
                     # prevent pytorch 'ValueError: Expected more than 1 value per channel when training, got input size ....
                     output.to(get_device())
                     output.eval()
-                    out =output(dummay_input)
+                    if isinstance(output, Layer):
+                        # the shapes flow through the shape rules of the layers, no forward pass of the whole model
+                        out = symbolic_build(output, input_shape)
+                    if not isinstance(out, tuple) or not all([isinstance(d, numbers.Integral) for d in out]):
+                        # multiple (or named) outputs, their specs come from a forward pass
+                        output.input_shape = to_tensor(input_shape)
+                        dummay_input = to_tensor(np.random.standard_normal((1,) + tuple(input_shape)).astype(np.float32)).to(get_device())
+                        out = output(dummay_input)
 
                 self._model = output
-                if isinstance(out, torch.Tensor):
+                if isinstance(out, tuple) and all([isinstance(d, numbers.Integral) for d in out]):
+                    self._outputs['output'] = TensorSpec(shape=to_tensor(list(out)).int(), name='output')
+                    self._targets['target'] = TensorSpec(shape=to_tensor(list(out)).int(), name='target')
+                elif isinstance(out, torch.Tensor):
                     self._outputs['output'] = TensorSpec(shape=to_tensor(int_shape(out)[self.batch_index+1:]),name='output')
                     self._targets['target'] = TensorSpec(shape=to_tensor(int_shape(out)[self.batch_index+1:]),name='target')
                 elif isinstance(out, OrderedDict):
@@ -344,11 +367,11 @@ class Model(ModelBase):
 
         data_ds=NumpyDataset(data=train_x,symbol="input")
         label_ds = LabelDataset(labels=train_y, symbol="target")
-        dataprovider=DataProvider(traindata=Iterator(data=data_ds,label=label_ds,minibatch_size=batch_size,is_shuffe=shuffle,buffer_size=max_queue_size,workers=workers))
+        dataprovider=DataProvider(traindata=Iterator(data=data_ds,label=label_ds,minibatch_size=batch_size,is_shuffe=shuffle,buffer_size=max_queue_size,workers=workers,use_multiprocessing=use_multiprocessing))
         if validation_split>0:
             data_test_ds = NumpyDataset(data=train_x, symbol="input")
             label_test_ds = LabelDataset(labels=train_y, symbol="target")
-            dataprovider.testdata=Iterator(data=data_test_ds, label=label_test_ds, minibatch_size=validation_batch_size, is_shuffe=shuffle, buffer_size=max_queue_size, workers=workers)
+            dataprovider.testdata=Iterator(data=data_test_ds, label=label_test_ds, minibatch_size=validation_batch_size, is_shuffe=shuffle, buffer_size=max_queue_size, workers=workers, use_multiprocessing=use_multiprocessing)
 
 
         plan = TrainingPlan() \
@@ -677,6 +700,65 @@ class Model(ModelBase):
             #elif isinstance(self._model, nn.Module):
             #     self._model.zero_grad()
 
+    def stage_data(self, data):
+        """Copy a host minibatch to the device.
+
+        On cuda every numeric array is pinned and copied with ``non_blocking=True`` on a side staging stream,
+        the dtype conversion (int to int64, others to float32, same as `to_tensor`) happens on the device,
+        so the copy can overlap with the kernels of the current step. Call `wait_staged` before using the
+        returned tensors.
+
+        Args:
+            data (OrderedDict): name and array (or tensor) pairs.
+
+        Returns:
+            OrderedDict of device tensors.
+
+        """
+        if data is None:
+            return None
+        staged = OrderedDict()
+        use_stream = get_device() == 'cuda' and torch.cuda.is_available()
+        if use_stream and self._staging_stream is None:
+            self._staging_stream = torch.cuda.Stream()
+        for k, v in data.item_list:
+            if use_stream and isinstance(v, np.ndarray) and v.dtype.kind in 'biuf':
+                host = torch.from_numpy(np.ascontiguousarray(v)).pin_memory()
+                with torch.cuda.stream(self._staging_stream):
+                    t = host.to(get_device(), non_blocking=True)
+                    staged[k] = t.long() if 'int' in str(v.dtype) else t.float()
+            else:
+                staged[k] = to_tensor(v)
+        return staged
+
+    def wait_staged(self, staged):
+        """Make the current stream wait for the staging copies of these tensors."""
+        if staged is None or self._staging_stream is None:
+            return
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self._staging_stream)
+        for t in staged.value_list:
+            if is_tensor(t) and t.is_cuda:
+                # allocated on the staging stream, used on the current stream
+                t.record_stream(current_stream)
+
+    def prefetch_data(self, train_data):
+        """Stage the next minibatch one step ahead, its host to device copy overlaps with the current step."""
+        if train_data is None or get_device() != 'cuda':
+            return
+        self._prefetched.append((train_data.value_list, self.stage_data(train_data)))
+        # keep only the lookahead window
+        self._prefetched = self._prefetched[-2:]
+
+    def _pop_prefetched(self, train_data):
+        values = train_data.value_list
+        for i in range(len(self._prefetched)):
+            src, staged = self._prefetched[i]
+            if len(src) == len(values) and all([a is b for a, b in zip(src, values)]):
+                self._prefetched = self._prefetched[i + 1:]
+                return staged
+        return None
+
     def do_on_data_received(self, train_data, test_data):
 
         # fields=train_data._fields
@@ -774,24 +856,16 @@ class Model(ModelBase):
 
         # convert to tensor
         try:
-            data_feed = self.training_context['data_feed']
-            input_list = [data_feed[arg] for arg in self._model.signature.inputs.key_list]
+            staged_train = self._pop_prefetched(train_data)
+            if staged_train is None:
+                staged_train = self.stage_data(train_data)
+            staged_test = self.stage_data(OrderedDict([(k, v) for k, v in test_data.item_list if k in train_data])) if test_data is not None else None
+            self.wait_staged(staged_train)
+            self.wait_staged(staged_test)
             for item in train_data.key_list:
-
-                if item in input_list:
-                    # only model 's input argments
-                    train_data[item] = to_tensor(train_data[item].copy()) #.cpu()
-                    if 'float' in str(train_data[item].dtype):
-                        train_data[item].require_grads=True
-                elif item in self.targets.key_list or data_feed:
-                    train_data[item] = to_tensor(train_data[item].copy())#.cpu()
-                else:
-                    train_data[item] = to_tensor(train_data[item].copy())#.cpu()
-
-                if test_data is not None and  item in test_data:
-                    test_data[item] = to_tensor(test_data[item].copy())#.cpu()
-
-                    # check target
+                train_data[item] = staged_train[item]
+                if staged_test is not None and item in staged_test:
+                    test_data[item] = staged_test[item]
 
             self.training_context['train_data'] = train_data
             self.training_context['test_data'] = test_data
@@ -813,17 +887,26 @@ class Model(ModelBase):
                 #double check!!!
                 self._model.train()
 
+            # fused device flag of mask_abnormal_number: false when a loss of the step has nan/inf
+            step_is_finite = self.training_context.get('step_is_finite', None)
+            self.training_context['step_is_finite'] = None
             if self.training_context['stop_update'] <1:
-                if get_session_value('amp_available') == True and get_session_value('is_amp_enable') == True and get_device()=='cuda' :
-                    if self.gradscaler is None:
-                        self.gradscaler=torch.cuda.amp.GradScaler()
-                    self.gradscaler.scale(self.training_context['current_loss']).backward(retain_graph=self.training_context['retain_graph'])
-                else:
-                    self.training_context['current_loss'].backward(retain_graph=self.training_context['retain_graph'])
+                with self.profile_phase('backward'):
+                    if get_session_value('amp_available') == True and get_session_value('is_amp_enable') == True and get_device()=='cuda' :
+                        if self.gradscaler is None:
+                            self.gradscaler=torch.cuda.amp.GradScaler()
+                        self.gradscaler.scale(self.training_context['current_loss']).backward(retain_graph=self.training_context['retain_graph'])
+                    else:
+                        self.training_context['current_loss'].backward(retain_graph=self.training_context['retain_graph'])
+                    if step_is_finite is not None and isinstance(self._model, nn.Module):
+                        # the masked loss still has its nan/inf branch in the graph, zero the non finite gradients
+                        # on device (no host sync), the gradients of the finite losses are kept
+                        for para in self._model.parameters():
+                            if para.grad is not None:
+                                para.grad.copy_(torch.where(step_is_finite | torch.isfinite(para.grad), para.grad, torch.zeros_like(para.grad)))
 
                 #only check once every epoch start.
-                for callback in self.training_context['callbacks']:
-                    callback.on_optimization_step_start(self.training_context)
+                self.dispatch_callbacks('on_optimization_step_start')
 
                 if isinstance(self._model,nn.Module) and self.grad_clipping_by_norm:
 
@@ -857,26 +940,26 @@ class Model(ModelBase):
                 if log_gradients:
                     self.log_gradient()
 
-            if self.training_context['stop_update'] == 0:
-                #amp support
-                if get_session_value('amp_available') == True and get_session_value('is_amp_enable') == True and get_device()=='cuda':
-                    self.gradscaler.step(self.optimizer)
-                    self.gradscaler.update()
-                else:
-                    self.optimizer.step(self.get_current_loss, )
-            elif 0 < self.training_context['stop_update'] < 1:
-                if random.random() <= self.training_context['stop_update']:
-                    # amp support
+            with self.profile_phase('optimizer_step'):
+                if self.training_context['stop_update'] == 0:
+                    #amp support
                     if get_session_value('amp_available') == True and get_session_value('is_amp_enable') == True and get_device()=='cuda':
                         self.gradscaler.step(self.optimizer)
                         self.gradscaler.update()
                     else:
                         self.optimizer.step(self.get_current_loss, )
-            else:
-                self.training_context['stop_update'] = self.training_context['stop_update'] - 1
+                elif 0 < self.training_context['stop_update'] < 1:
+                    if random.random() <= self.training_context['stop_update']:
+                        # amp support
+                        if get_session_value('amp_available') == True and get_session_value('is_amp_enable') == True and get_device()=='cuda':
+                            self.gradscaler.step(self.optimizer)
+                            self.gradscaler.update()
+                        else:
+                            self.optimizer.step(self.get_current_loss, )
+                else:
+                    self.training_context['stop_update'] = self.training_context['stop_update'] - 1
 
-            for callback in self.training_context['callbacks']:
-                callback.on_optimization_step_end(self.training_context)
+            self.dispatch_callbacks('on_optimization_step_end')
         except Exception as e:
             print(e)
             PrintException()
@@ -892,85 +975,215 @@ class Model(ModelBase):
         pass
 
     def log_gradient(self, grads=None):
-        grad_dict =OrderedDict()
         if isinstance(self._model, nn.Module):
-            for i, (k, v) in enumerate(self._model.named_parameters()):
-                grad_dict[k] = to_numpy(v.grad)
-            self.gradients_history.append(grad_dict)
+            self.gradients_history.collect(self.training_context['steps'], [(k, v.grad) for k, v in self._model.named_parameters() if v.requires_grad])
 
     def log_weight(self, weghts=None):
-        weight_dict =OrderedDict()
         if isinstance(self._model, nn.Module):
-            for k, v in self._model.named_parameters():
-                weight_dict[k] = to_numpy(v.data)
+            self.weights_history.collect(self.training_context['steps'], self._model.named_parameters())
+
+    def with_checkpoint(self, max_to_keep=None, save_optimizer=True, asynchronous=True):
+        """Configure how save_model writes checkpoints.
+
+        Args:
+            max_to_keep (int): keep the last N versioned checkpoints (``<name>-<step>.pth.tar``), None to only keep the latest one.
+            save_optimizer (bool): also save the optimizer state, the lr scheduler state and the training progress,
+                so `load_model` and `TrainingPlan.resume` can continue the training.
+            asynchronous (bool): write the checkpoints in a background thread.
+
+        Returns:
+            the model self
+
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        self.checkpoint_writer = CheckpointWriter(max_to_keep=max_to_keep, asynchronous=asynchronous)
+        self.save_optimizer_state = save_optimizer
+        return self
+
+    def _host_copy(self, value):
+        """A host copy of a tensor, the device tensors are copied into pinned memory without blocking."""
+        value = value.detach()
+        if value.is_cuda:
+            host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            return host.copy_(value, non_blocking=True)
+        return value.clone()
+
+    def snapshot_state(self, ready=None):
+        """Copy the checkpoint content (the tensors of the state dicts) to host memory, it is all save_model does on
+        the training thread.
+
+        Args:
+            ready (torch.cuda.Event): recorded after the device to host copies, which are then left running, the
+                caller waits for it before reading the snapshot. If None the copies are finished on return.
 
-            self.weights_history.append(weight_dict)
+        Returns:
+            the checkpoint dict.
+
+        """
+        state_dict = OrderedDict([(k, self._host_copy(v) if is_tensor(v) else copy.deepcopy(v)) for k, v in self._model.state_dict().items()])
+        state = {
+            'state_dict': state_dict,
+            'backend': 'pytorch',
+            'trident_version': __version__,
+            'pytorch_version': torch.__version__,
+            'signature': self._model.signature
+        }
+        if self.save_optimizer_state and self.optimizer is not None:
+            optimizer_state = self.optimizer.state_dict()
+            # the per parameter states are the live ones of the optimizer, they are copied and never modified
+            state['optimizer_state_dict'] = {
+                'state': {pid: {k: self._host_copy(v) if is_tensor(v) else copy.deepcopy(v) for k, v in param_state.items()}
+                          for pid, param_state in optimizer_state['state'].items()},
+                'param_groups': copy.deepcopy(optimizer_state['param_groups'])}
+            state['lr_scheduler_state'] = [OrderedDict([(k, v) for k, v in callback.__dict__.items() if isinstance(v, (numbers.Number, str, bool, type(None)))])
+                                           for callback in self.training_context['callbacks'] if isinstance(callback, AdjustLRCallbackBase)]
+            state['training_progress'] = OrderedDict([(k, self.training_context[k]) for k in ['current_epoch', 'current_batch', 'total_epoch', 'total_batch', 'steps']
+                                                      if k in self.training_context])
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            if ready is not None:
+                ready.record()
+            else:
+                torch.cuda.current_stream().synchronize()
+        return state
+
+    def _get_module_template(self, state_dict):
+        # a host clone of the module structure, only built again when the structure changes, every save swaps the
+        # snapshot tensors in it on the writer thread
+        keys = tuple(state_dict.keys())
+        if self._module_template is None or self._module_template_keys != keys:
+            memo = {}
+            for name, para in self._model.named_parameters():
+                if name in state_dict:
+                    memo[id(para)] = nn.Parameter(state_dict[name], requires_grad=para.requires_grad)
+            for name, buffer in self._model.named_buffers():
+                if buffer is not None and name in state_dict:
+                    memo[id(buffer)] = state_dict[name]
+            for module in self._model.modules():
+                # the other tensors (caches) are copied to host, never on the device
+                for value in module.__dict__.values():
+                    if is_tensor(value) and id(value) not in memo:
+                        memo[id(value)] = value.detach().cpu()
+            self._module_template = copy.deepcopy(self._model, memo)
+            self._module_template_keys = keys
+        return self._module_template
+
+    @staticmethod
+    def _write_module(template, state_dict, requires_grad, ready, path):
+        if ready is not None:
+            ready.synchronize()
+        for name, para in template.named_parameters():
+            if name in state_dict:
+                para.data = state_dict[name]
+                para.requires_grad_(requires_grad.get(name, para.requires_grad))
+        for name, buffer in template.named_buffers():
+            if buffer is not None and name in state_dict:
+                buffer.data = state_dict[name]
+        save(template, path)
+
+    @staticmethod
+    def _write_state(state, ready, path):
+        if ready is not None:
+            ready.synchronize()
+        torch.save(state, path)
 
     def save_model(self, save_path=None):
-        for callback in self.training_context['callbacks']:
-            callback.on_model_saving_start(self.training_context)
+        self.dispatch_callbacks('on_model_saving_start')
 
-        if isinstance(self._model, Layer) and any_abnormal_number(self._model):
-            for para in self._model.parameters():
-                if any_abnormal_number(para):
-                    para.data.copy_(where(is_nan(para), random_normal_like(para, mean=0, std=0.02).to(get_device()), para))
+        if isinstance(self._model, Layer):
+            paras = [para for para in self._model.parameters()]
+            # a single device sync for all parameters
+            if len(paras) > 0 and not bool(torch.stack([torch.isfinite(para).all() for para in paras]).all()):
+                for para in paras:
+                    if any_abnormal_number(para):
+                        para.data.copy_(where(is_nan(para), random_normal_like(para, mean=0, std=0.02).to(get_device()), para))
 
-            sys.stderr.write(self._get_name() + '  nan detected!!\n')
+                sys.stderr.write(self._get_name() + '  nan detected!!\n')
 
         if save_path is None or save_path=='':
             save_path=self.training_context['save_path']
 
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter()
+        version = self.training_context['steps'] if 'steps' in self.training_context else None
+
         if isinstance(self._model,nn.Module):
             folder,filename,ext=split_path(save_path)
             if filename=='':
                 filename=self.name
 
-            ext='.pth.tar_'
+            ext='.pth.tar'
             save_path = os.path.join(folder, filename + ext)
             make_dir_if_need(sanitize_path(save_path))
             save_path = sanitize_path(save_path)
-            device=get_device()
-            self._model.eval()
-
-            torch.save({
-                'state_dict': self._model.state_dict(),
-                'backend':'pytorch',
-                'trident_version':__version__,
-                'pytorch_version':torch.__version__,
-                'signature':self._model.signature
-            }, save_path)
-
-
-            self._model.train()
-            shutil.copy(save_path, save_path.replace('.pth.tar_','.pth.tar'))
-            os.remove(save_path)
-            save_path=save_path.replace('pth.tar','pth')
-            save(self._model,save_path)
-            shutil.copy(save_path, save_path.replace('.pth_', '.pth'))
-            os.remove(save_path)
 
+            # the device to host copies run while the training goes on, the writer waits for them
+            ready = torch.cuda.Event() if torch.cuda.is_available() and torch.cuda.is_initialized() else None
+            state = self.snapshot_state(ready=ready)
+            self.checkpoint_writer.submit(save_path, partial(self._write_state, state, ready), version)
+            module_path = save_path.replace('.pth.tar', '.pth')
+            try:
+                template = self._get_module_template(state['state_dict'])
+                requires_grad = OrderedDict([(name, para.requires_grad) for name, para in self._model.named_parameters()])
+                self.checkpoint_writer.submit(module_path, partial(self._write_module, template, state['state_dict'], requires_grad, ready), version)
+            except Exception:
+                # the module cannot be cloned, pickle it on the training thread
+                self.checkpoint_writer.wait()
+                CheckpointWriter(max_to_keep=self.checkpoint_writer.max_to_keep, asynchronous=False).submit(module_path, partial(save, self._model), version)
 
         elif isinstance(self._model,torch.Tensor):
-
-
             folder, filename, ext = split_path(save_path)
             if filename == '':
-                filenam = self.name
+                filename = self.name
 
-            ext = '.npy_'
+            ext = '.npy'
             save_path = os.path.join(folder, filename + ext)
             make_dir_if_need(sanitize_path(save_path))
             save_path = sanitize_path(save_path)
-            numpy_model=to_numpy(self._model)
-            np.save(save_path,numpy_model)
-            shutil.copy(save_path, save_path.replace('.npy_', '.npy'))
-            os.remove(save_path)
+            numpy_model=to_numpy(self._model).copy()
+
+            def write_numpy(path):
+                with open(path, 'wb') as f:
+                    np.save(f, numpy_model)
+
+            self.checkpoint_writer.submit(save_path, write_numpy, version)
             sys.stdout.write('Yor model is a Tensor not a nn.Module, it has saved as numpy array(*.npy) successfully. ')
         else:
             raise ValueError('only Layer or nn.Module as model can export to onnx, yours model is {0}'.format(type(self._model)))
 
-        for callback in self.training_context['callbacks']:
-            callback.on_model_saving_end(self.training_context)
+        self.dispatch_callbacks('on_model_saving_end')
+
+    def build_inference_model(self):
+        """Build the frozen copy of the model optimized by `optimize_for_inference` (batchnorm folded, identity and
+        dropout removed), the infer methods use it until the weights or the running statistics change.
+
+        The copy doubles the weight memory, so it is only built on demand, for serving after the training.
+
+        Returns:
+            the optimized copy, or the model itself with self.optimize_inference False.
+
+        """
+        if not isinstance(self._model, nn.Module) or not self.optimize_inference:
+            return self._model
+        self._inference_model = optimize_for_inference(self._model)
+        self._inference_key = self._weights_key()
+        return self._inference_model
+
+    def _weights_key(self):
+        # the optimizer steps and the batchnorm updates are in-place, they bump the version counter of the tensors
+        return tuple([(id(t), t._version) for t in itertools.chain(self._model.parameters(), self._model.buffers())])
+
+    @property
+    def inference_model(self):
+        """The copy built by `build_inference_model` while it is up to date, the model itself otherwise. A copy
+        outdated by a training step is released, it is never rebuilt implicitly."""
+        if self._inference_model is None or not isinstance(self._model, nn.Module) or not self.optimize_inference:
+            return self._model
+        if self._inference_key != self._weights_key():
+            self._inference_model = None
+            self._inference_key = None
+            return self._model
+        return self._inference_model
 
     def save_onnx(self, save_path, dynamic_axes=None):
         if isinstance(self._model,nn.Module):
@@ -991,7 +1204,9 @@ class Model(ModelBase):
 
 
             self._model.to(get_device())
-            outputs = self._model(dummy_input)
+            # a temporary optimized copy, released after the export
+            inference_model = optimize_for_inference(self._model) if self.optimize_inference else self._model
+            outputs = inference_model(dummy_input)
             if dynamic_axes is None:
                 dynamic_axes = {self.inputs.key_list[0]: {0: 'batch_size'},  # variable lenght axes
                                 self.outputs.key_list[0]: {0: 'batch_size'}}
@@ -1002,7 +1217,7 @@ class Model(ModelBase):
             #         dynamic_axes[inp] = {0: 'batch_size'}
             #     for out in output_names:
             #         dynamic_axes[out] = {0: 'batch_size'}
-            torch.onnx.export(self._model,  # model being run
+            torch.onnx.export(inference_model,  # model being run
                               dummy_input,  # model input (or a tuple for multiple inputs)
                               save_path,  # where to save the model (can be a file or file-like object)
                               export_params=True,  # store the trained parameter weights inside the model file
@@ -1014,8 +1229,7 @@ class Model(ModelBase):
             self._model.train()
             shutil.copy(save_path, save_path.replace('.onnx_', '.onnx'))
             os.remove(save_path)
-            for callback in self.training_context['callbacks']:
-                callback.on_model_saving_end(self.training_context)
+            self.dispatch_callbacks('on_model_saving_end')
         else:
             raise ValueError('only Layer or nn.Module as model can export to onnx, yours model is {0}'.format(type(self._model)))
 
@@ -1027,11 +1241,23 @@ class Model(ModelBase):
         optimizer_dict=None
         if "state_dict" in state_dict.keys():
             pretrained_dict = state_dict['state_dict']
-        # if "optimizer_state_dict" in state_dict.keys():
-        #     optimizer_dict = state_dict['state_dict']
-        #
-        # if check_keys(self.optimizer, optimizer_dict):
-        #     self.optimizer.load_state_dict(optimizer_dict, strict=False)
+        if "optimizer_state_dict" in state_dict.keys() and self.optimizer is not None:
+            try:
+                self.optimizer.load_state_dict(state_dict['optimizer_state_dict'])
+            except Exception as e:
+                print('Optimizer state cannot be restored: {0}'.format(e))
+        if "lr_scheduler_state" in state_dict.keys():
+            lr_schedulers = [callback for callback in self.training_context['callbacks'] if isinstance(callback, AdjustLRCallbackBase)]
+            for callback, callback_state in zip(lr_schedulers, state_dict['lr_scheduler_state']):
+                callback.__dict__.update(callback_state)
+        if "training_progress" in state_dict.keys():
+            progress = state_dict['training_progress']
+            self.training_context.update(progress)
+            # continue from the next epoch if the checkpoint was saved at the end of an epoch
+            if progress.get('current_batch', 0) >= progress.get('total_batch', 1) - 1:
+                self.training_context['resume_epoch'] = progress.get('current_epoch', -1) + 1
+            else:
+                self.training_context['resume_epoch'] = progress.get('current_epoch', 0)
 
         if check_keys(self._model, pretrained_dict):
             has_abnormal=False
@@ -1191,7 +1417,7 @@ class ImageClassificationModel(Model):
             inp = to_tensor(np.expand_dims(img, 0)).to(
                 torch.device("cuda" if self._model.weights[0].data.is_cuda else "cpu")).to(
                 self._model.weights[0].data.dtype)
-            result = self._model(inp)
+            result = self.inference_model(inp)
             result = to_numpy(result)[0]
             if self.class_names is None or len(self.class_names)==0:
                 return result
@@ -1240,7 +1466,7 @@ class ImageDetectionModel(Model):
             inp = to_tensor(np.expand_dims(img, 0)).to(
                 torch.device("cuda" if self._model.weights[0].data.is_cuda else "cpu")).to(
                 self._model.weights[0].data.dtype)
-            result = self._model(inp)
+            result = self.inference_model(inp)
 
             bboxes = self.generate_bboxes(*result, threshould=self.detection_threshould, scale=scale)
             bboxes = self.nms(bboxes)
@@ -1249,6 +1475,48 @@ class ImageDetectionModel(Model):
         else:
             raise ValueError('the model is not built yet.')
 
+    def infer_batch(self, images, scale=1):
+        """Detect the objects of many images, the images sharing the same shape after preprocessing go through the model in a single forward pass.
+
+        Args:
+            images (list): the images (path, PIL image or ndarray).
+            scale (float): the scale passed to generate_bboxes.
+
+        Returns:
+            the list of detected bboxes, one item per image.
+
+        """
+        if self._model.built:
+            self._model.to(self.device)
+            self._model.eval()
+            arrays = []
+            for img in images:
+                img = image2array(img)
+                if img.shape[-1] == 4:
+                    img = img[:, :, :3]
+                for func in self.preprocess_flow:
+                    if inspect.isfunction(func):
+                        img = func(img)
+                arrays.append(image_backend_adaption(img))
+
+            groups = {}
+            for i in range(len(arrays)):
+                groups.setdefault(arrays[i].shape, []).append(i)
+            results = [None] * len(arrays)
+            with torch.no_grad():
+                for shape, indexes in groups.items():
+                    inp = to_tensor(np.stack([arrays[i] for i in indexes], 0)).to(
+                        torch.device("cuda" if self._model.weights[0].data.is_cuda else "cpu")).to(
+                        self._model.weights[0].data.dtype)
+                    result = self.inference_model(inp)
+                    result = result if isinstance(result, (list, tuple)) else (result,)
+                    for k in range(len(indexes)):
+                        bboxes = self.generate_bboxes(*[r[k:k + 1] for r in result], threshould=self.detection_threshould, scale=scale)
+                        results[indexes[k]] = self.nms(bboxes)
+            return results
+        else:
+            raise ValueError('the model is not built yet.')
+
     def generate_bboxes(self, *outputs, threshould=0.5, scale=1):
         raise NotImplementedError
 
@@ -1288,7 +1556,7 @@ class ImageGenerationModel(Model):
                     img = func(img)
             img = image_backend_adaption(img)
             inp = to_tensor(np.expand_dims(img, 0)).to(torch.device("cuda" if self._model.weights[0].data.is_cuda else "cpu")).to(self._model.weights[0].data.dtype)
-            result = self._model(inp)
+            result = self.inference_model(inp)
             result = to_numpy(result)[0]
 
             for func in self.reverse_preprocess_flow:
@@ -1348,7 +1616,7 @@ class FaceRecognitionModel(Model):
                     img = func(img)
             img = image_backend_adaption(img)
             inp = to_tensor(np.expand_dims(img, 0)).to(torch.device("cuda" if self._model.weights[0].data.is_cuda else "cpu")).to(self._model.weights[0].data.dtype)
-            result = self._model(inp)[0]
+            result = self.inference_model(inp)[0]
             embedding = to_numpy(result)
             return norm(embedding)
 
@@ -757,14 +757,14 @@ class Model(ModelBase):
             for item in train_data.key_list:
                 if item in input_list:
                     # only model 's input argments
-                    train_data[item] = to_tensor(train_data[item].copy(), requires_grad=True)
+                    train_data[item] = to_tensor(train_data[item], requires_grad=True)
                 elif item in self.targets.key_list or data_feed:
-                    train_data[item] = to_tensor(train_data[item].copy(), requires_grad=False)
+                    train_data[item] = to_tensor(train_data[item], requires_grad=False)
                 else:
-                    train_data[item] = to_tensor(train_data[item].copy())
+                    train_data[item] = to_tensor(train_data[item])
 
                 if test_data is not None and item in test_data:
-                    test_data[item] = to_tensor(test_data[item].copy())
+                    test_data[item] = to_tensor(test_data[item])
 
                     # check target
 
@@ -796,8 +796,7 @@ class Model(ModelBase):
         #
 
         if self.training_context['stop_update'] < 1:
-            for callback in self.training_context['callbacks']:
-                callback.on_optimization_step_start(self.training_context)
+            self.dispatch_callbacks('on_optimization_step_start')
 
             if self.training_context['stop_update'] == 0:
                 self.optimizer.step(self.optimizer.grads_and_vars)
@@ -808,8 +807,7 @@ class Model(ModelBase):
             else:
                 self.training_context['stop_update'] = self.training_context['stop_update'] - 1
 
-            for callback in self.training_context['callbacks']:
-                callback.on_optimization_step_end(self.training_context)
+            self.dispatch_callbacks('on_optimization_step_end')
 
     def do_post_gradient_update(self):
 
@@ -845,8 +843,7 @@ class Model(ModelBase):
             self.weights_history.append(weight_dict)
 
     def save_model(self, save_path=None):
-        for callback in self.training_context['callbacks']:
-            callback.on_model_saving_start(self.training_context)
+        self.dispatch_callbacks('on_model_saving_start')
 
         if any_abnormal_number(self._model):
             raise ValueError(self._get_name() + '  nan detected!!')
@@ -897,15 +894,13 @@ class Model(ModelBase):
         else:
             raise ValueError(
                 'only Layer or nn.Module as model can export to onnx, yours model is {0}'.format(type(self._model)))
-        for callback in self.training_context['callbacks']:
-            callback.on_model_saving_end(self.training_context)
+        self.dispatch_callbacks('on_model_saving_end')
 
     def save_onnx(self, file_path):
         pass
 
     def save_weights(self, file_path):
-        for callback in self.training_context['callbacks']:
-            callback.on_model_saving_start(self.training_context)
+        self.dispatch_callbacks('on_model_saving_start')
 
         if file_path is not None:
             self._model.save_weights(file_path)
@@ -991,17 +986,14 @@ class Model(ModelBase):
                 self.training_context['print_epoch_progress_frequency'] = 1
 
                 self.do_on_epoch_start()
-                for callback in self.callbacks:
-                    callback.on_epoch_start(self.training_context)
+                self.dispatch_callbacks('on_epoch_start')
 
             self.do_on_batch_start()
-            for callback in self.callbacks:
-                callback.on_batch_start(self.training_context)
+            self.dispatch_callbacks('on_batch_start')
 
             train_data, test_data = self.do_on_data_received(train_data, test_data)
 
-            for callback in self.callbacks:
-                callback.on_data_received(self.training_context)
+            self.dispatch_callbacks('on_data_received')
 
             if accumulate_grads == False:
                 self.training_context['current_loss'] = to_tensor(0.0, requires_grad=True)
@@ -1085,8 +1077,7 @@ class Model(ModelBase):
                             PrintException()
 
                 self.do_post_loss_calculation()
-                for callback in self.callbacks:
-                    callback.on_loss_calculation_end(self.training_context)
+                self.dispatch_callbacks('on_loss_calculation_end')
 
                 if accumulate_grads == False:
                     # regularizer
@@ -1148,8 +1139,7 @@ class Model(ModelBase):
 
             # ON_EVALUATION_START
             self.do_on_metrics_evaluation_start()
-            for callback in self.training_context['callbacks']:
-                callback.on_metrics_evaluation_start(self.training_context)
+            self.dispatch_callbacks('on_metrics_evaluation_start')
 
             for k, v in self._metrics.items():
                 collect_history = getattr(v, 'collect_history') if hasattr(v, 'collect_history') else True
@@ -1166,8 +1156,7 @@ class Model(ModelBase):
 
             # ON_EVALUATION_END
             self.do_on_metrics_evaluation_end()
-            for callback in self.training_context['callbacks']:
-                callback.on_metrics_evaluation_end(self.training_context)
+            self.dispatch_callbacks('on_metrics_evaluation_end')
 
             # callback's metric can keep in epoch_metric_history
 
@@ -1180,21 +1169,18 @@ class Model(ModelBase):
 
             # ON_BATCH_END
             self.do_on_batch_end()
-            for callback in self.training_context['callbacks']:
-                callback.on_batch_end(self.training_context)
+            self.dispatch_callbacks('on_batch_end')
 
             # print batch progresss
             if is_print_batch_progress:
                 self.do_on_progress_start()
-                for callback in self.training_context['callbacks']:
-                    callback.on_progress_start(self.training_context)
+                self.dispatch_callbacks('on_progress_start')
 
                 self.print_batch_progress(self.training_context['print_batch_progress_frequency'])
 
                 self.training_context['print_batch_progress_frequency'] = 1
                 self.do_on_progress_end()
-                for callback in self.training_context['callbacks']:
-                    callback.on_progress_end(self.training_context)
+                self.dispatch_callbacks('on_progress_end')
             else:
                 self.training_context['print_batch_progress_frequency'] += 1
 
@@ -1237,23 +1223,19 @@ class Model(ModelBase):
 
                 if is_print_epoch_progress:
                     self.do_on_progress_start()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_progress_start(self.training_context)
+                    self.dispatch_callbacks('on_progress_start')
                     self.print_epoch_progress(self.training_context['print_epoch_progress_frequency'])
                     self.training_context['print_epoch_progress_frequency'] = 1
                     self.do_on_progress_end()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_progress_end(self.training_context)
+                    self.dispatch_callbacks('on_progress_end')
                 else:
                     self.training_context['print_epoch_progress_frequency'] += 1
 
-                for callback in self.training_context['callbacks']:
-                    callback.on_epoch_end(self.training_context)
+                self.dispatch_callbacks('on_epoch_end')
 
                 if self.training_context['current_epoch'] == self.training_context['total_epoch'] - 1:
                     self.do_on_training_end()
-                    for callback in self.training_context['callbacks']:
-                        callback.on_training_end(self.training_context)
+                    self.dispatch_callbacks('on_training_end')
         except Exception:
             self.do_on_excution_exception()
             PrintException()
@@ -19,6 +19,7 @@ from trident.data.dataset import ZipDataset
 from trident.backend.common import to_list, addindent, get_time_suffix, format_time, get_terminal_size, get_session, \
     snake2camel, PrintException, unpack_singleton, enforce_singleton, OrderedDict, split_path, sanitize_path
 from trident.backend.model import ModelBase, progress_bar
+from trident.callbacks.callback_base import CallbackDispatcher
 from trident.callbacks.visualization_callbacks import *
 from trident.data.data_provider import *
 from trident.misc.ipython_utils import *
@@ -27,6 +28,19 @@ from trident.backend.tensorspec import TensorSpec, assert_spec_compatibility
 
 __all__ = ['TrainingPlan']
 
+
+def _lookahead(iterable):
+    """Yield (current, next) pairs, next is None for the last item."""
+    it = iter(iterable)
+    try:
+        current = next(it)
+    except StopIteration:
+        return
+    for item in it:
+        yield current, item
+        current = item
+    yield current, None
+
 _session = get_session()
 _backend = _session.backend
 if _backend == 'pytorch':
@@ -35,6 +49,7 @@ if _backend == 'pytorch':
     from trident.backend.pytorch_backend import *
     from trident.backend.pytorch_ops import *
     from trident.optims.pytorch_optimizers import *
+    from trident.optims.pytorch_profiling import Profiler
 elif _backend == 'tensorflow':
     import tensorflow as tf
     from trident.backend.tensorflow_backend import *
@@ -59,6 +74,10 @@ class TrainingPlan(object):
         self.out_sample_evaluation_on_epoch_end = True
         self.save_model_frequency = -1
         self.save_model_unit = 'batch'
+        self.profile_frequency = -1
+        self.profile_unit = 'batch'
+        self.profile_save_path = None
+        self.profile_record_layers = True
         self.execution_id = None
 
         self._is_optimizer_warmup = False
@@ -67,6 +86,7 @@ class TrainingPlan(object):
         # NumberOfEpochsStoppingCriterionCallback(1)]  # elif not any([issubclass(type(cb),
         # StoppingCriterionCallback) for cb in self.callbacks]):  #  #     self.callbacks.append(  #
         # NumberOfEpochsStoppingCriterionCallback(1))
+        self.callback_dispatcher = CallbackDispatcher(self.callbacks)
         self.is_terminate = False
 
     @property
@@ -87,6 +107,23 @@ class TrainingPlan(object):
             self.callbacks.extend(callbacks)
         return self
 
+    def dispatch_callbacks(self, when):
+        """Call the hook of a training event on the shared callbacks overriding it, with the training plan as context."""
+        if self.callback_dispatcher.callbacks is not self.callbacks:
+            self.callback_dispatcher.bind(self.callbacks)
+        self.callback_dispatcher.dispatch(when, self.__dict__, shared=True)
+
+    def report_callbacks(self):
+        """Print the time spent in the callbacks of the training items and in the shared callbacks."""
+        dispatchers = [(name, trainitem.callback_dispatcher) for name, trainitem in zip(self.training_names.value_list, self.training_items.value_list)
+                       if getattr(trainitem, 'callback_dispatcher', None) is not None]
+        dispatchers.append(('shared callbacks', self.callback_dispatcher))
+        for name, dispatcher in dispatchers:
+            summary = dispatcher.summary()
+            if len(summary) > 0:
+                print('Callback time of {0}:'.format(name))
+                print(summary)
+
     def __getattr__(self, name):
         if name == 'self':
             return self
@@ -247,6 +284,43 @@ class TrainingPlan(object):
             self.save_model_unit = unit
         return self
 
+    def profile_scheduling(self, frequency: int, unit='batch', save_path: str = None, record_layers=True):
+        """Profile one training step every `frequency` batches (or epochs).
+
+        The sampled steps record the forward/backward time, cuda time, activation memory and FLOPs of every layer,
+        and the time spent in data loading, host to device copy, forward, loss, backward, optimizer step, metrics and
+        callbacks. The aggregated table is printed at the end of the training and the Chrome trace is written to
+        save_path ('{0}' is replaced by the training item name).
+
+        Args:
+            frequency (int): profile one step every frequency units.
+            unit (str): 'batch' or 'epoch'.
+            save_path (str): the Chrome trace path, default 'Log/profile_{0}_<execution id>.json'.
+            record_layers (bool): also record every layer, False to only time the phases of the step.
+
+        """
+        if unit not in ['batch', 'epoch']:
+            raise ValueError('unit should be batch or epoch')
+        self.profile_frequency = frequency
+        self.profile_unit = unit
+        self.profile_save_path = save_path
+        self.profile_record_layers = record_layers
+        return self
+
+    def report_profile(self):
+        """Print the profiling tables of the training items and write their Chrome traces."""
+        for name, trainitem in zip(self.training_names.value_list, self.training_items.value_list):
+            profiler = getattr(trainitem, 'profiler', None)
+            if profiler is None or profiler.num_steps == 0:
+                continue
+            save_path = self.profile_save_path
+            if save_path is None:
+                save_path = os.path.join('Log', 'profile_{0}_' + str(self.execution_id) + '.json')
+            save_path = sanitize_path(save_path.format(name))
+            print('Profile of {0}:'.format(name))
+            print(profiler.summary())
+            print('Chrome trace saved to {0}'.format(profiler.export_chrome_trace(save_path)))
+
     def display_tile_image_scheduling(self, frequency: int, unit='batch', save_path: str = None,
                                       name_prefix: str = 'tile_image_{0}.png', include_input=True, include_output=True,
                                       include_target=True, include_mask=None, imshow=None):
@@ -354,6 +428,8 @@ class TrainingPlan(object):
                 #     available_items.remove(out.replace("output","target").replace("student","teacher"))
 
             trainingitem.training_context['data_feed'] = data_feed
+            if hasattr(trainingitem, 'compile_call_plans'):
+                trainingitem.compile_call_plans()
             print('data_feed for {0} :{1}'.format(trainingitem.name, data_feed))
 
     def start_now(self, collect_data_inteval=1, is_resume=False, only_steps=False, max_batches=np.inf,
@@ -377,9 +453,7 @@ class TrainingPlan(object):
                                 # shared callback
                                 item.with_callbacks(callback)
                 # shared callbacks will access training plan dict instead of training_context
-                for callback in self.callbacks:
-                    if callback.is_shared == True:
-                        callback.on_training_start(self.__dict__)
+                self.dispatch_callbacks('on_training_start')
 
             data_loader = self._dataloaders.value_list[0]
             data_loader.minibatch_size = self.minibatch_size
@@ -392,27 +466,53 @@ class TrainingPlan(object):
             if only_steps == True:
                 self.num_epochs = (max_batches // len(data_loader.batch_sampler)) + 2
 
-            for epoch in range(self.num_epochs):
+            def to_iter_data(return_data):
+                iter_data = OrderedDict()
+                if isinstance(return_data, OrderedDict):
+                    for spec, data in return_data.item_list:
+                        iter_data[spec.name] = data
+                elif isinstance(return_data, tuple):
+                    for i in range(len(return_data)):
+                        iter_data[data_loader.traindata.data_template.key_list[i].name] = return_data[i]
+                return iter_data
+
+            # training items able to stage the next minibatch to device get it one step ahead
+            use_prefetch = any([hasattr(trainitem, 'prefetch_data') for trainitem in self.training_items.value_list])
+            batch_stream = _lookahead(data_loader) if use_prefetch else None
+
+            if self.profile_frequency > 0:
+                if _backend == 'pytorch':
+                    for trainitem in self.training_items.value_list:
+                        if getattr(trainitem, 'profiler', None) is None:
+                            trainitem.profiler = Profiler(trainitem._model, record_layers=self.profile_record_layers)
+                else:
+                    sys.stderr.write('profile_scheduling is only supported by the pytorch backend.\n')
+
+            # a resumed training continues from the epoch after its last checkpoint
+            start_epoch = 0
+            if is_resume and only_steps == False:
+                start_epoch = builtins.min([item.training_context.get('resume_epoch', 0) for item in self.training_items.value_list])
+            for epoch in range(start_epoch, self.num_epochs):
+                data_wait_start = time.perf_counter()
                 try:
-                    for mbs, return_data in enumerate(data_loader):
+                    for mbs, (return_data, next_return_data) in enumerate(batch_stream if use_prefetch else ((item, None) for item in data_loader)):
                         if self.is_terminate:
-                            for callback in self.callbacks:
-                                if callback.is_shared == True:
-                                    callback.on_training_terminated(self.__dict__)
+                            self.dispatch_callbacks('on_training_terminated')
 
                             for k, trainitem in self.training_items.items():
-                                for callback in trainitem.training_context['callbacks']:
-                                    if callback.is_shared == False:
-                                        callback.on_training_terminated(trainitem.training_context)
+                                trainitem.dispatch_callbacks('on_training_terminated', shared=False)
                         else:
+                            data_wait_end = time.perf_counter()
                             num_batches = len(data_loader.batch_sampler) * epoch + mbs
-                            iter_data = OrderedDict()
-                            if isinstance(return_data, OrderedDict):
-                                for spec, data in return_data.item_list:
-                                    iter_data[spec.name] = data
-                            elif isinstance(return_data, tuple):
-                                for i in range(len(return_data)):
-                                    iter_data[data_loader.traindata.data_template.key_list[i].name] = return_data[i]
+                            need_profile = self.profile_frequency > 0 and _backend == 'pytorch' and (
+                                    (self.profile_unit == 'batch' and (num_batches + 1) % self.profile_frequency == 0) or
+                                    (self.profile_unit == 'epoch' and (epoch + 1) % self.profile_frequency == 0 and
+                                     mbs == builtins.min(1, len(data_loader.batch_sampler) - 1)))
+                            if need_profile:
+                                for trainitem in self.training_items.value_list:
+                                    trainitem.profiler.start_step(num_batches)
+                                    trainitem.profiler.record('data_loading', data_wait_start, data_wait_end)
+                            iter_data = to_iter_data(return_data)
 
                             # check weather need out-of-sample evaluation
                             need_out_sample_evaluation = False
@@ -448,10 +548,16 @@ class TrainingPlan(object):
                                             iter_testdata[data_loader.traindata.data_template.key_list[i].name] = return_test[i]
 
                             # input, target = Variable(input).to(self.device), Variable(target).to(self.device)
+                            if next_return_data is not None:
+                                next_iter_data = to_iter_data(next_return_data)
+                                for trainitem in self.training_items.value_list:
+                                    if hasattr(trainitem, 'prefetch_data'):
+                                        trainitem.prefetch_data(copy.copy(next_iter_data))
 
                             for trainitem_name, trainitem in zip(self.training_names.value_list, self.training_items.value_list):
-                                train_data = copy.deepcopy(iter_data)
-                                test_data = copy.deepcopy(iter_testdata)
+                                # to_tensor always copies the arrays, so every training item only needs its own dict
+                                train_data = copy.copy(iter_data)
+                                test_data = copy.copy(iter_testdata)
 
                                 trainitem.training_context['model_name'] = trainitem_name
                                 if epoch < int(trainitem.start_epoch):
@@ -472,12 +578,11 @@ class TrainingPlan(object):
                                 print('\n', flush=True)
 
                             for k, trainitem in self.training_items.items():
-                                for callback in trainitem.training_context['callbacks']:
-                                    if callback.is_shared == False:
-                                        callback.on_overall_batch_end(trainitem.training_context)
-                            for callback in self.callbacks:
-                                if callback.is_shared == True:
-                                    callback.on_overall_batch_end(self.__dict__)
+                                trainitem.dispatch_callbacks('on_overall_batch_end', shared=False)
+                            self.dispatch_callbacks('on_overall_batch_end')
+                            if need_profile:
+                                for trainitem in self.training_items.value_list:
+                                    trainitem.profiler.end_step()
 
                             if self.save_model_frequency > 0 and self.save_model_unit == 'batch' and (num_batches + 1) % \
                                     self.save_model_frequency == 0:
@@ -490,10 +595,16 @@ class TrainingPlan(object):
                                         trainitem.save_model()
                                     except Exception as e:
                                         print(e)
+                                if hasattr(data_loader, 'close'):
+                                    data_loader.close()
+                                self.wait_checkpoints()
+                                self.report_profile()
+                                self.report_callbacks()
                                 return True
 
                             if only_steps == False and (mbs + 1) % len(data_loader.batch_sampler) == 0:
                                 break
+                            data_wait_start = time.perf_counter()
 
                 except StopIteration:
                     for k, trainitem in self.training_items.items():
@@ -513,16 +624,29 @@ class TrainingPlan(object):
                         epoch + 1) % self.save_model_frequency == 0:
                     for k, trainitem in self.training_items.items():
                         trainitem.save_model()
-
+            # shutdown the loader workers
+            if hasattr(data_loader, 'close'):
+                data_loader.close()
+            self.wait_checkpoints()
+            self.report_profile()
+            self.report_callbacks()
 
         except KeyboardInterrupt:
             for k, trainitem in self.training_items.items():
                 trainitem.save_model()
+            self.wait_checkpoints()
         except Exception as e:
             print(e)
             PrintException()
             for k, trainitem in self.training_items.items():
                 trainitem.save_model()
+            self.wait_checkpoints()
+
+    def wait_checkpoints(self):
+        """Block until the checkpoints written in background by the training items are on disk."""
+        for trainitem in self.training_items.value_list:
+            if getattr(trainitem, 'checkpoint_writer', None) is not None:
+                trainitem.checkpoint_writer.wait()
 
     def resume(self):
         self.start_now(is_resume=True)